@@ -0,0 +1,57 @@
+"""
+Benchmark the assignment of positional colormaps to tiles.
+
+Usage: python benchmarks/bench_positional_cmaps.py
+"""
+
+import time
+
+import numpy as np
+import xarray as xr
+
+from spatial_image import to_spatial_image
+from multiview_stitcher import param_utils, spatial_image_utils
+
+from napari_stitcher import viewer_utils
+
+
+TRANSFORM_KEY = 'affine_metadata'
+
+
+def generate_tiles(n_tiles, tile_shape=(4, 4), spacing=25., overlap=0.1):
+    """
+    Generate lightweight 2D tiles arranged on a (jittered) square grid.
+    """
+
+    n_x = int(np.ceil(np.sqrt(n_tiles)))
+    tile_extent = np.array(tile_shape) * spacing
+    rng = np.random.default_rng(0)
+
+    sims = []
+    for itile in range(n_tiles):
+        grid_pos = np.array([itile // n_x, itile % n_x])
+        offset = grid_pos * tile_extent * (1 - overlap)\
+            + rng.uniform(-0.02, 0.02, 2) * tile_extent
+        sim = to_spatial_image(
+            np.zeros(tile_shape, dtype=np.uint8),
+            dims=['y', 'x'],
+            scale={'y': spacing, 'x': spacing},
+        )
+        spatial_image_utils.set_sim_affine(
+            sim,
+            xr.DataArray(param_utils.affine_from_translation(offset),
+                         dims=['x_in', 'x_out']),
+            transform_key=TRANSFORM_KEY)
+        sims.append(sim)
+
+    return sims
+
+
+if __name__ == '__main__':
+
+    print('%10s %12s' % ('n_tiles', 'time [s]'))
+    for n_tiles in [10, 100, 1000, 10000]:
+        sims = generate_tiles(n_tiles)
+        start = time.perf_counter()
+        viewer_utils.get_cmaps_from_sims(sims, transform_key=TRANSFORM_KEY)
+        print('%10d %12.4f' % (n_tiles, time.perf_counter() - start))
@@ -2,7 +2,6 @@ __version__ = "0.0.1"
 
 from ._reader import napari_get_reader
 from ._sample_data import make_sample_data
-from ._widget import StitcherQWidget
 from ._writer import write_multiple, write_single_image
 
 __all__ = (
@@ -11,4 +10,17 @@ __all__ = (
     "write_multiple",
     "make_sample_data",
     "StitcherQWidget",
+    "BatchQueueQWidget",
 )
+
+
+def __getattr__(name):
+    # import the widgets (and Qt) only when needed, such that
+    # e.g. the command line interface runs without a display
+    if name == "StitcherQWidget":
+        from ._widget import StitcherQWidget
+        return StitcherQWidget
+    if name == "BatchQueueQWidget":
+        from ._batch_widget import BatchQueueQWidget
+        return BatchQueueQWidget
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
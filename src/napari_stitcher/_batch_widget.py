@@ -0,0 +1,348 @@
+"""
+Widget queueing several mosaic files for stitching.
+
+Queued files are registered and fused one after the other or overlapping
+(see `_cli.run_batch`), sharing a pool of threads and a memory budget.
+The throughput of each job is shown in the queue.
+"""
+import itertools
+import os
+
+from napari.utils import notifications
+from napari.qt.threading import create_worker
+
+from magicgui import widgets
+from qtpy.QtCore import Signal
+from qtpy.QtWidgets import QVBoxLayout, QWidget
+
+from napari_stitcher import _cli, _reader, _utils
+
+
+# columns of the queue table
+QUEUE_COLUMNS = ['File', 'Scene', 'Status', 'Tiles/s', 'GB/s']
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+
+class BatchQueueQWidget(QWidget):
+    """
+    Queue of mosaic files to stitch without loading them into the viewer.
+    """
+
+    # emitted from worker threads with the id of each job once it starts
+    job_started = Signal(int)
+
+    def __init__(self, napari_viewer):
+        super().__init__()
+        self.viewer = napari_viewer
+
+        self.setLayout(QVBoxLayout())
+
+        self.files_edit = widgets.FileEdit(
+            mode='rm', label='Files:', filter='*.czi')
+        self.button_add = widgets.Button(text='Add to queue',
+            tooltip='Queue all scenes of the chosen files.')
+        self.button_remove = widgets.Button(text='Clear finished',
+            tooltip='Remove finished, failed and cancelled jobs\n'+\
+                    'from the queue.')
+
+        self.queue_table = widgets.Table(
+            value={'data': [], 'index': [], 'columns': QUEUE_COLUMNS},
+            label='Queue:')
+
+        self.reg_ch_edit = widgets.LineEdit(
+            label='Reg channel:', value='',
+            tooltip='Channel used for registration (empty: first channel).')
+
+        self.timepoints_edit = widgets.LineEdit(
+            label='Timepoints:', value='',
+            tooltip="Time range to stitch as 'start:stop'\n"+\
+                    "(empty: all timepoints).")
+
+        self.reg_binning_xy = widgets.SpinBox(
+            label='Binning XY:', value=1, min=1, max=64,
+            tooltip='Binning applied in x and y during registration.')
+
+        self.reg_binning_z = widgets.SpinBox(
+            label='Binning Z:', value=1, min=1, max=64,
+            tooltip='Binning applied in z during registration (3D data only).')
+
+        self.reg_pyramid_levels = widgets.SpinBox(
+            label='Pyramid levels:', value=1, min=1, max=6,
+            tooltip='Number of levels for coarse-to-fine registration.')
+
+        self.output_format = widgets.ComboBox(
+            label='Output format:', choices=list(_cli.OUTPUT_FORMATS),
+            value='zarr')
+
+        self.output_dir = widgets.FileEdit(
+            mode='d', label='Output folder:',
+            tooltip='Folder of the fused images\n'+\
+                    '(empty: next to the input files).')
+
+        self.n_threads = widgets.SpinBox(
+            label='CPU threads:', value=os.cpu_count() or 1, min=1, max=1024,
+            tooltip='Number of threads shared by all running jobs.')
+
+        self.memory_budget = widgets.FloatSpinBox(
+            label='Memory budget (GB):',
+            value=8., min=0.5, max=4096., step=0.5,
+            tooltip='Memory shared by all running jobs. Jobs wait until\n'+\
+                    'their estimated memory usage fits into the budget.')
+
+        self.n_jobs_in_flight = widgets.SpinBox(
+            label='Concurrent jobs:', value=2, min=1, max=64,
+            tooltip='Maximum number of jobs running at the same time.')
+
+        self.button_run = widgets.Button(text='Run queue',
+            tooltip='Stitch all queued jobs.')
+        self.button_cancel = widgets.Button(text='Cancel', enabled=False,
+            tooltip='Stop the running jobs.')
+
+        self.setting_widgets = [
+                            self.reg_ch_edit,
+                            self.timepoints_edit,
+                            self.reg_binning_xy,
+                            self.reg_binning_z,
+                            self.reg_pyramid_levels,
+                            self.output_format,
+                            self.output_dir,
+                            self.n_threads,
+                            self.memory_budget,
+                            self.n_jobs_in_flight,
+                            ]
+
+        self.queue_widgets = [
+                            self.files_edit,
+                            widgets.HBox(widgets=[self.button_add,
+                                                  self.button_remove]),
+                            self.queue_table,
+                            ]
+
+        self.container = widgets.VBox(widgets=\
+                            self.queue_widgets+
+                            self.setting_widgets+
+                            [widgets.HBox(widgets=[self.button_run,
+                                                   self.button_cancel])]
+                            )
+
+        self.layout().addWidget(self.container.native)
+
+        # queued jobs: file and scene, status and throughput of each job,
+        # identified by an id which stays valid while jobs are removed
+        self.jobs = []
+        self.job_ids = itertools.count()
+
+        # background job state
+        self.worker = None
+        self.cancel_callback = None
+
+        self.button_add.clicked.connect(self.add_files)
+        self.button_remove.clicked.connect(self.clear_finished)
+        self.button_run.clicked.connect(self.start_queue)
+        self.button_cancel.clicked.connect(self.cancel_queue)
+        self.job_started.connect(self.set_job_running)
+
+
+    def add_files(self, paths=None):
+        """
+        Queue all scenes of the given files (by default those chosen).
+        """
+
+        if paths is None:
+            paths = self.files_edit.value
+
+        for path in paths:
+            path = str(path)
+            for scene_index in range(_reader.get_n_scenes(path)):
+                self.jobs.append({
+                    'id': next(self.job_ids),
+                    'path': path,
+                    'scene_index': scene_index,
+                    'status': STATUS_QUEUED,
+                    'stats': None,
+                    })
+
+        self.update_queue_table()
+
+
+    def get_job(self, job_id):
+        """
+        Queued job of the given id, None if it has been removed.
+        """
+
+        for job in self.jobs:
+            if job['id'] == job_id:
+                return job
+
+        return None
+
+
+    def clear_finished(self):
+
+        self.jobs = [job for job in self.jobs
+                     if job['status'] in [STATUS_QUEUED, STATUS_RUNNING]]
+
+        self.update_queue_table()
+
+
+    def update_queue_table(self):
+
+        data = []
+        for job in self.jobs:
+            stats = job['stats'] if job['stats'] is not None else dict()
+            data.append([
+                os.path.basename(job['path']),
+                job['scene_index'],
+                job['status'],
+                '%.1f' %stats['tiles_per_s'] if 'tiles_per_s' in stats else '',
+                '%.3f' %stats['gb_per_s'] if 'gb_per_s' in stats else '',
+                ])
+
+        self.queue_table.value = {
+            'data': data,
+            'index': list(range(len(data))),
+            'columns': QUEUE_COLUMNS}
+
+
+    def get_job_kwargs(self, job):
+        """
+        Keyword arguments of _cli.stitch_file for a queued job,
+        as chosen in the widget.
+        """
+
+        output_dir = str(self.output_dir.value)
+        if output_dir in ['', '.']:
+            output_dir = None
+
+        # keep the default behaviour of multiview-stitcher
+        # if no binning is chosen
+        registration_binning = None
+        if max(self.reg_binning_xy.value, self.reg_binning_z.value) > 1:
+            registration_binning = {'z': self.reg_binning_z.value,
+                                    'y': self.reg_binning_xy.value,
+                                    'x': self.reg_binning_xy.value}
+
+        return dict(
+            path=job['path'],
+            output_path=_cli.get_output_path(
+                job['path'], job['scene_index'], output_dir,
+                self.output_format.value),
+            scene_index=job['scene_index'],
+            timepoints=_cli.parse_timepoints(
+                self.timepoints_edit.value or None),
+            output_format=self.output_format.value,
+            reg_channel=self.reg_ch_edit.value or None,
+            registration_binning=registration_binning,
+            n_pyramid_levels=self.reg_pyramid_levels.value,
+            )
+
+
+    def start_queue(self):
+        """
+        Stitch the queued jobs in a background thread,
+        updating the queue each time a job has finished.
+        """
+
+        if self.worker is not None:
+            notifications.notification_manager.receive_info(
+                'The queue is running already.')
+            return
+
+        jobs = [job for job in self.jobs if job['status'] == STATUS_QUEUED]
+
+        if not len(jobs): return
+
+        job_ids = [job['id'] for job in jobs]
+        job_kwargs = [self.get_job_kwargs(job) for job in jobs]
+
+        for kwargs in job_kwargs:
+            os.makedirs(os.path.dirname(kwargs['output_path']), exist_ok=True)
+
+        cancel_callback = _utils.CancelCallback()
+
+        n_threads = self.n_threads.value
+        memory_budget = int(self.memory_budget.value * 1024 ** 3)
+        n_jobs_in_flight = self.n_jobs_in_flight.value
+
+        def run():
+            # the callback needs to be entered in the worker thread
+            with cancel_callback:
+                try:
+                    for ikwargs, stats in _cli.run_batch(
+                            job_kwargs,
+                            n_threads=n_threads,
+                            memory_budget=memory_budget,
+                            n_jobs_in_flight=n_jobs_in_flight,
+                            job_callback=lambda ikwargs:
+                                self.job_started.emit(job_ids[ikwargs]),
+                            ):
+                        yield job_ids[ikwargs], stats
+                except _utils.ComputationCancelledError:
+                    return
+
+        self.cancel_callback = cancel_callback
+        self.worker = create_worker(run, _start_thread=False)
+        self.worker.yielded.connect(lambda result: self.set_job_stats(*result))
+        self.worker.finished.connect(self.finish_queue)
+
+        self.button_run.enabled = False
+        self.button_cancel.enabled = True
+
+        self.worker.start()
+
+
+    def set_job_running(self, job_id):
+
+        job = self.get_job(job_id)
+        if job is None: return
+
+        job['status'] = STATUS_RUNNING
+
+        self.update_queue_table()
+
+
+    def set_job_stats(self, job_id, stats):
+
+        job = self.get_job(job_id)
+        if job is None: return
+
+        job['stats'] = stats
+        job['status'] = STATUS_FAILED if 'error' in stats else STATUS_DONE
+
+        if 'error' in stats:
+            notifications.notification_manager.receive_info(
+                'Stitching %s failed: %s' %(job['path'], stats['error']))
+
+        self.update_queue_table()
+
+
+    def finish_queue(self):
+
+        for job in self.jobs:
+            if job['status'] == STATUS_RUNNING:
+                job['status'] = STATUS_CANCELLED
+        self.update_queue_table()
+
+        self.button_run.enabled = True
+        self.button_cancel.enabled = False
+
+        self.worker = None
+        self.cancel_callback = None
+
+
+    def cancel_queue(self):
+        """
+        Cancel the running jobs, which are marked as cancelled.
+        Jobs which haven't started yet remain queued.
+        """
+
+        if self.worker is None: return
+
+        self.cancel_callback.cancel()
+        self.worker.quit()
+        self.button_cancel.enabled = False
@@ -0,0 +1,483 @@
+"""
+Command line interface for stitching mosaic files without a viewer.
+
+Runs the same pipeline as the stitcher widget (read tiles, register
+them using one channel, fuse all channels) on a headless machine, e.g.
+
+    napari-stitcher mosaic1.czi mosaic2.czi --reg-channel DAPI \\
+        --timepoints 0:10 --binning-xy 2 --output-format tif -o stitched
+
+Several files (and scenes) can be processed in parallel using --n-jobs.
+Within a single process, `run_batch` stitches a queue of files sharing
+a pool of threads and a memory budget (see the batch queue widget).
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import dask.threaded
+
+from multiview_stitcher import fusion, msi_utils, spatial_image_utils
+from multiview_stitcher.io import METADATA_TRANSFORM_KEY
+
+from napari_stitcher import _reader, _writer, _utils, registration_utils
+
+
+logger = logging.getLogger(__name__)
+
+REGISTERED_TRANSFORM_KEY = 'affine_registered'
+
+OUTPUT_FORMATS = {'zarr': '.ome.zarr', 'tif': '.ome.tif'}
+
+# suffix of outputs being written
+PARTIAL_SUFFIX = '.partial'
+
+
+def parse_timepoints(timepoints):
+    """
+    Parse a time range given as 'start:stop' (stop excluded, both
+    optional) or as a single timepoint index into a slice.
+    """
+
+    if timepoints is None:
+        return slice(None)
+
+    try:
+        if ':' not in timepoints:
+            t = int(timepoints)
+            return slice(t, t + 1)
+
+        start, stop = [int(s) if s.strip() else None
+                       for s in timepoints.split(':')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Invalid time range '%s', expected 'start:stop'" %timepoints)
+
+    return slice(start, stop)
+
+
+def stitch_sims(
+        sims,
+        reg_channel=None,
+        registration_binning=None,
+        n_pyramid_levels=1,
+        tile_ids=None,
+        cache_dir=None,
+        scheduler=None,
+        ):
+    """
+    Register tiles using one channel and (lazily) fuse all channels.
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+        Tiles with a channel dimension and their positions
+        stored under METADATA_TRANSFORM_KEY
+    reg_channel : str, optional
+        Channel used for registration, by default None (first channel)
+    registration_binning : dict, optional
+        Binning applied to each dimension during registration (dimensions
+        not present in the tiles are ignored), by default None
+    n_pyramid_levels : int, optional
+        Number of levels used for coarse-to-fine registration, by default 1
+    tile_ids : list of str, optional
+        Identifiers of the tiles used for caching pairwise registration
+        results, by default None (no caching)
+    cache_dir : str, optional
+        Directory of the registration cache, by default None
+    scheduler : optional
+        Dask scheduler used for registration, by default
+        the current dask scheduler
+
+    Returns
+    -------
+    dict
+        Fused SpatialImage for each channel
+    """
+
+    channels = [str(ch) for ch in sims[0].coords['c'].values]
+
+    if reg_channel is None:
+        reg_channel = channels[0]
+    elif reg_channel not in channels:
+        raise ValueError("Registration channel '%s' not found, available "
+                         "channels: %s" %(reg_channel, ', '.join(channels)))
+
+    if registration_binning is not None:
+        spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+        registration_binning = {dim: registration_binning[dim]
+                                for dim in spatial_dims}
+
+    reg_msims = [msi_utils.multiscale_sel_coords(
+                    msi_utils.get_msim_from_sim(sim, scale_factors=[]),
+                    {'c': sim.coords['c'].values[channels.index(reg_channel)]})
+                 for sim in sims]
+
+    params = registration_utils.register(
+        reg_msims,
+        transform_key=METADATA_TRANSFORM_KEY,
+        registration_binning=registration_binning,
+        n_pyramid_levels=n_pyramid_levels,
+        tile_ids=tile_ids,
+        cache_dir=cache_dir,
+        scheduler=scheduler,
+    )
+
+    for sim, p in zip(sims, params):
+        spatial_image_utils.set_sim_affine(
+            sim, p,
+            transform_key=REGISTERED_TRANSFORM_KEY,
+            base_transform_key=METADATA_TRANSFORM_KEY)
+
+    fused_sims = dict()
+    for ich, ch in enumerate(channels):
+
+        sims_ch = [spatial_image_utils.sim_sel_coords(
+                       sim, {'c': sim.coords['c'].values[ich]})
+                   for sim in sims]
+
+        fused = fusion.fuse(sims_ch, transform_key=REGISTERED_TRANSFORM_KEY)
+
+        fused_sims[ch] = fused.expand_dims(
+            {'c': [sims_ch[0].coords['c'].values]})
+
+    return fused_sims
+
+
+def save_fused_sims(path, fused_sims, output_format='zarr',
+                    scheduler=None, memory_budget=None):
+    """
+    Write the fused channels into a multiscale OME-Zarr or an OME-TIFF
+    file, using the given dask scheduler. For OME-TIFF, memory_budget
+    limits the number of bytes computed at once.
+    """
+
+    if output_format == 'zarr':
+        layers_sims = []
+        for fused in fused_sims.values():
+            mfused = msi_utils.get_msim_from_sim(fused, scale_factors=None)
+            layers_sims.append([mfused[sk]['image'] for sk in
+                                msi_utils.get_sorted_scale_keys(mfused)])
+        _writer.save_sims_as_ome_zarr(path, layers_sims, scheduler=scheduler)
+    elif output_format == 'tif':
+        kwargs = dict()
+        if memory_budget is not None:
+            kwargs['memory_budget'] = memory_budget
+        _writer.save_sims_as_tif(path, list(fused_sims.values()),
+                                 scheduler=scheduler, **kwargs)
+    else:
+        raise ValueError("Unknown output format '%s'" %output_format)
+
+
+def stitch_file(
+        path,
+        output_path,
+        scene_index=0,
+        timepoints=slice(None),
+        output_format='zarr',
+        scheduler=None,
+        memory_budget=None,
+        start_callback=None,
+        **kwargs,
+        ):
+    """
+    Stitch a scene of a mosaic file and write the result to output_path.
+    Keyword arguments are passed to `stitch_sims`.
+
+    Given a `_utils.MemoryBudget`, the estimated memory of the job
+    (see `get_job_memory_estimate`) is reserved before stitching.
+    start_callback is called once stitching starts.
+
+    Returns
+    -------
+    dict
+        Throughput of the job: number of tiles (counting each timepoint),
+        input bytes, duration in seconds, tiles/s and GB/s
+    """
+
+    sims = _reader.read_mosaic_into_sims(path, scene_index=scene_index)
+
+    if 't' in sims[0].dims:
+        # select the transforms of the timepoints, too. sim_sel_coords
+        # modifies the transforms in place, which may be a xr.Dataset
+        for sim in sims:
+            sim.attrs['transforms'] = dict(sim.attrs['transforms'])
+        sims = [spatial_image_utils.sim_sel_coords(
+                    sim, {'t': sim.coords['t'].values[timepoints]})
+                for sim in sims]
+
+    # registration results are cached per tile, such that
+    # interrupted batches can be resumed quickly
+    tile_ids = ['%s :: scene %s :: tile %s'
+                %(_utils.get_file_id(path), scene_index, itile)
+                for itile in range(len(sims))]
+
+    with ExitStack() as stack:
+
+        # written OME-TIFF slabs stay within the reserved memory
+        reserved_nbytes = None
+        if memory_budget is not None:
+            reserved_nbytes = get_job_memory_estimate(
+                sims, kwargs.get('registration_binning'))
+            stack.enter_context(memory_budget.reserve(reserved_nbytes))
+
+        if start_callback is not None:
+            start_callback()
+
+        start_time = time.perf_counter()
+
+        fused_sims = stitch_sims(
+            sims,
+            tile_ids=tile_ids,
+            cache_dir=registration_utils.get_registration_cache_dir(),
+            scheduler=scheduler,
+            **kwargs,
+        )
+
+        # write to a temporary path first, such that interrupted jobs
+        # don't leave incomplete outputs which would be skipped
+        partial_path = os.fspath(output_path) + PARTIAL_SUFFIX
+        remove_output(partial_path)
+
+        save_fused_sims(
+            partial_path, fused_sims, output_format=output_format,
+            scheduler=scheduler, memory_budget=reserved_nbytes)
+
+        remove_output(output_path)
+        os.replace(partial_path, output_path)
+
+        duration = time.perf_counter() - start_time
+
+    n_timepoints = len(sims[0].coords['t']) if 't' in sims[0].dims else 1
+    n_tiles = len(sims) * n_timepoints
+    nbytes = sum(sim.nbytes for sim in sims)
+
+    return {
+        'n_tiles': n_tiles,
+        'nbytes': nbytes,
+        'duration': duration,
+        'tiles_per_s': n_tiles / duration,
+        'gb_per_s': nbytes / 1e9 / duration,
+    }
+
+
+def remove_output(path):
+    """
+    Remove an OME-Zarr directory or an OME-TIFF file, if it exists.
+    """
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def get_job_memory_estimate(sims, registration_binning=None):
+    """
+    Estimate the memory needed for stitching tiles: registration loads
+    the (binned) registration channel of all tiles. The memory used
+    for fusion is bounded by the number of threads computing chunks.
+    """
+
+    n_channels = len(sims[0].coords['c']) if 'c' in sims[0].dims else 1
+    nbytes = sum(sim.nbytes for sim in sims) / n_channels
+
+    if registration_binning is not None:
+        spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+        nbytes /= np.prod([registration_binning[dim] for dim in spatial_dims])
+
+    return int(nbytes)
+
+
+def run_batch(jobs, n_threads=None, memory_budget=None, n_jobs_in_flight=2,
+              job_callback=None):
+    """
+    Stitch several files back to back or overlapping, with at most
+    n_jobs_in_flight jobs at a time. All jobs compute on a shared pool
+    of n_threads dask threads and share a memory budget (in bytes).
+
+    Parameters
+    ----------
+    jobs : list of dict
+        Keyword arguments of `stitch_file` for each job
+    n_threads : int, optional
+        Number of threads shared by all jobs, by default None
+        (number of CPUs)
+    memory_budget : int, optional
+        Memory shared by all jobs, by default None (unlimited)
+    n_jobs_in_flight : int, optional
+        Maximum number of jobs running at the same time, by default 2
+    job_callback : func, optional
+        Called (from a worker thread) with the index of each job once
+        it starts, i.e. once its memory has been reserved, by default None
+
+    Yields
+    ------
+    (int, dict)
+        Index of each finished job and its throughput (see `stitch_file`),
+        or the error message under 'error' if the job failed
+    """
+
+    budget = None
+    if memory_budget is not None:
+        budget = _utils.MemoryBudget(memory_budget)
+
+    with ThreadPoolExecutor(n_threads) as pool:
+
+        scheduler = partial(dask.threaded.get, pool=pool)
+
+        def run(ijob_job):
+            ijob, job = ijob_job
+            start_callback = None
+            if job_callback is not None:
+                start_callback = partial(job_callback, ijob)
+            try:
+                return stitch_file(
+                    **job, scheduler=scheduler, memory_budget=budget,
+                    start_callback=start_callback)
+            except _utils.ComputationCancelledError:
+                raise
+            except Exception as e:
+                logger.exception('Failed to stitch %s', job['path'])
+                return {'error': str(e)}
+
+        yield from _utils.map_bounded(run, enumerate(jobs), n_jobs_in_flight)
+
+
+def init_worker(n_threads):
+    """
+    Limit the default dask threadpool of a worker process, such that
+    stitching files in parallel processes doesn't oversubscribe the CPUs.
+    """
+
+    dask.config.set(num_workers=n_threads)
+
+
+def get_output_path(path, scene_index, output_dir, output_format):
+
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.abspath(path))
+
+    return os.path.join(
+        output_dir,
+        '%s_scene%03d%s' %(
+            Path(path).stem, scene_index, OUTPUT_FORMATS[output_format]))
+
+
+def get_parser():
+
+    parser = argparse.ArgumentParser(
+        prog='napari-stitcher',
+        description='Register and fuse the tiles of mosaic files '
+                    'without opening a viewer.')
+
+    parser.add_argument('paths', nargs='+',
+        help='Mosaic files to stitch, e.g. CZI files')
+    parser.add_argument('--scene', type=int, nargs='+', default=None,
+        help='Scene(s) to stitch from each file (default: all scenes)')
+    parser.add_argument('--reg-channel', default=None,
+        help='Channel used for registration (default: first channel)')
+    parser.add_argument('--timepoints', type=parse_timepoints,
+        default=slice(None),
+        help="Time range to stitch as 'start:stop' (default: all timepoints)")
+    parser.add_argument('--binning-xy', type=int, default=1,
+        help='Binning in x and y used for registration (default: 1)')
+    parser.add_argument('--binning-z', type=int, default=1,
+        help='Binning in z used for registration (default: 1)')
+    parser.add_argument('--pyramid-levels', type=int, default=1,
+        help='Number of levels for coarse-to-fine registration (default: 1)')
+    parser.add_argument('--output-format', choices=list(OUTPUT_FORMATS),
+        default='zarr',
+        help='Format of the fused images (default: zarr)')
+    parser.add_argument('-o', '--output-dir', default=None,
+        help='Directory of the fused images '
+             '(default: next to the input files)')
+    parser.add_argument('--overwrite', action='store_true',
+        help='Stitch again files for which an output exists already')
+    parser.add_argument('-j', '--n-jobs', type=int, default=1,
+        help='Number of files (or scenes) stitched in parallel (default: 1)')
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the napari-stitcher command. Returns
+    a non-zero exit code if any file failed to be stitched.
+    """
+
+    args = get_parser().parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # keep the default behaviour of multiview-stitcher if no binning is chosen
+    registration_binning = None
+    if max(args.binning_xy, args.binning_z) > 1:
+        registration_binning = {'z': args.binning_z,
+                                'y': args.binning_xy, 'x': args.binning_xy}
+
+    # (path, scene index) of each mosaic to stitch
+    sources = [(p, si) for p in args.paths
+               for si in _reader.get_scene_indices(
+                   args.scene, _reader.get_n_scenes(p))]
+
+    jobs = []
+    for path, scene_index in sources:
+        output_path = get_output_path(
+            path, scene_index, args.output_dir, args.output_format)
+        if os.path.exists(output_path) and not args.overwrite:
+            logger.info('Skipping %s (scene %s): %s exists',
+                        path, scene_index, output_path)
+            continue
+        jobs.append(dict(
+            path=path,
+            output_path=output_path,
+            scene_index=scene_index,
+            timepoints=args.timepoints,
+            output_format=args.output_format,
+            reg_channel=args.reg_channel,
+            registration_binning=registration_binning,
+            n_pyramid_levels=args.pyramid_levels,
+            ))
+
+    # the CPUs are shared between the worker processes
+    n_threads = max(1, (os.cpu_count() or 1) // args.n_jobs)
+
+    with ProcessPoolExecutor(
+            args.n_jobs, initializer=init_worker,
+            initargs=(n_threads,)) as executor:
+
+        futures = [executor.submit(stitch_file, **job) for job in jobs]
+
+        n_failed = 0
+        for job, future in zip(jobs, futures):
+            try:
+                stats = future.result()
+                logger.info('Stitched %s (scene %s) into %s '
+                            '(%.1f tiles/s, %.3f GB/s)',
+                            job['path'], job['scene_index'],
+                            job['output_path'],
+                            stats['tiles_per_s'], stats['gb_per_s'])
+            except Exception:
+                n_failed += 1
+                logger.exception('Failed to stitch %s (scene %s)',
+                                 job['path'], job['scene_index'])
+
+    return int(n_failed > 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
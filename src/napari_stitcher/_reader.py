@@ -6,11 +6,27 @@ implement multiple readers or even other plugin contributions. see:
 https://napari.org/stable/plugins/guides.html?#readers
 """
 
-from multiview_stitcher import msi_utils
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from dask.base import tokenize
+
+from spatial_image import to_spatial_image
+
+from multiview_stitcher import msi_utils, param_utils, spatial_image_utils
 from multiview_stitcher.io import read_mosaic_image_into_list_of_spatial_xarrays,\
     METADATA_TRANSFORM_KEY
 
-from napari_stitcher import viewer_utils
+# aicsimageio is an optional dependency of multiview-stitcher
+try:
+    from aicsimageio import AICSImage
+except ImportError:
+    AICSImage = None
+
+from napari_stitcher import _utils, viewer_utils
 
 
 def napari_get_reader(path):
@@ -27,21 +43,27 @@ def napari_get_reader(path):
         If the path is a recognized format, return a function that accepts the
         same path or list of paths, and returns a list of layer data tuples.
     """
-    if isinstance(path, list):
-        # reader plugins may be handed single path, or a list of paths.
-        # if it is a list, it is assumed to be an image stack...
-        # so we are only going to look at the first file.
-        path = path[0]
+    # reader plugins may be handed single path, or a list of paths.
+    # a list of paths is read as several mosaics, each of them namespaced
+    paths = [path] if isinstance(path, str) else path
 
     # if we know we cannot read the file, we immediately return None.
     # otherwise we return the *function* that can read ``path``.
-    if path.endswith(".czi"):
+    if len(paths) and all(str(p).endswith(".czi") for p in paths):
         return read_mosaic
     else:
         return None
     
 
-def read_mosaic(path, scene_index=None):
+def read_mosaic(
+        path,
+        scene_index=None,
+        tile_indices=None,
+        timepoints=None,
+        channels=None,
+        contrast_limits_n_sample_chunks=None,
+        n_workers=None,
+        ):
     """
     
     Read in tiles as layers.
@@ -56,6 +78,22 @@ def read_mosaic(path, scene_index=None):
     ----------
     path : str or list of str
         Path to file, or list of paths.
+    scene_index : int or list of int, optional
+        Scene(s) to read from each file, by default None: ask which scene
+        to read from a single file with several scenes, otherwise read
+        all scenes
+    tile_indices : list of int, optional
+        Tiles to read, by default None (all tiles)
+    timepoints : list of int, optional
+        Indices of the timepoints to read, by default None (all timepoints)
+    channels : list of str, optional
+        Names of the channels to read, by default None (all channels)
+    contrast_limits_n_sample_chunks : int, optional
+        If given, estimate contrast limits from this number of randomly
+        chosen chunks of each tile, by default None (all chunks)
+    n_workers : int, optional
+        Number of threads used to parse the metadata of several files
+        and scenes, by default None (ThreadPoolExecutor default)
 
     Returns
     -------
@@ -69,17 +107,261 @@ def read_mosaic(path, scene_index=None):
     """
     # handle both a string and a list of strings
     paths = [path] if isinstance(path, str) else path
+    paths = [str(p) for p in paths]
+
+    with ThreadPoolExecutor(n_workers) as executor:
+
+        n_scenes = list(executor.map(get_n_scenes, paths))
+
+        if scene_index is None and len(paths) == 1 and n_scenes[0] > 1:
+            scene_index = request_scene_index(n_scenes[0])
+
+        # (path, scene index) of each mosaic to read
+        sources = [(p, si) for p, n in zip(paths, n_scenes)
+                   for si in get_scene_indices(scene_index, n)]
+
+        sims_per_source = list(executor.map(
+            lambda source: read_mosaic_into_sims(
+                source[0],
+                scene_index=source[1],
+                tile_indices=tile_indices,
+                timepoints=timepoints,
+                channels=channels,
+                ),
+            sources))
+
+    source_names = dict(zip(paths, get_source_names(paths)))
 
-    sims = read_mosaic_image_into_list_of_spatial_xarrays(paths[0], scene_index=scene_index)
-    msims = [msi_utils.get_msim_from_sim(sim) for sim in sims]
+    out_layers = []
+    for (source_path, source_scene_index), sims in zip(sources, sims_per_source):
 
-    out_layers = viewer_utils.create_image_layer_tuples_from_msims(
-        msims,
-        transform_key=METADATA_TRANSFORM_KEY)
+        msims = [viewer_utils.get_msim_from_sim_preserving_chunks(sim)
+                 for sim in sims]
+
+        # namespace layers if several mosaics are read
+        if len(sources) > 1:
+            name_prefix = '%s_scene%03d_tile' %(
+                source_names[source_path], source_scene_index)
+        else:
+            name_prefix = 'tile'
+
+        out_layers += viewer_utils.create_image_layer_tuples_from_msims(
+            msims,
+            name_prefix=name_prefix,
+            transform_key=METADATA_TRANSFORM_KEY,
+            contrast_limits_n_sample_chunks=contrast_limits_n_sample_chunks,
+            contrast_limits_cache_key=(
+                _utils.get_file_id(source_path), source_scene_index,
+                *[None if sel is None else tuple(sel)
+                  for sel in [tile_indices, timepoints, channels]]),
+            )
 
     return out_layers
 
 
+def get_source_names(paths):
+    """
+    Get names distinguishing several files, e.g. for namespacing layers.
+
+    Files are named by their stem, prefixed by the name of their folder
+    if several files share a stem. Files which remain ambiguous
+    (e.g. equally named folders) are suffixed by a hash of their path.
+
+    Parameters
+    ----------
+    paths : list of str
+
+    Returns
+    -------
+    list of str
+    """
+
+    abspaths = [os.path.abspath(p) for p in paths]
+
+    def disambiguate(names, get_name):
+        out_names = []
+        for ap, name in zip(abspaths, names):
+            if len({ap2 for ap2, n in zip(abspaths, names) if n == name}) > 1:
+                name = get_name(ap, name)
+            out_names.append(name)
+        return out_names
+
+    names = [Path(ap).stem for ap in abspaths]
+    names = disambiguate(
+        names, lambda ap, name: '%s_%s' %(Path(ap).parent.name, name))
+    names = disambiguate(
+        names, lambda ap, name: '%s_%s' %(name, tokenize(ap)[:6]))
+
+    return names
+
+
+def get_n_scenes(path):
+    """
+    Get the number of scenes contained in a file (reading metadata only).
+    """
+
+    if AICSImage is None:
+        raise ImportError(
+            "aicsimageio is required to read mosaic CZI files. "
+            "Please install it using `pip install aicsimageio`.")
+
+    return len(AICSImage(path, reconstruct_mosaic=False).scenes)
+
+
+def get_scene_indices(scene_index, n_scenes):
+    """
+    Get the list of scene indices to read from a file.
+
+    Parameters
+    ----------
+    scene_index : int, list of int or None
+        Requested scene(s), None meaning all scenes
+    n_scenes : int
+        Number of scenes in the file
+
+    Returns
+    -------
+    list of int
+    """
+
+    if scene_index is None:
+        return list(range(n_scenes))
+    elif isinstance(scene_index, (int, np.integer)):
+        scene_indices = [int(scene_index)]
+    else:
+        scene_indices = [int(si) for si in scene_index]
+
+    for si in scene_indices:
+        if not 0 <= si < n_scenes:
+            raise ValueError(
+                "Scene index %s out of range (%s scenes)" %(si, n_scenes))
+
+    return scene_indices
+
+
+def request_scene_index(n_scenes):
+    """
+    Ask the user which scene to load.
+    """
+
+    from magicgui.widgets import request_values
+
+    return request_values(
+        scene_index={
+            'annotation': int,
+            'label': 'Which scene should be loaded?',
+            'options': {'min': 0, 'max': n_scenes - 1},
+        },
+    )['scene_index']
+
+
+def read_mosaic_into_sims(
+        path,
+        scene_index=0,
+        tile_indices=None,
+        timepoints=None,
+        channels=None,
+        ):
+    """
+    Lazily read the tiles of a CZI mosaic scene into spatial images.
+
+    Only metadata is read. Pixel data is chunked such that each chunk
+    corresponds to a single subblock (tile plane) of the CZI file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the CZI file
+    scene_index : int, optional
+        Scene to read, by default 0
+    tile_indices : list of int, optional
+        Tiles to read, by default None (all tiles)
+    timepoints : list of int, optional
+        Indices of the timepoints to read, by default None (all timepoints)
+    channels : list of str, optional
+        Names of the channels to read, by default None (all channels)
+
+    Returns
+    -------
+    list of SpatialImage
+        One spatial image per tile, with the tile positions
+        stored under METADATA_TRANSFORM_KEY
+    """
+
+    if AICSImage is None:
+        raise ImportError(
+            "aicsimageio is required to read mosaic CZI files. "
+            "Please install it using `pip install aicsimageio`.")
+
+    # one chunk per subblock
+    aicsim = AICSImage(path, reconstruct_mosaic=False, chunk_dims=['Y', 'X'])
+
+    aicsim.set_scene(scene_index)
+
+    xim = aicsim.xarray_dask_data
+    xim = xim.rename({dim: dim.lower() for dim in xim.dims})
+
+    if 'm' not in xim.dims:
+        xim = xim.expand_dims(m=[0])
+
+    # remove singleton z
+    if 'z' in xim.dims and len(xim.coords['z']) < 2:
+        xim = xim.isel(z=0, drop=True)
+
+    if 't' not in xim.dims:
+        xim = xim.expand_dims(t=[0])
+
+    if timepoints is not None:
+        xim = xim.isel(t=list(timepoints))
+    if channels is not None:
+        xim = xim.sel(c=list(channels))
+
+    spatial_dims = [dim for dim in ['z', 'y', 'x'] if dim in xim.dims]
+
+    pixel_sizes = {dim: getattr(aicsim.physical_pixel_sizes, dim.upper())
+                   for dim in spatial_dims}
+    pixel_sizes = {dim: 1. if ps is None else ps for dim, ps in pixel_sizes.items()}
+
+    tile_mosaic_positions = aicsim.get_mosaic_tile_positions()
+
+    if tile_indices is None:
+        tile_indices = range(len(xim.coords['m']))
+
+    sims = []
+    for tile_index in tile_indices:
+
+        tile_xim = xim.isel(m=tile_index, drop=True)
+
+        sim = to_spatial_image(
+            tile_xim.data,
+            dims=tile_xim.dims,
+            scale=pixel_sizes,
+            t_coords=tile_xim.coords['t'].values,
+            c_coords=tile_xim.coords['c'].values,
+        )
+
+        origin = {dim: 0. for dim in spatial_dims}
+        origin.update({
+            dim: tile_mosaic_positions[tile_index][idim] * pixel_sizes[dim]
+            for idim, dim in enumerate(['y', 'x'])})
+
+        affine = param_utils.affine_from_translation(
+            [origin[dim] for dim in spatial_dims])
+
+        spatial_image_utils.set_sim_affine(
+            sim,
+            xr.DataArray(
+                np.stack([affine] * len(sim.coords['t'])),
+                dims=['t', 'x_in', 'x_out']),
+            transform_key=METADATA_TRANSFORM_KEY)
+
+        sim.name = str(tile_index)
+
+        sims.append(sim)
+
+    return sims
+
+
 if __name__ == "__main__":
 
     from multiview_stitcher.sample_data import get_mosaic_sample_data_path
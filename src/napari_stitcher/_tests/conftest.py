@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """
+    Don't write fusion and registration results
+    into the user's cache during tests.
+    """
+    monkeypatch.setenv('NAPARI_STITCHER_CACHE_DIR', str(tmp_path / 'cache'))
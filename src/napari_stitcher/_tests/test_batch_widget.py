@@ -0,0 +1,59 @@
+import numpy as np
+
+from napari_stitcher import BatchQueueQWidget, _batch_widget, _reader,\
+    _sample_data
+
+
+def test_batch_queue(tmp_path, monkeypatch, qtbot):
+    """
+    Queue two files with two scenes each and run the queue in the background.
+    """
+
+    from napari.components import ViewerModel
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=5, zoom=10, dtype=np.uint8)
+
+    monkeypatch.setattr(_reader, 'get_n_scenes', lambda path: 2)
+    monkeypatch.setattr(
+        _reader, 'read_mosaic_into_sims',
+        lambda path, scene_index=0: [sim.copy() for sim in sims])
+
+    wdg = BatchQueueQWidget(ViewerModel())
+
+    wdg.add_files([tmp_path / 'mosaic1.czi', tmp_path / 'mosaic2.czi'])
+    assert(len(wdg.jobs) == 4)
+    assert(wdg.queue_table.shape == (4, len(_batch_widget.QUEUE_COLUMNS)))
+
+    wdg.output_dir.value = tmp_path / 'stitched'
+    wdg.output_format.value = 'tif'
+    wdg.n_threads.value = 2
+
+    # jobs are only marked as running once they start
+    wdg.button_run.clicked()
+    assert(all(job['status'] == _batch_widget.STATUS_QUEUED
+               for job in wdg.jobs))
+
+    qtbot.waitUntil(lambda: wdg.worker is None, timeout=60000)
+
+    assert(all(job['status'] == _batch_widget.STATUS_DONE for job in wdg.jobs))
+    assert(len(list((tmp_path / 'stitched').glob('*.ome.tif'))) == 4)
+    assert(all(wdg.queue_table.data[irow, 3] for irow in range(4)))
+
+    wdg.button_remove.clicked()
+    assert(not len(wdg.jobs))
+
+    # clearing finished jobs while the queue runs keeps the others in place
+    wdg.add_files([tmp_path / 'mosaic3.czi'])
+    wdg.jobs[0]['status'] = _batch_widget.STATUS_DONE
+
+    wdg.button_run.clicked()
+    wdg.button_remove.clicked()
+    assert(len(wdg.jobs) == 1)
+
+    qtbot.waitUntil(lambda: wdg.worker is None, timeout=60000)
+
+    assert(wdg.jobs[0]['status'] == _batch_widget.STATUS_DONE)
+    assert(wdg.jobs[0]['stats']['n_tiles'] == 2)
@@ -0,0 +1,143 @@
+import numpy as np
+
+import dask
+
+import tifffile
+import zarr
+
+from multiview_stitcher import sample_data
+
+from napari_stitcher import _cli
+
+import pytest
+
+
+def test_parse_timepoints():
+
+    assert(_cli.parse_timepoints('2:5') == slice(2, 5))
+    assert(_cli.parse_timepoints(':5') == slice(None, 5))
+    assert(_cli.parse_timepoints('3') == slice(3, 4))
+
+    args = _cli.get_parser().parse_args(
+        ['a.czi', 'b.czi', '--timepoints', '1:',
+         '--binning-xy', '2', '-j', '2'])
+    assert(args.paths == ['a.czi', 'b.czi'])
+    assert(args.timepoints == slice(1, None))
+    assert(args.binning_xy == 2 and args.n_jobs == 2)
+
+    with pytest.raises(SystemExit):
+        _cli.get_parser().parse_args(['a.czi', '--timepoints', 'a:b'])
+
+
+@pytest.mark.parametrize('output_format', ['zarr', 'tif'])
+def test_stitch_sims(output_format, tmp_path):
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=2,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=8)
+
+    channels = [str(ch) for ch in sims[0].coords['c'].values]
+
+    with pytest.raises(ValueError):
+        _cli.stitch_sims(sims, reg_channel='missing')
+
+    fused_sims = _cli.stitch_sims(
+        sims,
+        reg_channel=channels[1],
+        registration_binning={'z': 2, 'y': 2, 'x': 2},
+    )
+
+    assert(list(fused_sims.keys()) == channels)
+
+    path = str(tmp_path / ('fused' + _cli.OUTPUT_FORMATS[output_format]))
+    _cli.save_fused_sims(path, fused_sims, output_format=output_format)
+
+    fused = fused_sims[channels[0]].isel(c=0).transpose('t', 'y', 'x')
+
+    if output_format == 'zarr':
+        data = zarr.open_group(path, mode='r')['0'][:, 0]
+    else:
+        data = tifffile.imread(path)[:, 0]
+
+    assert(np.allclose(data, fused.data))
+
+
+def test_run_batch(tmp_path, monkeypatch):
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=8)
+
+    monkeypatch.setattr(
+        _cli._reader, 'read_mosaic_into_sims',
+        lambda path, scene_index=0: [sim.copy() for sim in sims])
+
+    jobs = [dict(path='mosaic%s.czi' %ijob,
+                 output_path=str(tmp_path / ('mosaic%s.ome.zarr' %ijob)),
+                 reg_channel=reg_channel)
+            for ijob, reg_channel in enumerate([None, None, 'missing'])]
+
+    # a budget smaller than a single job runs the jobs back to back
+    started = []
+    results = dict(_cli.run_batch(
+        jobs, n_threads=2, memory_budget=1, n_jobs_in_flight=2,
+        job_callback=started.append))
+
+    assert(sorted(results.keys()) == [0, 1, 2])
+    assert(sorted(started) == [0, 1, 2])
+
+    for ijob in [0, 1]:
+        assert(results[ijob]['n_tiles'] == 4)
+        assert(results[ijob]['tiles_per_s'] > 0)
+        assert(results[ijob]['gb_per_s'] > 0)
+        output = zarr.open_group(jobs[ijob]['output_path'], mode='r')
+        assert(output['0'].shape[:2] == (2, 1))
+
+    # outputs are only moved into place once complete
+    assert(not list(tmp_path.glob('*' + _cli.PARTIAL_SUFFIX)))
+
+    # failing jobs don't stop the batch
+    assert('error' in results[2])
+
+
+def test_stitch_file_timepoints(tmp_path, monkeypatch):
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=3, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=8)
+
+    monkeypatch.setattr(
+        _cli._reader, 'read_mosaic_into_sims',
+        lambda path, scene_index=0: [sim.copy() for sim in sims])
+
+    stitched_sims = []
+    stitch_sims = _cli.stitch_sims
+    def stitch_sims_recording(sims, **kwargs):
+        stitched_sims.extend(sims)
+        return stitch_sims(sims, **kwargs)
+    monkeypatch.setattr(_cli, 'stitch_sims', stitch_sims_recording)
+
+    output_path = str(tmp_path / 'mosaic.ome.zarr')
+    stats = _cli.stitch_file(
+        'mosaic.czi', output_path, timepoints=slice(1, None))
+
+    assert(stats['n_tiles'] == 2 * 2)
+
+    # the transforms are selected along with the timepoints
+    for sim, stitched_sim in zip(sims, stitched_sims):
+        assert(np.array_equal(stitched_sim.data, sim.data[1:]))
+        for affine in stitched_sim.attrs['transforms'].values():
+            assert(len(affine.coords['t']) == 2)
+
+    output = zarr.open_group(output_path, mode='r')
+    assert(output['0'].shape[0] == 2)
+
+
+def test_init_worker():
+
+    with dask.config.set(num_workers=None):
+        _cli.init_worker(3)
+        assert(dask.config.get('num_workers') == 3)
@@ -0,0 +1,293 @@
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import dask.array as da
+
+from spatial_image import to_spatial_image
+
+from multiview_stitcher import msi_utils
+
+from napari_stitcher import fusion_utils
+
+
+def test_multiscale_spatial_image_to_zarr():
+    """
+    All scales are written in a single computation, such that
+    each chunk of the highest resolution is computed only once.
+    """
+
+    computed_blocks = []
+
+    def count_block(x, block_info=None):
+        computed_blocks.append(block_info[0]['chunk-location'])
+        return x
+
+    data = da.ones((1, 1, 1100, 1100), dtype=np.uint16, chunks=(1, 1, 256, 256))
+    data = data.map_blocks(count_block, dtype=data.dtype)
+
+    sim = to_spatial_image(data, dims=['t', 'c', 'y', 'x'],
+                           scale={'y': 0.5, 'x': 0.5}, c_coords=['ch0'])
+
+    msim = msi_utils.get_msim_from_sim(sim, scale_factors=None)
+    scale_keys = msi_utils.get_sorted_scale_keys(msim)
+
+    assert(len(scale_keys) > 1)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        path = str(Path(tmpdir) / 'fused.zarr')
+        write = fusion_utils.multiscale_spatial_image_to_zarr(
+            msim, path, compute=False)
+
+        assert(not len(computed_blocks))
+
+        write.compute()
+
+        assert(len(computed_blocks) == data.npartitions)
+
+        msim_read = msi_utils.multiscale_spatial_image_from_zarr(path)
+
+        assert(msi_utils.get_sorted_scale_keys(msim_read) == scale_keys)
+        for scale_key in scale_keys:
+            assert(msim_read[scale_key]['image'].shape ==
+                   msim[scale_key]['image'].shape)
+            assert(np.allclose(msim_read[scale_key]['image'].data, 1))
+
+
+def test_get_fusion_key():
+
+    from multiview_stitcher import param_utils, spatial_image_utils
+    import xarray as xr
+
+    def get_sim(offset):
+        sim = to_spatial_image(
+            np.zeros((2, 10, 10), dtype=np.uint8), dims=['t', 'y', 'x'])
+        spatial_image_utils.set_sim_affine(
+            sim,
+            xr.DataArray(
+                np.stack([param_utils.affine_from_translation([offset, 0])] * 2),
+                dims=['t', 'x_in', 'x_out']),
+            transform_key='affine_registered')
+        return sim
+
+    key = fusion_utils.get_fusion_key(
+        [get_sim(0), get_sim(5)], ['a', 'b'], 'affine_registered', 'ch0')
+
+    assert(key == fusion_utils.get_fusion_key(
+        [get_sim(0), get_sim(5)], ['a', 'b'], 'affine_registered', 'ch0'))
+
+    # changed transform parameters, tiles or channel
+    for other_key in [
+        fusion_utils.get_fusion_key(
+            [get_sim(0), get_sim(6)], ['a', 'b'], 'affine_registered', 'ch0'),
+        fusion_utils.get_fusion_key(
+            [get_sim(0), get_sim(5)], ['a', 'c'], 'affine_registered', 'ch0'),
+        fusion_utils.get_fusion_key(
+            [get_sim(0), get_sim(5)], ['a', 'b'], 'affine_registered', 'ch1'),
+    ]:
+        assert(key != other_key)
+
+
+def test_evict_fusion_cache(tmp_path):
+
+    import os
+    import time
+
+    paths = []
+    for ientry in range(3):
+        path = fusion_utils.get_fusion_cache_path(str(ientry), str(tmp_path))
+        os.makedirs(path)
+        with open(os.path.join(path, '.zmetadata'), 'wb') as f:
+            f.write(b'0' * 100)
+        os.utime(path, (time.time() - 10 + ientry,) * 2)
+        paths.append(path)
+
+    # mark the oldest entry as recently used
+    assert(fusion_utils.get_cached_fusion_path('0', str(tmp_path)) == paths[0])
+
+    fusion_utils.evict_fusion_cache(str(tmp_path), max_size=250)
+
+    assert([os.path.exists(path) for path in paths] == [True, False, True])
+    assert(fusion_utils.get_cached_fusion_path('1', str(tmp_path)) is None)
+
+    # partial results count towards the cache size and
+    # are removed once they haven't been written to for a while
+    partial_paths = []
+    for age in [2 * fusion_utils.FUSION_PARTIAL_GRACE_PERIOD, 0]:
+        path = fusion_utils.get_fusion_cache_path(
+            'partial%s' %age, str(tmp_path)) + '.partial'
+        os.makedirs(os.path.join(path, '0'))
+        chunk_path = os.path.join(path, '0', '0.0')
+        with open(chunk_path, 'wb') as f:
+            f.write(b'0' * 100)
+        for p in [chunk_path, os.path.join(path, '0'), path]:
+            os.utime(p, (time.time() - age,) * 2)
+        partial_paths.append(path)
+
+    fusion_utils.evict_fusion_cache(str(tmp_path), max_size=250)
+
+    assert([os.path.exists(path) for path in partial_paths] == [False, True])
+    assert([os.path.exists(path) for path in paths] == [True, False, False])
+
+
+def test_incremental_fusion(tmp_path):
+    """
+    Updating a fusion result after changing the transform parameters of a
+    tile gives the same result as fusing from scratch, rewriting only the
+    chunks touched by the tile.
+    """
+
+    import xarray as xr
+
+    from multiview_stitcher import fusion, param_utils, spatial_image_utils
+    from napari_stitcher import _sample_data
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=1,
+        tile_size=100, tiles_x=3, tiles_y=1, tiles_z=1,
+        overlap=10, dtype=np.uint8)
+
+    sims = [spatial_image_utils.sim_sel_coords(sim, {'c': sim.coords['c'][0]})
+            for sim in sims]
+
+    def fuse(sims, transform_key):
+        fused = fusion.fuse(sims, transform_key=transform_key, output_chunksize=32)
+        fused = fused.expand_dims({'c': ['ch0']})
+        return msi_utils.get_msim_from_sim(fused, scale_factors=[{'y': 2, 'x': 2}])
+
+    tile_ids = [str(i) for i in range(len(sims))]
+
+    # previous fusion
+    mfused = fuse(sims, 'affine_metadata')
+    previous_record = fusion_utils.get_fusion_record(
+        sims, tile_ids, 'affine_metadata', 'ch0', msi_utils.get_sim_from_msim(mfused))
+    previous_path = str(tmp_path / 'previous.zarr')
+    fusion_utils.multiscale_spatial_image_to_zarr(mfused, previous_path)
+    previous_record['path'] = previous_path
+
+    # nudge the middle tile without changing the output stack
+    for isim, sim in enumerate(sims):
+        affine = spatial_image_utils.get_affine_from_sim(sim, 'affine_metadata')
+        if isim == 1:
+            affine = param_utils.rebase_affine(
+                xr.DataArray(param_utils.affine_from_translation([0., 2.]),
+                             dims=['x_in', 'x_out']),
+                affine)
+        spatial_image_utils.set_sim_affine(sim, affine, transform_key='affine_nudged')
+
+    mfused = fuse(sims, 'affine_nudged')
+    record = fusion_utils.get_fusion_record(
+        sims, tile_ids, 'affine_nudged', 'ch0', msi_utils.get_sim_from_msim(mfused))
+
+    boxes = fusion_utils.get_incremental_fusion_boxes(
+        previous_record, record, max_fraction=1.)
+    assert(boxes is not None)
+
+    regions = fusion_utils.get_regions_touched_by_boxes(
+        msi_utils.get_sim_from_msim(mfused), boxes)
+    assert(0 < len(regions) < msi_utils.get_sim_from_msim(mfused).data.npartitions)
+
+    previous_data = msi_utils.get_sim_from_msim(
+        msi_utils.multiscale_spatial_image_from_zarr(previous_path)).values
+
+    # update a copy sharing the files of unchanged chunks
+    path = str(tmp_path / 'updated.zarr')
+    fusion_utils.link_zarr_store(previous_path, path)
+    fusion_utils.update_multiscale_spatial_image_zarr(mfused, path, boxes)
+
+    msim_read = msi_utils.multiscale_spatial_image_from_zarr(path)
+    for scale_key in msi_utils.get_sorted_scale_keys(mfused):
+        assert(np.allclose(msim_read[scale_key]['image'].values,
+                           mfused[scale_key]['image'].values))
+
+    # the previous result remains untouched
+    assert(np.array_equal(msi_utils.get_sim_from_msim(
+        msi_utils.multiscale_spatial_image_from_zarr(previous_path)).values,
+        previous_data))
+
+    chunk_paths = [os.path.join(root, f)
+                   for root, _, files in os.walk(previous_path) for f in files
+                   if f[0].isdigit()]
+    n_shared = sum(os.path.samefile(
+                       chunk_path, chunk_path.replace(previous_path, path))
+                   for chunk_path in chunk_paths)
+    assert(0 < n_shared < len(chunk_paths))
+
+    # a changed set of tiles requires a full fusion
+    record['base_key'] = 'other'
+    assert(fusion_utils.get_incremental_fusion_boxes(previous_record, record) is None)
+
+
+def test_stream_fusion_to_zarr(tmp_path):
+
+    from multiview_stitcher import fusion, spatial_image_utils
+    from napari_stitcher import _sample_data
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=4, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=5, drift_scale=2., shift_scale=2., dtype=np.uint8)
+
+    sims = [spatial_image_utils.sim_sel_coords(sim, {'c': sim.coords['c'][0]})
+            for sim in sims]
+
+    path = str(tmp_path / 'fused.zarr')
+
+    # interrupt the fusion after the first batch
+    for time_indices in fusion_utils.stream_fusion_to_zarr(
+            sims, 'affine_metadata', path, timepoint_batch_size=2):
+        break
+
+    assert(time_indices == [0, 1])
+    assert(not os.path.exists(os.path.join(path, '.zmetadata')))
+
+    # resuming starts with the timepoints written previously
+    written = list(fusion_utils.stream_fusion_to_zarr(
+        sims, 'affine_metadata', path, timepoint_batch_size=2))
+    assert(written == [[0, 1], [2, 3]])
+
+    fused = fusion.fuse(sims, transform_key='affine_metadata')
+    msim = msi_utils.multiscale_spatial_image_from_zarr(path)
+    assert(np.allclose(msim['scale0/image'].sel(c=sims[0].coords['c'].values).values,
+                       fused.values))
+
+
+def test_fusion_on_distributed_client(tmp_path):
+
+    import pytest
+    pytest.importorskip('distributed')
+
+    from multiview_stitcher import fusion, spatial_image_utils
+    from napari_stitcher import _sample_data, _utils
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=5, dtype=np.uint8)
+
+    sims = [spatial_image_utils.sim_sel_coords(sim, {'c': sim.coords['c'][0]})
+            for sim in sims]
+
+    fused = fusion.fuse(sims, transform_key='affine_metadata')
+    mfused = msi_utils.get_msim_from_sim(fused, scale_factors=None)
+
+    with _utils.get_client(n_workers=2, processes=False) as client:
+
+        # writes are computed on the cluster
+        paths = [str(tmp_path / ('fused%s.zarr' %i)) for i in range(2)]
+        writes = [fusion_utils.multiscale_spatial_image_to_zarr(
+                      mfused, path, compute=False) for path in paths]
+        assert(sorted(_utils.compute_yielding(writes, scheduler=client))
+               == [0, 1])
+
+        streamed_path = str(tmp_path / 'streamed.zarr')
+        assert(list(fusion_utils.stream_fusion_to_zarr(
+            sims, 'affine_metadata', streamed_path,
+            timepoint_batch_size=2, scheduler=client)) == [[0, 1]])
+
+    for path in paths + [streamed_path]:
+        msim = msi_utils.multiscale_spatial_image_from_zarr(path)
+        assert(np.allclose(msim['scale0/image'].squeeze().values,
+                           fused.squeeze().values))
@@ -1,3 +1,4 @@
+import pytest
 from pathlib import Path
 
 from napari_stitcher import napari_get_reader, _reader
@@ -37,3 +38,29 @@ def test_reader():
 
     # make sure it's the same as it started
     # np.testing.assert_allclose(original_data, layer_data_tuple[0])
+
+
+def test_get_reader_for_list_of_paths():
+
+    assert callable(napari_get_reader(['a.czi', 'b.czi']))
+    assert napari_get_reader(['a.czi', 'b.tif']) is None
+
+
+def test_get_scene_indices():
+
+    assert _reader.get_scene_indices(None, 3) == [0, 1, 2]
+    assert _reader.get_scene_indices(1, 3) == [1]
+    assert _reader.get_scene_indices([0, 2], 3) == [0, 2]
+
+    with pytest.raises(ValueError):
+        _reader.get_scene_indices(3, 3)
+
+
+def test_get_source_names():
+
+    assert _reader.get_source_names(['a/x.czi', 'b/y.czi']) == ['x', 'y']
+    assert _reader.get_source_names(['a/x.czi', 'b/x.czi']) == ['a_x', 'b_x']
+
+    names = _reader.get_source_names(['a/c/x.czi', 'b/c/x.czi', 'y.czi'])
+    assert names[0].startswith('c_x_') and names[1].startswith('c_x_')
+    assert names[0] != names[1] and names[2] == 'y'
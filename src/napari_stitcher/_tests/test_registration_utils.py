@@ -0,0 +1,457 @@
+import os
+import numpy as np
+
+from multiview_stitcher import msi_utils, sample_data
+from multiview_stitcher.io import METADATA_TRANSFORM_KEY
+
+from napari_stitcher import registration_utils
+
+import pytest
+
+
+@pytest.mark.parametrize("ndim", [2, 3])
+def test_coarse_to_fine_registration(ndim):
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=ndim, N_t=1, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=8, zoom=6, dtype=np.uint8)
+
+    msims = [msi_utils.get_msim_from_sim(
+                sim.sel(c=sim.coords['c'][0]), scale_factors=[])
+             for sim in sims]
+
+    pairs = []
+    params = registration_utils.register(
+        msims,
+        transform_key=METADATA_TRANSFORM_KEY,
+        n_pyramid_levels=2,
+        pair_callback=lambda pair, n_pairs: pairs.append((pair, n_pairs)),
+        )
+
+    params_reference = registration_utils.register(
+        msims,
+        transform_key=METADATA_TRANSFORM_KEY,
+        registration_binning={dim: 1 for dim in 'zyx'[-ndim:]},
+        )
+
+    # one pair registered per pyramid level
+    assert(pairs == [((0, 1), 2), ((0, 1), 2)])
+
+    assert(len(params) == len(msims))
+    for p, p_ref in zip(params, params_reference):
+        assert(np.allclose(p, p_ref, atol=1.5))
+
+
+def test_get_pyramid_binnings():
+
+    binnings = registration_utils.get_pyramid_binnings(
+        {'z': 1, 'y': 2, 'x': 2}, ['z', 'y', 'x'], 3)
+
+    assert(binnings == [
+        {'z': 4, 'y': 8, 'x': 8},
+        {'z': 2, 'y': 4, 'x': 4},
+        {'z': 1, 'y': 2, 'x': 2},
+    ])
+
+
+def test_pyramid_levels_use_optimal_binning_and_scales(monkeypatch):
+    """
+    Without registration binning, the finest pyramid level uses the
+    binning multiview-stitcher considers optimal, and levels are read
+    from the coarser scales of the views.
+    """
+
+    import dask.array as da
+    from spatial_image import to_spatial_image
+    from multiview_stitcher import param_utils
+
+    # large lazy tiles overlapping by half, such that
+    # the optimal registration binning is larger than one
+    sims = [to_spatial_image(
+                da.zeros((1, 12000, 12000), dtype=np.uint8, chunks=4000),
+                dims=['t', 'y', 'x'],
+                translation={'y': 0., 'x': x_origin},
+                ) for x_origin in [0., 6000.]]
+
+    for sim in sims:
+        sim.attrs['transforms'] = {METADATA_TRANSFORM_KEY:
+            param_utils.identity_transform(2, t_coords=sim.coords['t'].values)}
+
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[2])
+             for sim in sims]
+
+    levels = []
+    def compute_params_from_pairs(msims, g_reg, pairs, **kwargs):
+        levels.append((
+            msi_utils.get_sim_from_msim(msims[0]).shape[-2:],
+            kwargs['registration_binning']))
+        return [param_utils.identity_transform(2, t_coords=[0])
+                for _ in msims]
+
+    monkeypatch.setattr(registration_utils, 'compute_params_from_pairs',
+                        compute_params_from_pairs)
+
+    g_reg, pairs = registration_utils.get_registration_graph(
+        msims, transform_key=METADATA_TRANSFORM_KEY)
+
+    optimal_binning = registration_utils.get_optimal_registration_binning(
+        msims, pairs, METADATA_TRANSFORM_KEY)
+    assert(optimal_binning == {'y': 2, 'x': 2})
+
+    registration_utils.register_pairs(
+        msims, g_reg, pairs,
+        transform_key=METADATA_TRANSFORM_KEY,
+        n_pyramid_levels=2,
+        )
+
+    # both levels are read from the downsampled scale
+    assert(levels == [
+        ((6000, 6000), {'y': 2, 'x': 2}),
+        ((6000, 6000), {'y': 1, 'x': 1}),
+    ])
+
+
+def test_register_with_cache(tmp_path, monkeypatch):
+
+    from multiview_stitcher import registration
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=1,
+        tile_size=30, tiles_x=3, tiles_y=1, tiles_z=1,
+        overlap=8, zoom=6, dtype=np.uint8)
+
+    msims = [msi_utils.get_msim_from_sim(
+                sim.sel(c=sim.coords['c'][0]), scale_factors=[])
+             for sim in sims]
+
+    tile_ids = ['tile%s' %i for i in range(len(msims))]
+
+    params = registration_utils.register(
+        msims,
+        transform_key=METADATA_TRANSFORM_KEY,
+        tile_ids=tile_ids,
+        cache_dir=str(tmp_path),
+        )
+
+    # one entry per pair and timepoint
+    assert(len(list(tmp_path.glob('*.json'))) == 2 * 2)
+
+    # registering again only reads from the cache
+    registered_pairs = []
+    register_pair = registration.register_pair_of_msims_over_time
+    def register_pair_counting(*args, **kwargs):
+        registered_pairs.append(args)
+        return register_pair(*args, **kwargs)
+    monkeypatch.setattr(
+        registration, 'register_pair_of_msims_over_time', register_pair_counting)
+
+    pairs = []
+    params_cached = registration_utils.register(
+        msims,
+        transform_key=METADATA_TRANSFORM_KEY,
+        tile_ids=tile_ids,
+        cache_dir=str(tmp_path),
+        pair_callback=lambda pair, n_pairs: pairs.append(pair),
+        )
+
+    assert(not len(registered_pairs))
+    assert(sorted(pairs) == [(0, 1), (1, 2)])
+    for p, p_cached in zip(params, params_cached):
+        assert(np.allclose(p, p_cached))
+
+    # changing the settings invalidates the cached results
+    registration_utils.register(
+        msims,
+        transform_key=METADATA_TRANSFORM_KEY,
+        registration_binning={'y': 2, 'x': 2},
+        tile_ids=tile_ids,
+        cache_dir=str(tmp_path),
+        )
+
+    assert(len(registered_pairs) == 2)
+
+
+def test_register_cache_is_bounded(tmp_path, monkeypatch):
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=1,
+        tile_size=30, tiles_x=3, tiles_y=1, tiles_z=1,
+        overlap=8, zoom=6, dtype=np.uint8)
+
+    msims = [msi_utils.get_msim_from_sim(
+                sim.sel(c=sim.coords['c'][0]), scale_factors=[])
+             for sim in sims]
+
+    # stale and recent leftovers of interrupted writes
+    stale_partial = tmp_path / 'stale.json.123.partial'
+    recent_partial = tmp_path / 'recent.json.123.partial'
+    stale_partial.write_text('')
+    recent_partial.write_text('')
+    os.utime(stale_partial, (0, 0))
+
+    monkeypatch.setenv(registration_utils.REGISTRATION_CACHE_SIZE_ENV, '3')
+
+    registration_utils.register(
+        msims,
+        transform_key=METADATA_TRANSFORM_KEY,
+        tile_ids=['tile%s' %i for i in range(len(msims))],
+        cache_dir=str(tmp_path),
+        )
+
+    assert(len(list(tmp_path.glob('*.json'))) == 3)
+    assert(not stale_partial.exists())
+    assert(recent_partial.exists())
+
+    # least recently used entries are evicted first
+    paths = sorted(tmp_path.glob('*.json'))
+    for i, path in enumerate(paths):
+        os.utime(path, (i, i))
+    assert(registration_utils.load_pair_registration(
+        paths[0].name[:-len('.json')], str(tmp_path)) is not None)
+
+    registration_utils.evict_registration_cache(str(tmp_path), max_entries=2)
+
+    assert([path.exists() for path in paths] == [True, False, True])
+
+
+def test_register_reloaded_layers_with_cache(tmp_path, monkeypatch):
+    """
+    In-memory layers reloaded with an additional timepoint keep their
+    tile ids for unchanged timepoints, such that only the new timepoint
+    is registered.
+    """
+
+    from napari.components import ViewerModel
+    from napari.layers import Image
+    from multiview_stitcher import registration
+
+    from napari_stitcher import _utils, viewer_utils
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=3, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=8, zoom=6, dtype=np.uint8)
+
+    viewer = ViewerModel()
+    viewer.dims.ndim = 3
+    viewer.dims.axis_labels = ['t', 'y', 'x']
+
+    def load(n_t):
+        layers = [Image(np.asarray(sim.isel(c=0, t=slice(0, n_t))),
+                        name='tile%s' %isim, translate=[0, 0, 22 * isim])
+                  for isim, sim in enumerate(sims)]
+        msims = [viewer_utils.image_layer_to_msim(l, viewer) for l in layers]
+        tile_ids = [_utils.get_tile_id(l, msi_utils.get_sim_from_msim(msim))
+                    for l, msim in zip(layers, msims)]
+        return msims, tile_ids
+
+    msims, tile_ids = load(2)
+    registration_utils.register(
+        msims, transform_key=METADATA_TRANSFORM_KEY,
+        tile_ids=tile_ids, cache_dir=str(tmp_path))
+
+    registered_ts = []
+    register_pair = registration.register_pair_of_msims_over_time
+    def register_pair_counting(msim1, msim2, **kwargs):
+        registered_ts.extend(
+            msi_utils.get_sim_from_msim(msim1).coords['t'].values)
+        return register_pair(msim1, msim2, **kwargs)
+    monkeypatch.setattr(
+        registration, 'register_pair_of_msims_over_time', register_pair_counting)
+
+    msims_reloaded, tile_ids_reloaded = load(3)
+
+    for tile_id, tile_id_reloaded in zip(tile_ids, tile_ids_reloaded):
+        assert(all(tile_id_reloaded[t] == tile_id[t] for t in tile_id))
+
+    registration_utils.register(
+        msims_reloaded, transform_key=METADATA_TRANSFORM_KEY,
+        tile_ids=tile_ids_reloaded, cache_dir=str(tmp_path))
+
+    assert(registered_ts == [2])
+
+
+def test_register_anchored_to_previous_params():
+
+    from multiview_stitcher import param_utils
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=1,
+        tile_size=30, tiles_x=3, tiles_y=1, tiles_z=1,
+        overlap=8, zoom=6, dtype=np.uint8)
+
+    msims = [msi_utils.get_msim_from_sim(
+                sim.sel(c=sim.coords['c'][0]), scale_factors=[])
+             for sim in sims]
+
+    params = registration_utils.register(
+        msims, transform_key=METADATA_TRANSFORM_KEY)
+
+    # previous solution for the first two views, differing
+    # from the new one by a global shift
+    shift = param_utils.affine_from_translation([5., -3.])
+    def shifted(p):
+        p = p.transpose('t', 'x_in', 'x_out')
+        return p.copy(data=shift @ p.values)
+
+    previous_params = [shifted(p) for p in params[:2]] + [None]
+
+    params_anchored = registration_utils.register(
+        msims,
+        transform_key=METADATA_TRANSFORM_KEY,
+        previous_params=previous_params,
+        )
+
+    for p, p_anchored in zip(params, params_anchored):
+        assert(np.allclose(shifted(p), p_anchored.transpose('t', 'x_in', 'x_out')))
+
+
+def test_get_anchoring_affine():
+
+    from multiview_stitcher import param_utils
+
+    rng = np.random.default_rng(0)
+    P = [param_utils.affine_from_translation(rng.uniform(-50, 50, 2))
+         for _ in range(3)]
+
+    angle = np.pi / 6
+    rigid = np.array([[np.cos(angle), -np.sin(angle), 4.],
+                      [np.sin(angle), np.cos(angle), -2.],
+                      [0., 0., 1.]])
+
+    # previous parameters differing by a rigid transformation
+    Q = [rigid @ p for p in P]
+    for transform_type in ['rigid', 'affine']:
+        assert(np.allclose(
+            registration_utils.get_anchoring_affine(P, Q, transform_type),
+            rigid))
+
+    # sheared previous parameters don't add shear to rigid anchors
+    shear = np.array([[1., .2, 0.], [0., 1.1, 0.], [0., 0., 1.]])
+    Q = [shear @ rigid @ p for p in P]
+
+    anchor = registration_utils.get_anchoring_affine(P, Q, 'rigid')
+    assert(np.allclose(anchor[:2, :2] @ anchor[:2, :2].T, np.eye(2)))
+    assert(np.isclose(np.linalg.det(anchor[:2, :2]), 1))
+
+    anchor = registration_utils.get_anchoring_affine(P, Q, 'translation')
+    assert(np.allclose(anchor[:2, :2], np.eye(2)))
+    assert(np.allclose(anchor[:2, 2], np.mean(
+        [q[:2, 2] - p[:2, 2] for p, q in zip(P, Q)], axis=0)))
+
+    with pytest.raises(ValueError):
+        registration_utils.get_anchoring_affine(P, Q, 'unknown')
+
+
+def test_register_timepoints():
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=3, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=8, zoom=6, dtype=np.uint8, drift_scale=2.)
+
+    msims = [msi_utils.get_msim_from_sim(
+                sim.sel(c=sim.coords['c'][0]), scale_factors=[])
+             for sim in sims]
+
+    params = registration_utils.register(
+        msims, transform_key=METADATA_TRANSFORM_KEY)
+
+    results = list(registration_utils.register_timepoints(
+        msims, transform_key=METADATA_TRANSFORM_KEY, n_workers=2))
+
+    # each timepoint is yielded once
+    assert(sorted(t for t, _ in results) == list(sims[0].coords['t'].values))
+
+    for t, params_t in results:
+        assert(len(params_t) == len(msims))
+        for p, p_t in zip(params, params_t):
+            assert(np.allclose(p.sel(t=t), p_t.sel(t=t)))
+
+
+def test_register_timepoints_warm_start():
+
+    import dask.array as da
+
+    # the ground truth image of the sample data is random
+    da.random.seed(0)
+
+    # tiles large enough to be registered at a coarse pyramid level
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=3, N_c=1,
+        tile_size=100, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=30, zoom=6, dtype=np.uint8, drift_scale=2., shift_scale=2.)
+
+    msims = [msi_utils.get_msim_from_sim(
+                sim.sel(c=sim.coords['c'][0]), scale_factors=[])
+             for sim in sims]
+
+    params = registration_utils.register(
+        msims, transform_key=METADATA_TRANSFORM_KEY)
+
+    results = list(registration_utils.register_timepoints_warm_start(
+        msims, transform_key=METADATA_TRANSFORM_KEY))
+
+    assert([t for t, _, _ in results] == list(sims[0].coords['t'].values))
+
+    # the first timepoint is registered from scratch
+    assert([warm_started for _, _, warm_started in results] == [False, True, True])
+
+    for t, params_t, _ in results:
+        for p, p_t in zip(params, params_t):
+            assert(np.allclose(p.sel(t=t), p_t.sel(t=t), atol=1.5))
+
+    # fall back to registering from scratch
+    results = list(registration_utils.register_timepoints_warm_start(
+        msims, transform_key=METADATA_TRANSFORM_KEY, min_quality_ratio=2.))
+
+    assert(not any(warm_started for _, _, warm_started in results))
+
+
+def test_register_on_distributed_client(tmp_path):
+    """
+    Registration on process workers: the progress callback holds a lock
+    (which can't be sent to workers) and is called by the calling process,
+    which also writes the registration cache.
+    """
+
+    pytest.importorskip('distributed')
+
+    import os, threading
+    from napari_stitcher import _utils
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=1,
+        tile_size=30, tiles_x=3, tiles_y=1, tiles_z=1,
+        overlap=8, zoom=6, dtype=np.uint8)
+
+    msims = [msi_utils.get_msim_from_sim(
+                sim.sel(c=sim.coords['c'][0]), scale_factors=[])
+             for sim in sims]
+
+    params = registration_utils.register(
+        msims, transform_key=METADATA_TRANSFORM_KEY)
+
+    lock = threading.Lock()
+    reported = []
+    def pair_callback(pair, n_pairs):
+        with lock:
+            reported.append((pair, os.getpid()))
+
+    with _utils.get_client(n_workers=2, processes=True) as client:
+        params_client = registration_utils.register(
+            msims,
+            transform_key=METADATA_TRANSFORM_KEY,
+            pair_callback=pair_callback,
+            tile_ids=['tile%s' %i for i in range(len(msims))],
+            cache_dir=str(tmp_path),
+            scheduler=client,
+            )
+
+    assert(sorted(pair for pair, _ in reported) == [(0, 1), (1, 2)])
+    assert(all(pid == os.getpid() for _, pid in reported))
+    assert(len(list(tmp_path.glob('*.json'))) == 2 * 2)
+
+    for p, p_client in zip(params, params_client):
+        assert(np.allclose(p, p_client))
@@ -16,4 +16,254 @@ def test_create_image_layer_tuples_from_msims():
     msims = [msi_utils.get_msim_from_sim(sim) for sim in sims]
 
     lds = viewer_utils.create_image_layer_tuples_from_msims(msims)
-    
\ No newline at end of file
+    
+
+def test_get_layer_affines_from_params():
+
+    affine = np.array([[1, 0, 5], [0, 1, 3], [0, 0, 1.]])
+    params = np.stack([affine] * 4)
+
+    # layer with time dimension
+    layer_affines = viewer_utils.get_layer_affines_from_params(params, 3)
+    assert(layer_affines.shape == (4, 4, 4))
+    assert(np.allclose(layer_affines[2][1:, 1:], affine))
+    assert(np.allclose(layer_affines[2][0], [1, 0, 0, 0]))
+
+    # layer with fewer dimensions
+    layer_affines = viewer_utils.get_layer_affines_from_params(affine, 1)
+    assert(np.allclose(layer_affines, [[1, 3], [0, 1]]))
+
+
+def test_viewer_transformation_manager():
+
+    from napari.components import ViewerModel
+
+    viewer = ViewerModel()
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=3, N_c=1,
+        tile_size=15, tiles_x=2, tiles_y=1, tiles_z=1,
+        drift_scale=2., shift_scale=2.)
+
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims]
+
+    lds = viewer_utils.create_image_layer_tuples_from_msims(
+        msims, positional_cmaps=False, transform_key=METADATA_TRANSFORM_KEY)
+
+    # adding layers several times creates a single manager
+    n_callbacks = len(viewer.dims.events.current_step.callbacks)
+    for ld in lds:
+        viewer_utils.add_image_layer_tuples_to_viewer(viewer, [ld])
+
+    manager = viewer_utils.get_viewer_transformation_manager(viewer)
+    assert(len(viewer.dims.events.current_step.callbacks) == n_callbacks + 1)
+    assert(len(manager.layer_affines) == len(lds))
+
+    # scroll in time
+    current_step = list(viewer.dims.current_step)
+    current_step[0] = 2
+    viewer.dims.current_step = tuple(current_step)
+
+    for l in viewer.layers:
+        p = np.array(l.metadata['full_affine_transform'].isel(t=2))
+        assert(np.allclose(l.affine.affine_matrix[-3:, -3:], p))
+
+    # transforms are set in a single batch, updating
+    # the extent of the viewer once for all layers
+    extent_updates = []
+    for l in viewer.layers:
+        l.affine.affine_matrix = np.eye(l.ndim + 1)
+        l.events._extent_augmented.connect(extent_updates.append)
+
+    manager.update(force=True)
+
+    for l in viewer.layers:
+        p = np.array(l.metadata['full_affine_transform'].isel(t=2))
+        assert(np.allclose(l.affine.affine_matrix[-3:, -3:], p))
+    assert(len(extent_updates) == 1)
+
+    viewer.layers.pop(0)
+    assert(len(manager.layer_affines) == len(lds) - 1)
+
+    # inserting a layer only sets the transform of that layer
+    refreshed = []
+    for l in viewer.layers:
+        l.refresh = lambda *args, l=l, **kwargs: refreshed.append(l)
+    viewer_utils.add_image_layer_tuples_to_viewer(viewer, [lds[0]])
+    assert(not refreshed)
+    assert(np.allclose(
+        viewer.layers[-1].affine.affine_matrix[-3:, -3:],
+        np.array(viewer.layers[-1].metadata['full_affine_transform'].isel(t=2))))
+
+    # the manager doesn't keep the viewer alive
+    import gc, weakref
+    viewer_ref = weakref.ref(viewer)
+    del viewer, manager, l
+    gc.collect()
+    assert(viewer_ref() is None)
+
+
+def test_get_contrast_limits_from_msims(monkeypatch):
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=2,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1)
+
+    sims = [sim.chunk({'y': 10, 'x': 10}) for sim in sims]
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims]
+
+    contrast_limits = viewer_utils.get_contrast_limits_from_msims(msims)
+
+    assert(len(contrast_limits) == len(msims))
+    for sim, msim_limits in zip(sims, contrast_limits):
+        assert(len(msim_limits) == 2)
+        for ch, ch_sim in zip(sim.coords['c'].values, sim.transpose('c', ...)):
+            assert(np.allclose(msim_limits[str(ch)],
+                               [ch_sim.min(), ch_sim.max()]))
+
+    # sampled limits lie within the full limits
+    sampled_limits = viewer_utils.get_contrast_limits_from_msims(
+        msims, n_sample_chunks=2, percentiles=(1, 99), cache_key='sampled')
+    for msim_limits, msim_sampled_limits in zip(contrast_limits, sampled_limits):
+        for ch, (lo, hi) in msim_sampled_limits.items():
+            assert(msim_limits[ch][0] <= lo <= hi <= msim_limits[ch][1])
+
+    # cached results are reused
+    assert(viewer_utils.get_contrast_limits_from_msims(
+        msims, n_sample_chunks=2, percentiles=(1, 99), cache_key='sampled')
+        is sampled_limits)
+
+    # the least recently used results are dropped from the cache
+    monkeypatch.setattr(viewer_utils, 'CONTRAST_LIMITS_CACHE_SIZE', 2)
+    for cache_key in ['other', 'sampled', 'new']:
+        viewer_utils.get_contrast_limits_from_msims(
+            msims, n_sample_chunks=2, percentiles=(1, 99),
+            cache_key=cache_key)
+    assert(len(viewer_utils._contrast_limits_cache) == 2)
+    assert(viewer_utils.get_contrast_limits_from_msims(
+        msims, n_sample_chunks=2, percentiles=(1, 99), cache_key='sampled')
+        is sampled_limits)
+
+    # layers are created using per channel limits
+    lds = viewer_utils.create_image_layer_tuples_from_msims(
+        msims, positional_cmaps=False)
+    assert(len(lds) == 4)
+    assert(lds[0][1]['contrast_limits'] == contrast_limits[0][str(sims[0].coords['c'].values[0])])
+
+
+def test_get_cmaps_from_sims():
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=1,
+        tile_size=15, tiles_x=3, tiles_y=2, tiles_z=1,
+        shift_scale=1.)
+
+    sims = [sim.squeeze(drop=True) for sim in sims]
+
+    cmaps = viewer_utils.get_cmaps_from_sims(
+        sims, transform_key=METADATA_TRANSFORM_KEY)
+
+    # checkerboard pattern: tiles are ordered by y, then x
+    assert([cmaps[iview] for iview in range(len(sims))]
+           == ['red', 'green', 'red', 'green', 'red', 'green'])
+
+
+def test_get_positional_color_indices():
+
+    # jittered grid of 30 x 40 tiles
+    grid = np.stack(np.meshgrid(
+        np.arange(30), np.arange(40), indexing='ij'), -1).reshape(-1, 2)
+    rng = np.random.default_rng(0)
+    centers = grid * 90. + rng.uniform(-5, 5, grid.shape)
+    extents = np.ones_like(centers) * 100.
+
+    color_indices = viewer_utils.get_positional_color_indices(
+        centers, extents, n_colors=2)
+
+    assert(np.all(color_indices == grid.sum(axis=1) % 2))
+
+
+def test_get_msim_from_sim_preserving_chunks():
+
+    sim = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=2,
+        tile_size=1100, tiles_x=1, tiles_y=1, tiles_z=1)[0]
+
+    # one chunk per plane, as obtained from subblocks
+    sim = sim.chunk({'t': 1, 'c': 1, 'y': 1100, 'x': 1100})
+
+    msim = viewer_utils.get_msim_from_sim_preserving_chunks(sim)
+
+    scale_keys = msi_utils.get_sorted_scale_keys(msim)
+    assert(len(scale_keys) > 1)
+
+    for sk in scale_keys:
+        data = msim[sk]['image'].data
+        assert(data.numblocks == (2, 2, 1, 1))
+        assert('affine_metadata' in msim[sk].data_vars)
+
+
+def test_image_layer_to_msim():
+
+    from napari.components import ViewerModel
+    from napari.layers import Image
+
+    viewer = ViewerModel()
+
+    data = np.random.default_rng(0).integers(0, 100, (1200, 1000), dtype=np.uint16)
+
+    # single scale layer is downsampled lazily
+    l = Image(data, scale=[2, 3], translate=[10, 20])
+    msim = viewer_utils.image_layer_to_msim(l, viewer)
+
+    scale_keys = msi_utils.get_sorted_scale_keys(msim)
+    assert(len(scale_keys) > 1)
+    sim = msim['scale0/image']
+    assert(sim.dims == ('t', 'y', 'x'))
+    assert(np.allclose(sim.data[0].compute(), data))
+    assert(float(sim.coords['y'][0]) == 10 and float(sim.coords['x'][1]) == 23)
+
+    # multiscale layer with numpy data
+    l = Image([data, data[::2, ::2]], scale=[2, 3], multiscale=True)
+    msim = viewer_utils.image_layer_to_msim(l, viewer)
+
+    sim1 = msim['scale1/image']
+    assert(sim1.shape == (1, 600, 500))
+    assert(np.allclose(
+        [float(sim1.coords['y'][1] - sim1.coords['y'][0]),
+         float(sim1.coords['x'][1] - sim1.coords['x'][0])],
+        [4, 6]))
+    assert('affine_metadata' in msim['scale1'].data_vars)
+
+
+def test_get_layer_data_chunks():
+
+    # equally sized chunks which are multiples of the binning
+    chunks = viewer_utils.get_layer_data_chunks(
+        (3, 2100, 1000), ['t', 'y', 'x'], registration_binning={'y': 4, 'x': 3})
+    assert(chunks == (1, 1052, 1000))
+
+    # multiples of the storage chunks
+    chunks = viewer_utils.get_layer_data_chunks(
+        (300, 300, 300), ['z', 'y', 'x'], storage_chunks=(50, 64, 100))
+    assert(chunks == (150, 192, 200))
+
+
+def test_image_layer_to_msim_zero_copy(tmp_path):
+
+    from napari.components import ViewerModel
+    from napari.layers import Image
+
+    data = np.memmap(tmp_path / 'data.raw', dtype=np.uint16,
+                     mode='w+', shape=(1500, 1200))
+    data[:] = 1
+
+    l = Image(data)
+    msim = viewer_utils.image_layer_to_msim(l, ViewerModel())
+
+    # the dask graph refers to the original memmap
+    graph = msim['scale0/image'].data.dask
+    assert(any(getattr(v, 'array', None) is data
+               for layer in graph.layers.values() for v in layer.values()))
+
+    assert(np.allclose(msim['scale0/image'].data[0, :10, :10], 1))
@@ -8,6 +8,7 @@ from napari_stitcher import (
     StitcherQWidget,
     _widget,
     _sample_data,
+    _utils,
     viewer_utils,
 )
 
@@ -302,3 +303,128 @@ def test_vanilla_layers_2D_no_time(make_napari_viewer):
     wdg.button_load_layers_all.clicked()
     wdg.run_registration()
     wdg.run_fusion()
+
+
+def test_registration_in_background(make_napari_viewer, qtbot, monkeypatch):
+    """
+    Register using the button (background thread) and cancel a second run.
+    """
+
+    import threading
+
+    # threads in which tiles are identified (hashing in-memory data)
+    tile_id_threads = []
+    get_tile_id = _utils.get_tile_id
+    def recording_get_tile_id(*args):
+        tile_id_threads.append(threading.current_thread())
+        return get_tile_id(*args)
+    monkeypatch.setattr(_utils, 'get_tile_id', recording_get_tile_id)
+
+    viewer = make_napari_viewer()
+
+    wdg = StitcherQWidget(viewer)
+    viewer.window.add_dock_widget(wdg)
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=5, zoom=10, dtype=np.uint8)
+
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims]
+    layer_tuples = viewer_utils.create_image_layer_tuples_from_msims(
+        msims, transform_key=METADATA_TRANSFORM_KEY)
+
+    for lt in layer_tuples:
+        viewer.add_image(lt[0], **lt[1])
+
+    wdg.button_load_layers_all.clicked()
+
+    wdg.button_stitch.clicked()
+    qtbot.waitUntil(lambda: wdg.worker is None, timeout=60000)
+
+    assert(wdg.visualization_type_rbuttons.value == _widget.CHOICE_REGISTERED)
+    assert(wdg.button_stitch.enabled)
+
+    # tiles are identified within the job, not in the GUI thread
+    assert(len(tile_id_threads))
+    assert(threading.main_thread() not in tile_id_threads)
+
+    # cancelled jobs don't apply their results
+    wdg.visualization_type_rbuttons.value = _widget.CHOICE_METADATA
+    wdg.button_stitch.clicked()
+    wdg.button_cancel.clicked()
+    qtbot.waitUntil(lambda: wdg.worker is None, timeout=60000)
+
+    assert(wdg.visualization_type_rbuttons.value == _widget.CHOICE_METADATA)
+    assert(not wdg.button_cancel.enabled)
+
+
+def test_fusion_in_background(make_napari_viewer, qtbot):
+    """
+    Fuse using the button (background thread), channels concurrently.
+    """
+
+    viewer = make_napari_viewer()
+
+    wdg = StitcherQWidget(viewer)
+    viewer.window.add_dock_widget(wdg)
+
+    N_c = 2
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=N_c,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        overlap=5, zoom=10, dtype=np.uint8)
+
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims]
+    layer_tuples = viewer_utils.create_image_layer_tuples_from_msims(
+        msims, transform_key=METADATA_TRANSFORM_KEY)
+
+    for lt in layer_tuples:
+        viewer.add_image(lt[0], **lt[1])
+
+    wdg.button_load_layers_all.clicked()
+
+    wdg.button_fuse.clicked()
+    qtbot.waitUntil(lambda: wdg.worker is None, timeout=60000)
+
+    assert(len(wdg.fused_layers) == N_c)
+    assert(min(['fused' in l.name for l in viewer.layers[-N_c:]]))
+
+
+def test_viewer_transformations_lut(make_napari_viewer, qtbot):
+    """
+    Scrolling through time applies the precomputed transforms
+    of the last timepoint only.
+    """
+
+    viewer = make_napari_viewer()
+
+    wdg = StitcherQWidget(viewer)
+    viewer.window.add_dock_widget(wdg)
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=3, N_c=1,
+        tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1,
+        drift_scale=2., shift_scale=2., overlap=5, zoom=10, dtype=np.uint8)
+
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims]
+    layer_tuples = viewer_utils.create_image_layer_tuples_from_msims(
+        msims, transform_key=METADATA_TRANSFORM_KEY)
+
+    for lt in layer_tuples:
+        viewer.add_image(lt[0], **lt[1])
+
+    wdg.button_load_layers_all.clicked()
+
+    layer = viewer.layers[1]
+    lut = wdg.affine_lut[METADATA_TRANSFORM_KEY][layer.name]
+
+    assert(lut.shape == (3, layer.ndim + 1, layer.ndim + 1))
+
+    for tp in [1, 2]:
+        current_step = list(viewer.dims.current_step)
+        current_step[0] = tp
+        viewer.dims.current_step = tuple(current_step)
+
+    qtbot.waitUntil(lambda: wdg.shown_transformations == (2, METADATA_TRANSFORM_KEY))
+    assert(np.allclose(layer.affine.affine_matrix, lut[2]))
@@ -97,3 +97,146 @@ def test_writer_napari(field_ndim, N_t, N_c, make_napari_viewer):
         assert(resolution_value_checked)
         assert(bitspersample_checked)
 
+
+
+def test_write_multiscale_layer_data(tmp_path):
+    """
+    Multiscale layers are passed to the writer as napari's MultiScaleData.
+    """
+
+    from napari.layers import Image
+    from napari_stitcher import _writer
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=1,
+        tiles_x=1, tiles_y=1, tiles_z=1, dtype=np.uint16)
+
+    msims = [msi_utils.get_msim_from_sim(sim) for sim in sims]
+
+    layer_data = [Image(ld[0], **ld[1]).as_layer_data_tuple()
+                  for ld in viewer_utils.create_image_layer_tuples_from_msims(
+                      msims,
+                      positional_cmaps=False,
+                      transform_key=METADATA_TRANSFORM_KEY,
+                  )]
+
+    assert(not isinstance(layer_data[0][0], (list, tuple)))
+
+    filepath = str(tmp_path / "test.tif")
+    assert(_writer.write_multiple(filepath, layer_data) == [filepath])
+
+    assert(np.array_equal(tifffile.imread(filepath),
+                          np.squeeze(sims[0].values)))
+
+
+@pytest.mark.parametrize("memory_budget", [2 ** 30, 50 * 40, 1000])
+def test_save_sims_as_tif(memory_budget, tmp_path):
+
+    from spatial_image import to_spatial_image
+    from napari_stitcher import _writer
+
+    rng = np.random.default_rng(0)
+    sims = [to_spatial_image(
+                da.from_array(
+                    rng.integers(0, 255, (2, 3, 50, 40), dtype=np.uint8),
+                    chunks=(1, 2, 25, 25)),
+                dims=['t', 'z', 'y', 'x'],
+                scale={'z': 2., 'y': 0.5, 'x': 0.5},
+                ).assign_coords(c='ch%s' %ich)
+            for ich in range(2)]
+
+    filepath = str(tmp_path / "test.tif")
+    _writer.save_sims_as_tif(
+        filepath, sims, memory_budget=memory_budget,
+        tile=(16, 16), compression='zlib')
+
+    read_im = tifffile.imread(filepath)
+    assert(np.array_equal(read_im, np.stack([sim.values for sim in sims], 1)))
+
+    tif = tifffile.TiffFile(filepath)
+    assert(tif.is_bigtiff)
+    assert(tif.pages[0].is_tiled)
+    assert(tif.series[0].axes == 'TCZYX')
+
+
+@pytest.mark.parametrize("memory_budget", [2 ** 30, 3 * 50 * 40, 700])
+def test_save_sims_as_tif_computes_chunks_once(memory_budget, tmp_path):
+    """
+    Slabs are aligned to the dask chunks, such that no chunk is
+    computed more than once, also when chunks of z-planes exceed
+    the memory budget.
+    """
+
+    from spatial_image import to_spatial_image
+    from napari_stitcher import _writer
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 255, (1, 5, 50, 40), dtype=np.uint8)
+
+    computed_blocks = []
+    def count_block(block, block_info=None):
+        computed_blocks.append(tuple(block_info[0]['chunk-location']))
+        return block
+
+    array = da.from_array(data, chunks=(1, 2, 15, 40)).map_blocks(
+        count_block, dtype=data.dtype, meta=np.array((), dtype=data.dtype))
+
+    sim = to_spatial_image(
+        array, dims=['t', 'z', 'y', 'x'],
+        scale={'z': 2., 'y': 0.5, 'x': 0.5},
+        ).assign_coords(c='ch0')
+
+    filepath = str(tmp_path / "test.tif")
+    _writer.save_sims_as_tif(
+        filepath, [sim], memory_budget=memory_budget, tile=(16, 16))
+
+    assert(np.array_equal(tifffile.imread(filepath), data[0]))
+
+    n_chunks = np.prod(array.numblocks)
+    assert(len(computed_blocks) == n_chunks)
+    assert(len(set(computed_blocks)) == n_chunks)
+
+
+@pytest.mark.parametrize("compression", [None, 'zstd'])
+def test_write_multiple_ome_zarr(compression, tmp_path):
+
+    import zarr
+    from napari_stitcher import _writer
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=2, tile_size=600,
+        tiles_x=1, tiles_y=1, tiles_z=1, dtype=np.uint8,
+        spacing_x=0.5, spacing_y=0.5,
+    )
+
+    msims = [msi_utils.get_msim_from_sim(sim) for sim in sims]
+
+    lds = viewer_utils.create_image_layer_tuples_from_msims(
+        msims, positional_cmaps=False, contrast_limits=[0, 1])
+    layers_sims = _writer.get_sims_from_layer_data(lds)
+
+    filepath = str(tmp_path / "test.zarr")
+    _writer.save_sims_as_ome_zarr(filepath, layers_sims, compression=compression)
+
+    root = zarr.open_group(filepath, mode='r')
+    multiscales = root.attrs['multiscales'][0]
+
+    assert([ax['name'] for ax in multiscales['axes']] == ['t', 'c', 'y', 'x'])
+    assert(len(multiscales['datasets']) == len(layers_sims[0]) > 1)
+
+    for iscale, dataset in enumerate(multiscales['datasets']):
+        scale_sims = [layer_sims[iscale] for layer_sims in layers_sims]
+        assert(np.array_equal(
+            root[dataset['path']][:],
+            np.stack([sim.values for sim in scale_sims], 1)))
+
+        spacing = dataset['coordinateTransformations'][0]['scale']
+        assert(np.allclose(
+            spacing[2:],
+            [float(scale_sims[0].coords[dim][1] - scale_sims[0].coords[dim][0])
+             for dim in ['y', 'x']]))
+
+        translation = dataset['coordinateTransformations'][1]['translation']
+        assert(np.allclose(
+            translation[2:],
+            [float(scale_sims[0].coords[dim][0]) for dim in ['y', 'x']]))
@@ -1,12 +1,30 @@
+import os, threading, queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+
 import numpy as np
 import xarray as xr
 
 from dask import delayed, compute
+from dask.base import tokenize
+from dask.callbacks import Callback
 import dask.array as da
 from tqdm.dask import TqdmCallback
 
 from napari.utils import progress
 
+# distributed is an optional dependency
+try:
+    import distributed
+except ImportError:
+    distributed = None
+
+
+# environment variable configuring the directory of the
+# caches for fusion and registration results
+CACHE_DIR_ENV = 'NAPARI_STITCHER_CACHE_DIR'
+
 
 class TemporarilyDisabledWidgets(object):
     """
@@ -35,6 +53,270 @@ class VisibleActivityDock(object):
         self.viewer.window._status_bar._toggle_activity_dock(False)
 
 
+class ComputationCancelledError(Exception):
+    """
+    Raised within a dask computation that has been cancelled.
+    """
+    pass
+
+
+class CancelCallback(Callback):
+    """
+    Dask callback allowing to cancel computations from another thread.
+
+    Once `cancel` has been called, no further tasks are started by the
+    computations running in the threads that entered the callback and
+    ComputationCancelledError is raised instead. Computations triggered
+    by other threads (e.g. napari loading data for display) are unaffected.
+    """
+    active_instances = set()
+    def __init__(self):
+        super().__init__()
+        self.cancelled = threading.Event()
+        self.thread_ids = set()
+    def __enter__(self):
+        self.thread_ids.add(threading.get_ident())
+        CancelCallback.active_instances.add(self)
+        return super().__enter__()
+    def __exit__(self, *args):
+        CancelCallback.active_instances.discard(self)
+        super().__exit__(*args)
+    def cancel(self):
+        self.cancelled.set()
+    def _pretask(self, key, dsk, state):
+        if self.cancelled.is_set() and threading.get_ident() in self.thread_ids:
+            raise ComputationCancelledError('Computation cancelled.')
+
+
+def is_cancelled():
+    """
+    Whether a CancelCallback watching the calling thread has been cancelled.
+    """
+    return any(cb.cancelled.is_set()
+               for cb in list(CancelCallback.active_instances)
+               if threading.get_ident() in cb.thread_ids)
+
+
+class MemoryBudget(object):
+    """
+    Memory budget (in bytes) shared by concurrent jobs.
+
+    Jobs reserve their estimated memory usage before starting and wait
+    until enough of the budget is available. A job exceeding the whole
+    budget runs as soon as no other job holds a reservation. Waiting
+    jobs are cancelled by the CancelCallbacks watching their thread.
+    """
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        with self.condition:
+            while self.reserved and self.reserved + nbytes > self.nbytes:
+                if is_cancelled():
+                    raise ComputationCancelledError('Computation cancelled.')
+                self.condition.wait(timeout=0.1)
+            self.reserved += nbytes
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.reserved -= nbytes
+                self.condition.notify_all()
+
+
+def compute_yielding(tasks, scheduler=None):
+    """
+    Compute delayed tasks within a single dask computation, i.e. sharing
+    the same scheduler, and yield the index of each task once it has finished.
+
+    The computation runs in a separate thread, which can be cancelled
+    by the CancelCallbacks watching the calling thread. Given a distributed
+    Client as scheduler, the tasks are computed on its cluster instead
+    and cancelling stops them there.
+    """
+
+    if is_distributed_client(scheduler):
+        for itask, _ in compute_as_completed(tasks, scheduler):
+            yield itask
+        return
+
+    finished = queue.Queue()
+
+    tasks = [delayed(_put_index)(task, itask, finished)
+             for itask, task in enumerate(tasks)]
+
+    cancel_callbacks = [cb for cb in CancelCallback.active_instances
+                        if threading.get_ident() in cb.thread_ids]
+
+    def run():
+        for cb in cancel_callbacks:
+            cb.thread_ids.add(threading.get_ident())
+        compute(tasks, scheduler=scheduler)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(run)
+        n_finished = 0
+        while n_finished < len(tasks):
+            try:
+                yield finished.get(timeout=0.1)
+                n_finished += 1
+            except queue.Empty:
+                if future.done(): break
+        # raise errors occurring during the computation
+        future.result()
+
+
+def compute_as_completed(tasks, client):
+    """
+    Compute tasks on a distributed Client and yield (index, result) of
+    each task as it finishes. Results are gathered by the calling process,
+    such that they can be processed there (e.g. reporting progress or
+    writing caches). Tasks still pending when the generator is closed or
+    the CancelCallbacks watching the calling thread are cancelled, are
+    cancelled on the cluster.
+    """
+
+    futures = client.compute(tasks)
+    indices = {id(future): itask for itask, future in enumerate(futures)}
+    pending = dict(indices)
+
+    try:
+        for future in distributed.as_completed(futures):
+            if is_cancelled():
+                raise ComputationCancelledError('Computation cancelled.')
+            pending.pop(id(future))
+            # raise errors occurring during the computation
+            yield indices[id(future)], future.result()
+    finally:
+        remaining = [future for future in futures if id(future) in pending]
+        if len(remaining):
+            client.cancel(remaining)
+
+
+def compute_bounded(tasks, n_in_flight=2, scheduler=None):
+    """
+    Compute delayed tasks, each within its own dask computation, keeping
+    at most n_in_flight computations running at a time. Tasks are only
+    taken from the iterable once a computation has finished, such that
+    their graphs can be built lazily by a generator.
+
+    Yields the index of each task once it has finished. As for
+    compute_yielding, the computations can be cancelled by the
+    CancelCallbacks watching the calling thread (computations
+    running on a distributed Client by `cancel_client_computations`).
+    """
+
+    for itask, _ in map_bounded(
+            partial(compute, scheduler=scheduler), tasks, n_in_flight):
+        yield itask
+
+
+def map_bounded(func, iterable, n_in_flight=2):
+    """
+    Apply func to the elements of iterable in a pool of n_in_flight
+    threads, taking elements from the iterable only once a thread
+    becomes available.
+
+    Yields (index, result) in the order in which the calls finish.
+    Dask computations started by func can be cancelled by the
+    CancelCallbacks watching the calling thread. Once cancelled,
+    no further calls are started.
+    """
+
+    cancel_callbacks = [cb for cb in CancelCallback.active_instances
+                        if threading.get_ident() in cb.thread_ids]
+
+    def run(item):
+        for cb in cancel_callbacks:
+            cb.thread_ids.add(threading.get_ident())
+        return func(item)
+
+    items = enumerate(iterable)
+    running = dict()
+
+    with ThreadPoolExecutor(max_workers=n_in_flight) as executor:
+        while True:
+            for iitem, item in items:
+                if any(cb.cancelled.is_set() for cb in cancel_callbacks):
+                    raise ComputationCancelledError('Computation cancelled.')
+                running[executor.submit(run, item)] = iitem
+                if len(running) >= n_in_flight: break
+
+            if not len(running): break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=running.get):
+                iitem = running.pop(future)
+                # raise errors occurring during the computation
+                yield iitem, future.result()
+
+
+def get_client(address=None, n_workers=1, threads_per_worker=1,
+               memory_limit='auto', processes=True):
+    """
+    Dask distributed Client connected to the scheduler at the given
+    address or, without address, to a new LocalCluster of n_workers
+    worker processes (threads if processes=False) with threads_per_worker
+    threads each, limited to memory_limit (e.g. '4GB'). Closing the
+    client shuts down its LocalCluster.
+
+    The client is not set as the default scheduler, such that other
+    computations (e.g. napari loading data for display) are not affected.
+    """
+
+    if distributed is None:
+        raise ImportError(
+            "distributed is required to compute on a cluster. "
+            "Please install it using `pip install distributed`.")
+
+    if address:
+        return distributed.Client(address, set_as_default=False)
+
+    return distributed.Client(
+        n_workers=n_workers,
+        threads_per_worker=threads_per_worker,
+        memory_limit=memory_limit,
+        processes=processes,
+        set_as_default=False,
+        )
+
+
+@contextmanager
+def local_cluster_client(n_workers, memory_limit):
+    """
+    Context manager providing a dask distributed Client connected to
+    a LocalCluster of n_workers single threaded worker processes,
+    each limited to memory_limit (e.g. '4GB').
+    """
+
+    with get_client(n_workers=n_workers, memory_limit=memory_limit) as client:
+        yield client
+
+
+def is_distributed_client(scheduler):
+    return distributed is not None \
+        and isinstance(scheduler, distributed.Client)
+
+
+def cancel_client_computations(client):
+    """
+    Cancel all computations of a distributed Client, including blocking
+    computations started using the client as a dask scheduler (which
+    then raise a CancelledError).
+    """
+
+    keys = list(client.futures)
+    if len(keys):
+        client.cancel([distributed.Future(key, client) for key in keys])
+
+
+def _put_index(result, index, q):
+    q.put(index)
+
+
 def get_str_unique_to_view_from_layer_name(layer_name):
     return layer_name.split(' :: ')[0]
 
@@ -52,3 +334,91 @@ def filter_layers(layers, sims, view=None, ch=None):
         if view is not None and get_str_unique_to_view_from_layer_name(l.name) != view: continue
         if ch is not None and get_str_unique_to_ch_from_sim_coords(sims[l.name].coords) != ch: continue
         yield l
+
+
+def index_layers_by_view_and_ch(layers, sims):
+    """
+    Group layers by view and by channel in a single pass.
+
+    Returns
+    -------
+    tuple of dict
+        Layers for each view and layers for each channel
+    """
+    layers_by_view, layers_by_ch = dict(), dict()
+    for l in layers:
+        view = get_str_unique_to_view_from_layer_name(l.name)
+        ch = get_str_unique_to_ch_from_sim_coords(sims[l.name].coords)
+        layers_by_view.setdefault(view, []).append(l)
+        layers_by_ch.setdefault(ch, []).append(l)
+    return layers_by_view, layers_by_ch
+
+
+def get_cache_dir(name):
+    """
+    Directory of the cache with the given name. The caches are located
+    in the directory given by the environment variable
+    NAPARI_STITCHER_CACHE_DIR, by default ~/.cache/napari-stitcher.
+    """
+
+    cache_dir = os.environ.get(
+        CACHE_DIR_ENV,
+        os.path.join(os.path.expanduser('~'), '.cache', 'napari-stitcher'))
+
+    cache_dir = os.path.join(cache_dir, name)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+
+def get_file_id(path):
+    """
+    Identify a file across sessions by its path, modification time and
+    size, such that results obtained from a modified file aren't reused.
+    """
+
+    path = os.path.abspath(path)
+
+    if not os.path.exists(path):
+        return path
+
+    stat = os.stat(path)
+
+    return '%s :: %s :: %s' %(path, stat.st_mtime_ns, stat.st_size)
+
+
+def get_tile_id(layer, sim):
+    """
+    Identify the data of a tile across sessions: by the file a layer has
+    been read from (see `get_file_id`) and the layer name or, for layers
+    not read from a file, by a token of the layer data at each time
+    coordinate of sim (the layer data as loaded). The tokens hash numpy
+    arrays and use the (deterministic) name of dask arrays, such that
+    they don't change when the same data is loaded again, and timepoints
+    stay identified when timepoints are added to the data.
+
+    Returns
+    -------
+    str or dict
+        Identifier of the tile or, for layers not read from a file,
+        identifier of the tile for each time coordinate
+    """
+
+    if layer.source.path is not None:
+        return '%s :: %s' %(get_file_id(layer.source.path), layer.name)
+
+    data = layer.data[0] if layer.multiscale else layer.data
+
+    ts = sim.coords['t'].values
+    if isinstance(data, xr.DataArray):
+        fields = [data.isel(t=it) if 't' in data.dims else data
+                  for it in range(len(ts))]
+    elif data.ndim == sim.ndim:
+        axis = sim.dims.index('t')
+        fields = [data[(slice(None),) * axis + (it,)] for it in range(len(ts))]
+    else:
+        # the time dimension has been added when loading the layer
+        fields = [data] * len(ts)
+
+    return {t: '%s :: %s' %(layer.name, tokenize(field))
+            for t, field in zip(ts, fields)}
@@ -7,15 +7,20 @@ see: https://napari.org/stable/plugins/guides.html?#widgets
 Replace code below according to your needs.
 """
 from typing import TYPE_CHECKING
-import os, tempfile, sys
+import os, shutil, sys, inspect, threading, uuid
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from contextlib import ExitStack
+from functools import partial
 
 import numpy as np
 import dask
 
 from napari.utils import notifications
+from napari.qt.threading import create_worker
 
 from magicgui import widgets
 from qtpy.QtWidgets import QVBoxLayout, QWidget
+from qtpy.QtCore import QTimer
 
 import spatial_image as si
 
@@ -26,7 +31,8 @@ from multiview_stitcher import (
     msi_utils,
     )
 
-from napari_stitcher import _reader, viewer_utils, _utils
+from napari_stitcher import _reader, viewer_utils, _utils,\
+    registration_utils, fusion_utils
 
 if TYPE_CHECKING:
     import napari
@@ -50,10 +56,15 @@ class StitcherQWidget(QWidget):
 
         self.button_load_layers_all = widgets.Button(text='All')
         self.button_load_layers_sel = widgets.Button(text='Selected')
+        self.button_add_layers_new = widgets.Button(text='Add new',
+            tooltip='Add layers which are not loaded yet or have gained\n'+\
+                    'timepoints (e.g. during acquisition), keeping the\n'+\
+                    'registration results of the loaded layers.')
         self.buttons_load_layers = widgets.HBox(
             widgets=\
                 [self.button_load_layers_sel,
-                    self.button_load_layers_all]
+                    self.button_load_layers_all,
+                    self.button_add_layers_new]
                     )
         self.layers_selection = widgets.Select(choices=[])
         self.load_layers_box = widgets.VBox(widgets=\
@@ -72,6 +83,44 @@ class StitcherQWidget(QWidget):
             choices=[],
             tooltip='Choose a file to process using napari-stitcher.')
 
+        self.reg_binning_xy = widgets.SpinBox(
+            label='Binning XY:', value=1, min=1, max=64,
+            tooltip='Binning applied in x and y during registration.\n'+\
+                    'Higher values speed up registration of large tiles,\n'+\
+                    'e.g. 8 for large 3D tiles.')
+
+        self.reg_binning_z = widgets.SpinBox(
+            label='Binning Z:', value=1, min=1, max=64,
+            tooltip='Binning applied in z during registration (3D data only).')
+
+        self.reg_pyramid_levels = widgets.SpinBox(
+            label='Pyramid levels:', value=1, min=1, max=6,
+            tooltip='Coarse-to-fine registration: register on a coarse level first\n'+\
+                    '(binning doubled for each additional level), then refine\n'+\
+                    'on finer levels within the overlap regions only.')
+
+        self.reg_warm_start = widgets.CheckBox(
+            text='Warm start from previous timepoint', value=False,
+            tooltip='Register each timepoint starting from the result of the\n'+\
+                    'previous one, searching only close to it. Falls back to\n'+\
+                    'registering from scratch if the quality drops.\n'+\
+                    'Timepoints are registered one after the other.')
+
+        self.reg_timepoint_workers = widgets.SpinBox(
+            label='Timepoint workers:', value=0, min=0, max=256,
+            tooltip='Register timepoints independently, this many at a time,\n'+\
+                    'showing the results of each timepoint once it is registered.\n'+\
+                    '0: register all timepoints within a single computation.')
+
+        self.reg_use_cluster = widgets.CheckBox(
+            text='Use local cluster', value=False,
+            tooltip='Register the timepoints in separate worker processes\n'+\
+                    'of a dask distributed LocalCluster (requires distributed).')
+
+        self.reg_worker_memory = widgets.FloatSpinBox(
+            label='Memory per worker (GB):', value=4., min=0.5, max=1024., step=0.5,
+            tooltip='Memory limit of each worker process of the local cluster.')
+
         self.button_stitch = widgets.Button(text='Register', enabled=False,
             tooltip='Use the overlaps between tiles to determine their relative positions.')
         
@@ -98,6 +147,35 @@ class StitcherQWidget(QWidget):
                     'tiles and timepoints into a single image, smoothly'+\
                     'blending the overlaps and filling in gaps.')
 
+        self.fusion_stream_checkbox = widgets.CheckBox(
+            text='Stream time points', value=False, enabled=False,
+            tooltip='Fuse and write one time point at a time, keeping memory\n'+\
+                    'usage bounded for long time lapses. Interrupted fusions\n'+\
+                    'are resumed when fusing again.')
+
+        self.button_cancel = widgets.Button(text='Cancel', enabled=False,
+            tooltip='Stop the running registration or fusion.')
+
+        self.cluster_address = widgets.LineEdit(
+            label='Scheduler address:', value='',
+            tooltip='Address of a running dask scheduler, e.g. tcp://host:8786.\n'+\
+                    'Empty: start a LocalCluster of worker processes.\n'+\
+                    'Fused images are written by the workers, such that\n'+\
+                    'the cache folder needs to be accessible to them.')
+
+        self.cluster_n_workers = widgets.SpinBox(
+            label='Cluster workers:', value=4, min=1, max=1024,
+            tooltip='Number of worker processes of the LocalCluster\n'+\
+                    '(memory per worker as chosen above).')
+
+        self.button_connect_cluster = widgets.Button(text='Connect cluster',
+            tooltip='Run registration and fusion on a dask distributed cluster\n'+\
+                    '(requires distributed). Process workers avoid contention\n'+\
+                    'for the GIL in the Python parts of the registration.')
+
+        self.cluster_dashboard = widgets.Label(value='')
+        self.cluster_dashboard.native.setOpenExternalLinks(True)
+
         self.loading_widgets = [
                             self.load_layers_box,
                             ]
@@ -105,6 +183,13 @@ class StitcherQWidget(QWidget):
         self.reg_widgets = [
                             self.times_slider,
                             self.reg_ch_picker,
+                            self.reg_binning_xy,
+                            self.reg_binning_z,
+                            self.reg_pyramid_levels,
+                            self.reg_warm_start,
+                            self.reg_timepoint_workers,
+                            widgets.HBox(widgets=[self.reg_use_cluster,
+                                                  self.reg_worker_memory]),
                             self.buttons_register_tracks,
                             ]
 
@@ -113,15 +198,29 @@ class StitcherQWidget(QWidget):
         ]
 
         self.fusion_widgets = [
-                            widgets.HBox(widgets=[self.button_fuse]),
+                            widgets.HBox(widgets=[self.button_fuse,
+                                                  self.fusion_stream_checkbox]),
+                            ]
+
+
+        self.cluster_widgets = [
+                            self.cluster_address,
+                            widgets.HBox(widgets=[self.cluster_n_workers,
+                                                  self.button_connect_cluster]),
                             ]
 
+        self.job_widgets = [
+                            self.cluster_dashboard,
+                            widgets.HBox(widgets=[self.button_cancel]),
+                            ]
 
         self.container = widgets.VBox(widgets=\
                             self.loading_widgets+
                             self.reg_widgets+
                             self.visualization_widgets+
-                            self.fusion_widgets
+                            self.fusion_widgets+
+                            self.cluster_widgets+
+                            self.job_widgets
                             )
 
         self.container.native.setMinimumWidth = 50
@@ -134,101 +233,173 @@ class StitcherQWidget(QWidget):
         self.fused_layers = []
         self.params = dict()
 
-        # create temporary directory for storing dask arrays
-        self.tmpdir = tempfile.TemporaryDirectory()
+        # affine transforms to show for each transform key, layer and timepoint
+        self.affine_lut = dict()
+        self.highest_sdim = None
+        self.shown_transformations = None
+
+        # background job state
+        self.worker = None
+        self.cancel_callback = None
+
+        # distributed Client running registration and fusion,
+        # None for computing within the napari process
+        self.client = None
+
+        # directories for storing fused images and pairwise
+        # registration results across sessions
+        self.cache_dir = fusion_utils.get_fusion_cache_dir()
+        self.registration_cache_dir = registration_utils.get_registration_cache_dir()
+
+        # inputs and paths of the last fusion of each channel
+        self.fusion_records = dict()
         
+        # coalesce bursts of dims events (e.g. when scrolling through time)
+        self.viewer_transformations_timer = QTimer()
+        self.viewer_transformations_timer.setSingleShot(True)
+        self.viewer_transformations_timer.setInterval(30)
+        self.viewer_transformations_timer.timeout.connect(
+            self.update_viewer_transformations_if_changed)
+
         self.visualization_type_rbuttons.changed.connect(self.update_viewer_transformations)
-        self.viewer.dims.events.connect(self.update_viewer_transformations)
+        self.viewer.dims.events.current_step.connect(
+            self.schedule_viewer_transformations_update)
 
-        self.button_stitch.clicked.connect(self.run_registration)
+        self.button_stitch.clicked.connect(self.start_registration)
         # self.button_stabilize.clicked.connect(self.run_stabilization)
-        self.button_fuse.clicked.connect(self.run_fusion)
+        self.button_fuse.clicked.connect(self.start_fusion)
+        self.button_cancel.clicked.connect(self.cancel_job)
+        self.button_connect_cluster.clicked.connect(self.toggle_cluster)
 
         self.button_load_layers_all.clicked.connect(self.load_layers_all)
         self.button_load_layers_sel.clicked.connect(self.load_layers_sel)
+        self.button_add_layers_new.clicked.connect(self.add_layers_new)
 
 
-    def update_viewer_transformations(self):
+    def update_affine_lut(self):
         """
-        set transformations
-        - for current timepoint
-        - for each (compatible) layer loaded in viewer
+        Precompute the affine transforms to show for each
+        transform key, compatible layer and timepoint.
         """
 
+        self.affine_lut = dict()
+        self.shown_transformations = None
+
         if not len(self.msims): return
 
-        compatible_layers = [l for l in self.viewer.layers
-                             if l.name in self.msims.keys()]
-        
-        if not len(compatible_layers): return
-        
-        sims = [msi_utils.get_sim_from_msim(self.msims[l.name])
-                for l in compatible_layers]
+        sims = {lname: msi_utils.get_sim_from_msim(msim)
+                for lname, msim in self.msims.items()}
 
         # determine spatial dimensions from layers
-        all_spatial_dims = [spatial_image_utils.get_spatial_dims_from_sim(
-            sims[il])
-            for il, l in enumerate(compatible_layers)]
-        
-        highest_sdim = max([len(sdim) for sdim in all_spatial_dims])
+        self.highest_sdim = max([
+            len(spatial_image_utils.get_spatial_dims_from_sim(sim))
+            for sim in sims.values()])
+
+        layers = {l.name: l for l in self.viewer.layers
+                  if l.name in self.msims.keys()}
+
+        for transform_key in [_reader.METADATA_TRANSFORM_KEY, 'affine_registered']:
+
+            self.affine_lut[transform_key] = dict()
+
+            for lname, l in layers.items():
+
+                try:
+                    params = spatial_image_utils.get_affine_from_sim(
+                        sims[lname], transform_key=transform_key
+                        )
+                except:
+                    continue
+
+                # parameters for all timepoints of the layer,
+                # NaN if not available (e.g. not registered)
+                if 't' in params.dims:
+                    params = params.reindex(t=sims[lname].coords['t'])
+                    params = np.array(params.transpose('t', ...))
+                else:
+                    params = np.array([np.array(params)] * len(sims[lname].coords['t']))
+
+                self.affine_lut[transform_key][lname] = \
+                    viewer_utils.get_layer_affines_from_params(params, l.ndim)
+
+
+    def get_current_timepoint(self):
 
-        # get curr tp
         # handle possibility that there had been no T dimension
         # when collecting sims from layers
-
-        if len(self.viewer.dims.current_step) > highest_sdim:
-            curr_tp = self.viewer.dims.current_step[-highest_sdim-1]
+        if len(self.viewer.dims.current_step) > self.highest_sdim:
+            return self.viewer.dims.current_step[-self.highest_sdim-1]
         else:
-            curr_tp = 0
+            return 0
+
+
+    def get_shown_transform_key(self):
 
         if self.visualization_type_rbuttons.value == CHOICE_METADATA:
-            transform_key=_reader.METADATA_TRANSFORM_KEY
+            return _reader.METADATA_TRANSFORM_KEY
         else:
-            transform_key = 'affine_registered'
+            return 'affine_registered'
 
-        for il, l in enumerate(compatible_layers):
 
-            try:
-                params = spatial_image_utils.get_affine_from_sim(
-                    sims[il], transform_key=transform_key
-                    )
-            except:
-                # notifications.notification_manager.receive_info(
-                #     'Update transform: %s not available in %s' %(transform_key, l.name))
-                continue
+    def schedule_viewer_transformations_update(self):
+        """
+        Restart the timer triggering the update, such that
+        only the last of a burst of dims events is applied.
+        """
+        self.viewer_transformations_timer.start()
 
-            try:
-                p = np.array(params.sel(t=sims[il].coords['t'][curr_tp])).squeeze()
-            except:
-                notifications.notification_manager.receive_info(
-                    'Timepoint %s: no parameters available, register first.' % curr_tp)
-                continue
 
-                # # if curr_tp not available, use nearest available parameter
-                # notifications.notification_manager.receive_info(
-                #     'Timepoint %s: no parameters available, taking nearest available one.' % curr_tp)
-                # p = np.array(params.sel(t=layer_sim.coords['t'][curr_tp], method='nearest')).squeeze()
+    def update_viewer_transformations_if_changed(self):
 
-            ndim_layer_data = l.ndim
+        if not len(self.affine_lut): return
 
-            # if stitcher sim has more dimensions than layer data (i.e. time)
-            vis_p = p[-(ndim_layer_data + 1):, -(ndim_layer_data + 1):]
+        if self.shown_transformations == \
+            (self.get_current_timepoint(), self.get_shown_transform_key()):
+            return
 
-            # if layer data has more dimensions than stitcher sim
-            full_vis_p = np.eye(ndim_layer_data + 1)
-            full_vis_p[-len(vis_p):, -len(vis_p):] = vis_p
+        self.update_viewer_transformations()
 
-            l.affine.affine_matrix = full_vis_p
 
-            # refreshing layers fails sometimes
-            # this solution is suboptimal though
-            try:
-                l.refresh()
-            except:
-                pass
+    def update_viewer_transformations(self):
+        """
+        set transformations
+        - for current timepoint
+        - for each (compatible) layer loaded in viewer
+        """
 
+        if not len(self.affine_lut): return
 
-    def run_registration(self):
+        curr_tp = self.get_current_timepoint()
+        transform_key = self.get_shown_transform_key()
+
+        updates, missing = [], []
+        for l in self.viewer.layers:
+
+            if l.name not in self.affine_lut[transform_key]: continue
+
+            affines = self.affine_lut[transform_key][l.name]
+
+            if curr_tp >= len(affines) or np.isnan(affines[curr_tp]).any():
+                missing.append(l.name)
+            else:
+                updates.append((l, affines[curr_tp]))
+
+        # set all transforms in a single batch
+        viewer_utils.set_layer_affines(updates)
+
+        if len(missing):
+            notifications.notification_manager.receive_info(
+                'Timepoint %s: no parameters available, register first.'
+                % curr_tp)
+
+        self.shown_transformations = (curr_tp, transform_key)
+
+
+    def get_registration_msims(self):
+        """
+        Get the views to register, restricted to the
+        registration channel and the selected timepoints.
+        """
 
         msims_dict = {_utils.get_str_unique_to_view_from_layer_name(lname): msim
                       for lname, msim in self.msims.items()
@@ -244,17 +415,250 @@ class StitcherQWidget(QWidget):
                                          self.times_slider.value[1] + 1)]})
                   for msim in msims]
 
+        return msims, sorted_lnames
+
+
+    def get_registration_tile_ids(self, sorted_lnames):
+        """
+        Function returning identifiers of the views to register (as sorted
+        by get_registration_msims) which are stable across sessions.
+
+        Identifying views not read from a file hashes their data,
+        which is therefore left to the function, e.g. to be called
+        within a background job.
+        """
+
+        layers = {_utils.get_str_unique_to_view_from_layer_name(l.name): l
+                  for l in self.input_layers
+                  if l.name in self.msims and self.reg_ch_picker.value in
+                      msi_utils.get_sim_from_msim(self.msims[l.name]).coords['c']}
+
+        layers_sims = [(layers[view], msi_utils.get_sim_from_msim(
+                            self.msims[layers[view].name]))
+                       for view in sorted_lnames]
+
+        return lambda: [_utils.get_tile_id(layer, sim)
+                        for layer, sim in layers_sims]
+
+
+    def get_registration_kwargs(self, msims):
+        """
+        Registration binning and pyramid levels as chosen in the widget.
+        """
+
+        spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(
+            msi_utils.get_sim_from_msim(msims[0]))
+
+        registration_binning = {dim: self.reg_binning_z.value if dim == 'z'
+                                else self.reg_binning_xy.value
+                                for dim in spatial_dims}
+
+        n_pyramid_levels = self.reg_pyramid_levels.value
+
+        # keep the default behaviour of multiview-stitcher if no binning is chosen
+        if max(registration_binning.values()) == 1:
+            registration_binning = None
+
+        return {'registration_binning': registration_binning,
+                'n_pyramid_levels': n_pyramid_levels}
+
+
+    def get_timepoint_workers_kwargs(self):
+        """
+        Execution settings for registering timepoints independently
+        (see compute_registration_timepoints).
+        """
+
+        return {'n_workers': self.reg_timepoint_workers.value,
+                'use_cluster': self.reg_use_cluster.value,
+                'worker_memory_limit': '%sGB' %self.reg_worker_memory.value}
+
+
+    def run_registration(self):
+        """
+        Register the loaded tiles, blocking until done.
+        """
+
+        msims, sorted_lnames = self.get_registration_msims()
+
+        kwargs = dict(
+            tile_ids=self.get_registration_tile_ids(sorted_lnames)(),
+            previous_params=[self.params.get(view) for view in sorted_lnames],
+            **self.get_registration_kwargs(msims))
+
         with _utils.TemporarilyDisabledWidgets([self.container]),\
-            _utils.VisibleActivityDock(self.viewer),\
-            _utils.TqdmCallback(tqdm_class=_utils.progress,
-                                desc='Registering tiles', bar_format=" "):
-            
-            params = registration.register(
+            _utils.VisibleActivityDock(self.viewer):
+
+            if self.reg_warm_start.value:
+                for params in self.compute_registration_warm_start(msims, **kwargs):
+                    self.set_registration_params(params, sorted_lnames)
+                return
+
+            if self.reg_timepoint_workers.value:
+                for params in self.compute_registration_timepoints(
+                        msims, **kwargs, **self.get_timepoint_workers_kwargs()):
+                    self.set_registration_params(params, sorted_lnames)
+                return
+
+            params = self.compute_registration(msims, **kwargs)
+
+        self.set_registration_params(params, sorted_lnames)
+
+
+    def start_registration(self):
+        """
+        Register the loaded tiles in a background thread.
+        The viewer stays responsive and the registration can be cancelled.
+        With timepoint workers, the parameters of each timepoint are
+        shown as soon as it has been registered.
+        """
+
+        msims, sorted_lnames = self.get_registration_msims()
+
+        kwargs = dict(
+            previous_params=[self.params.get(view) for view in sorted_lnames],
+            **self.get_registration_kwargs(msims))
+
+        # tile ids are determined within the job, keeping the viewer
+        # responsive while the data of in-memory layers is hashed
+        get_tile_ids = self.get_registration_tile_ids(sorted_lnames)
+
+        def job(compute, msims, **kwargs):
+            return compute(msims, tile_ids=get_tile_ids(), **kwargs)
+
+        if self.reg_warm_start.value:
+            self.start_job(
+                partial(job, self.compute_registration_warm_start, **kwargs),
+                msims,
+                on_yielded=partial(self.set_registration_params,
+                                   sorted_lnames=sorted_lnames),
+                )
+            return
+
+        if self.reg_timepoint_workers.value:
+            self.start_job(
+                partial(job, self.compute_registration_timepoints,
+                        **kwargs, **self.get_timepoint_workers_kwargs()),
+                msims,
+                on_yielded=partial(self.set_registration_params,
+                                   sorted_lnames=sorted_lnames),
+                )
+            return
+
+        self.start_job(
+            partial(job, self.compute_registration, **kwargs),
+            msims,
+            on_returned=partial(self.set_registration_params,
+                                sorted_lnames=sorted_lnames),
+            )
+
+
+    def compute_registration_warm_start(self, msims, **kwargs):
+        """
+        Register the timepoints of the views one after the other, starting
+        from the result of the previous timepoint. Yields the parameters
+        of each timepoint once it has been registered.
+        """
+
+        n_t = len(msi_utils.get_sim_from_msim(msims[0]).coords['t'])
+
+        with _utils.progress(total=n_t, desc='Registering timepoints') as pbar:
+
+            for t, params, warm_started in \
+                    registration_utils.register_timepoints_warm_start(
+                        msims,
+                        transform_key='affine_metadata',
+                        cache_dir=self.registration_cache_dir,
+                        scheduler=self.client,
+                        **kwargs,
+                        ):
+                pbar.set_description('Registered timepoint %s%s'
+                    %(t, '' if warm_started else ' (from scratch)'))
+                pbar.update(1)
+                yield params
+
+
+    def compute_registration_timepoints(self, msims, n_workers=1,
+                                        use_cluster=False, worker_memory_limit=None,
+                                        **kwargs):
+        """
+        Register the timepoints of the views independently, n_workers at a
+        time, optionally on a local cluster with worker_memory_limit (unless
+        the widget is connected to a cluster already, see toggle_cluster).
+        Yields the parameters of each timepoint once it has been registered.
+        """
+
+        n_t = len(msi_utils.get_sim_from_msim(msims[0]).coords['t'])
+
+        with ExitStack() as stack:
+
+            scheduler = self.client
+            if scheduler is None and use_cluster:
+                scheduler = stack.enter_context(_utils.local_cluster_client(
+                    n_workers, worker_memory_limit))
+
+            pbar = stack.enter_context(
+                _utils.progress(total=n_t, desc='Registering timepoints'))
+
+            for t, params in registration_utils.register_timepoints(
+                    msims,
+                    transform_key='affine_metadata',
+                    n_workers=n_workers,
+                    cache_dir=self.registration_cache_dir,
+                    scheduler=scheduler,
+                    **kwargs,
+                    ):
+                pbar.set_description('Registered timepoint %s' %t)
+                pbar.update(1)
+                yield params
+
+
+    def compute_registration(self, msims,
+                             registration_binning=None, n_pyramid_levels=1,
+                             tile_ids=None, previous_params=None):
+        """
+        Register views, reporting progress for each registered pair.
+        Given the tile_ids of the views, pairs registered previously
+        are read from the registration cache. Given previous_params,
+        the previously registered views keep their positions.
+        """
+
+        pbar = _utils.progress(desc='Registering tiles')
+        pbar_lock = threading.Lock()
+
+        def pair_callback(pair, n_pairs):
+            with pbar_lock:
+                pbar.total = n_pairs
+                pbar.set_description(
+                    'Registered tiles %s and %s' %tuple(pair))
+                pbar.update(1)
+
+        try:
+            params = registration_utils.register(
                 msims,
-                # registration_binning={'z': 2, 'y': 8, 'x': 8},
-                registration_binning=None,
+                registration_binning=registration_binning,
+                n_pyramid_levels=n_pyramid_levels,
                 transform_key='affine_metadata',
+                pair_callback=pair_callback,
+                tile_ids=tile_ids,
+                cache_dir=self.registration_cache_dir,
+                previous_params=previous_params,
+                scheduler=self.client,
             )
+        finally:
+            pbar.close()
+
+        return params
+
+
+    def set_registration_params(self, params, sorted_lnames):
+
+        # keep the parameters of timepoints which haven't been registered again
+        params = [p if self.params.get(view) is None
+                  else p.combine_first(self.params[view])
+                  for view, p in zip(sorted_lnames, params)]
+
+        self.params.update(zip(sorted_lnames, params))
 
         for lname, msim in self.msims.items():
             params_index = sorted_lnames.index(_utils.get_str_unique_to_view_from_layer_name(lname))
@@ -276,66 +680,455 @@ class StitcherQWidget(QWidget):
         #     notifications.notification_manager.receive_info(message)
         #     return
         
+        self.update_affine_lut()
+
         self.visualization_type_rbuttons.enabled = True
         self.visualization_type_rbuttons.value = CHOICE_REGISTERED
+        self.update_viewer_transformations()
 
 
-    def run_fusion(self):
+    def start_job(self, func, *args, on_returned=None, on_yielded=None):
+        """
+        Run func(*args) in a background thread.
+
+        While the job runs, the processing widgets are disabled and
+        the cancel button is enabled. If func returns a generator,
+        its yielded values are passed to on_yielded.
+        """
+
+        if self.worker is not None:
+            notifications.notification_manager.receive_info(
+                'Another computation is still running.')
+            return
 
+        cancel_callback = _utils.CancelCallback()
+
+        def job():
+            # the callback needs to be entered in the worker thread
+            with cancel_callback:
+                try:
+                    result = func(*args)
+                    if inspect.isgenerator(result):
+                        result = yield from result
+                except _utils.ComputationCancelledError:
+                    return None
+                except CancelledError:
+                    # computations cancelled on a distributed cluster
+                    if cancel_callback.cancelled.is_set():
+                        return None
+                    raise
+            return result
+
+        def returned(result):
+            if cancel_callback.cancelled.is_set():
+                notifications.notification_manager.receive_info(
+                    'Computation cancelled.')
+                return
+            if on_returned is not None:
+                on_returned(result)
+
+        self.disabled_widgets = _utils.TemporarilyDisabledWidgets(
+            self.loading_widgets + self.reg_widgets +\
+            self.visualization_widgets + self.fusion_widgets +\
+            self.cluster_widgets)
+        self.visible_activity_dock = _utils.VisibleActivityDock(self.viewer)
+
+        self.disabled_widgets.__enter__()
+        self.visible_activity_dock.__enter__()
+        self.button_cancel.enabled = True
+
+        self.cancel_callback = cancel_callback
+        self.worker = create_worker(job, _start_thread=False)
+        self.worker.returned.connect(returned)
+        if on_yielded is not None:
+            self.worker.yielded.connect(on_yielded)
+        self.worker.finished.connect(self.finish_job)
+        self.worker.start()
+
+
+    def finish_job(self):
+
+        self.button_cancel.enabled = False
+        self.visible_activity_dock.__exit__(None, None, None)
+        self.disabled_widgets.__exit__(None, None, None)
+
+        self.worker = None
+        self.cancel_callback = None
+
+
+    def cancel_job(self):
+        """
+        Cancel the running background job. Dask stops scheduling
+        new tasks and the job finishes without applying results.
+        Computations running on a cluster are cancelled there.
+        """
+
+        if self.worker is None: return
+
+        self.cancel_callback.cancel()
+        if self.client is not None:
+            _utils.cancel_client_computations(self.client)
+        self.worker.quit()
+        self.button_cancel.enabled = False
+
+
+    def toggle_cluster(self):
+
+        if self.client is None:
+            self.connect_cluster()
+        else:
+            self.disconnect_cluster()
+
+
+    def connect_cluster(self):
+        """
+        Connect to the dask scheduler at the chosen address or start a
+        LocalCluster of worker processes. Registration and fusion then
+        run on the cluster until disconnecting.
+        """
+
+        try:
+            self.client = _utils.get_client(
+                address=self.cluster_address.value.strip() or None,
+                n_workers=self.cluster_n_workers.value,
+                memory_limit='%sGB' %self.reg_worker_memory.value,
+                )
+        except Exception as e:
+            notifications.notification_manager.receive_info(
+                'Could not connect to the cluster: %s' %e)
+            return
+
+        self.cluster_dashboard.value = '<a href="%s">Cluster dashboard</a>'\
+            %self.client.dashboard_link
+        self.button_connect_cluster.text = 'Disconnect cluster'
+        self.cluster_address.enabled = False
+        self.cluster_n_workers.enabled = False
+        self.reg_use_cluster.enabled = False
+
+
+    def disconnect_cluster(self):
         """
-        Split layers into channel groups and fuse each group separately.
+        Close the connection to the cluster (shutting down a LocalCluster
+        started by the widget) and compute within the napari process again.
+        """
+
+        if self.client is None: return
+
+        self.client.close()
+        self.client = None
+
+        self.cluster_dashboard.value = ''
+        self.button_connect_cluster.text = 'Connect cluster'
+        self.cluster_address.enabled = True
+        self.cluster_n_workers.enabled = True
+        self.reg_use_cluster.enabled = True
+
+
+    def get_fused_msims(self, stream=False):
+        """
+        Split layers into channel groups and (lazily) fuse each group separately.
+
+        With stream=True, the fusion graphs are not built. Instead, lazy
+        placeholders with the layout of the fused images are returned,
+        which are filled in one time point at a time (see compute_fusion).
+
+        Returns
+        -------
+        dict
+            Fused MultiscaleSpatialImage for each channel
         """
 
         channels = self.reg_ch_picker.choices
 
+        mfuseds = dict()
         for _, ch in enumerate(channels):
 
-            msims = [msim for _, msim in self.msims.items()
-                    if ch in msi_utils.get_sim_from_msim(msim).coords['c']]
+            _, sims, transform_key = self.get_fusion_inputs(ch)
+
+            if stream:
+                fused = fusion_utils.get_fusion_template(
+                    sims, transform_key,
+                    fusion_utils.get_fusion_stack_properties(sims, transform_key))
+            else:
+                fused = fusion.fuse(
+                    sims,
+                    transform_key=transform_key,
+                )
+
+                fused = fused.expand_dims({'c': [sims[0].coords['c'].values]})
+
+            # lazily downsampled levels are written within the same
+            # computation as the fused image (see compute_fusion)
+            mfuseds[ch] = msi_utils.get_msim_from_sim(fused, scale_factors=None)
+
+        return mfuseds
+
+
+    def get_fusion_inputs(self, ch):
+        """
+        Get the layer names, time selected views and transform key
+        used for fusing a channel.
+        """
+
+        lnames = [lname for lname, msim in self.msims.items()
+                  if ch in msi_utils.get_sim_from_msim(msim).coords['c']]
+
+        sims = [msi_utils.get_sim_from_msim(self.msims[lname])
+                for lname in lnames]
+
+        sims = [spatial_image_utils.sim_sel_coords(sim,
+                {'t': [sim.coords['t'][it]
+                        for it in range(self.times_slider.value[0] + 1,
+                                        self.times_slider.value[1] + 1)]})
+                for sim in sims]
+
+        transform_key = 'affine_registered'\
+            if self.visualization_type_rbuttons.value == CHOICE_REGISTERED\
+            else 'affine_metadata'
+
+        return lnames, sims, transform_key
+
+
+    def get_fusion_records(self, mfuseds):
+        """
+        Function describing the fusion of each channel: its key in the
+        fusion cache, a key ignoring transform parameters, and the
+        transform parameters and output stack used. Allows to update
+        previous fusion results incrementally (see compute_fusion).
+
+        Identifying tiles not read from a file hashes their data,
+        which is therefore left to the function, e.g. to be called
+        within a background job.
+        """
+
+        layers = {l.name: l for l in self.input_layers}
+
+        fusion_inputs = dict()
+        for ch in self.reg_ch_picker.choices:
+
+            lnames, sims, transform_key = self.get_fusion_inputs(ch)
+
+            tiles = [(layers[lname],
+                      msi_utils.get_sim_from_msim(self.msims[lname]))
+                     if lname in layers else lname
+                     for lname in lnames]
+
+            fusion_inputs[ch] = (tiles, sims, transform_key)
+
+        def get_records():
+
+            fusion_records = dict()
+            for ch, (tiles, sims, transform_key) in fusion_inputs.items():
+
+                tile_ids = [tile if isinstance(tile, str)
+                            else _utils.get_tile_id(*tile)
+                            for tile in tiles]
+
+                fusion_records[ch] = fusion_utils.get_fusion_record(
+                    sims, tile_ids, transform_key, ch,
+                    msi_utils.get_sim_from_msim(mfuseds[ch]))
+
+            return fusion_records
+
+        return get_records
+
+
+    def run_fusion(self):
+        """
+        Fuse the loaded tiles, blocking until done.
+        """
+
+        stream = self.fusion_stream_checkbox.value
+        mfuseds = self.get_fused_msims(stream=stream)
+        fusion_records = self.get_fusion_records(mfuseds)()
+
+        with _utils.TemporarilyDisabledWidgets([self.container]),\
+            _utils.VisibleActivityDock(self.viewer):
+
+            fused_paths = list(self.compute_fusion(
+                mfuseds, fusion_records, stream=stream))
+
+        for ch, path in fused_paths:
+            self.add_fused_layer(ch, path)
+
+
+    def start_fusion(self):
+        """
+        Fuse the loaded tiles in a background thread. The layer of
+        each channel is added to the viewer as soon as it has been fused.
+        """
+
+        stream = self.fusion_stream_checkbox.value
+        mfuseds = self.get_fused_msims(stream=stream)
 
-            sims = [msi_utils.get_sim_from_msim(msim) for msim in msims]
+        # fusion records are determined within the job, keeping the viewer
+        # responsive while the data of in-memory layers is hashed
+        get_fusion_records = self.get_fusion_records(mfuseds)
 
-            sims = [spatial_image_utils.sim_sel_coords(sim,
-                    {'t': [sim.coords['t'][it]
-                            for it in range(self.times_slider.value[0] + 1,
-                                            self.times_slider.value[1] + 1)]})
-                    for sim in sims]
+        def job():
+            return self.compute_fusion(mfuseds, get_fusion_records(), stream)
 
-            fused = fusion.fuse(
-                sims,
-                transform_key='affine_registered'
-                if self.visualization_type_rbuttons.value == CHOICE_REGISTERED
-                else 'affine_metadata',
+        self.start_job(
+            job,
+            on_yielded=lambda ch_path: self.add_fused_layer(*ch_path),
             )
 
-            fused = fused.expand_dims({'c': [sims[0].coords['c'].values]})
 
-            mfused = msi_utils.get_msim_from_sim(fused, scale_factors=[])
+    def compute_fusion(self, mfuseds, fusion_records=None, stream=False):
+        """
+        Write all fused channels to zarr within a single dask computation,
+        such that independent channels are processed concurrently.
+        Each fused chunk is computed once and its downsampled versions
+        are derived from it while it's in memory.
+
+        Channels found in the fusion cache (given their fusion_records)
+        are not recomputed. If only the transform parameters of some tiles
+        changed since the previous fusion of a channel, only the chunks
+        touched by these tiles are recomputed.
 
-            tmp_fused_path = os.path.join(self.tmpdir.name, 'fused_%s.zarr' %ch)
+        With stream=True, the channels are instead fused one time point
+        at a time (see fusion_utils.stream_fusion_to_zarr), resuming
+        previously interrupted fusions.
 
-            with _utils.TemporarilyDisabledWidgets([self.container]),\
-                _utils.VisibleActivityDock(self.viewer),\
-                _utils.TqdmCallback(tqdm_class=_utils.progress,
-                                    desc='Fusing tiles of channel %s' %ch, bar_format=" "):
-                
-                mfused.to_zarr(tmp_fused_path)
+        Yields (channel, path) as soon as a channel has been written.
+        """
 
-            mfused = msi_utils.multiscale_spatial_image_from_zarr(tmp_fused_path)
+        # without records, results are stored but never found in the cache
+        if fusion_records is None:
+            fusion_records = {ch: {'key': uuid.uuid4().hex}
+                              for ch in mfuseds.keys()}
+
+        fusion_keys = {ch: record['key'] for ch, record in fusion_records.items()}
+
+        channels = []
+        for ch in mfuseds.keys():
+            cached_path = fusion_utils.get_cached_fusion_path(
+                fusion_keys[ch], self.cache_dir)
+            if cached_path is None:
+                channels.append(ch)
+            else:
+                self.fusion_records[ch] = dict(fusion_records[ch], path=cached_path)
+                yield ch, cached_path
+
+        paths = [fusion_utils.get_fusion_cache_path(fusion_keys[ch], self.cache_dir)
+                 for ch in channels]
+
+        if stream:
+            yield from self.stream_fusion(mfuseds, fusion_records, channels, paths)
+            fusion_utils.evict_fusion_cache(
+                self.cache_dir,
+                keep=[fusion_utils.get_fusion_cache_path(key, self.cache_dir)
+                      for key in fusion_keys.values()] +
+                     self.get_shown_fusion_paths())
+            return
 
-            fused_ch_layer_tuple = viewer_utils.create_image_layer_tuples_from_msim(
-                mfused,
-                colormap=None,
-                name_prefix='fused',
-            )[0]
+        # write into temporary locations first, such that
+        # interrupted writes never end up in the cache
+        writes = []
+        for ch, path in zip(channels, paths):
+
+            partial_path = path + '.partial'
+            if os.path.exists(partial_path):
+                shutil.rmtree(partial_path)
+
+            update_boxes = None
+            if ch in self.fusion_records:
+                update_boxes = fusion_utils.get_incremental_fusion_boxes(
+                    self.fusion_records[ch], fusion_records[ch])
+
+            if update_boxes is None:
+                writes.append(fusion_utils.multiscale_spatial_image_to_zarr(
+                    mfuseds[ch], partial_path, compute=False))
+            else:
+                # start from the previous result, which may be shown,
+                # sharing the files of the chunks which remain unchanged
+                fusion_utils.link_zarr_store(
+                    self.fusion_records[ch]['path'], partial_path)
+                writes.append(fusion_utils.update_multiscale_spatial_image_zarr(
+                    mfuseds[ch], partial_path, update_boxes, compute=False))
+
+        with _utils.progress(total=len(channels), desc='Fusing channels') as pbar:
+            for ich in _utils.compute_yielding(writes, scheduler=self.client):
+                if os.path.exists(paths[ich]):
+                    shutil.rmtree(paths[ich])
+                os.replace(paths[ich] + '.partial', paths[ich])
+                self.fusion_records[channels[ich]] = dict(
+                    fusion_records[channels[ich]], path=paths[ich])
+                pbar.set_description('Fused channel %s' %channels[ich])
+                pbar.update(1)
+                yield channels[ich], paths[ich]
+
+        fusion_utils.evict_fusion_cache(
+            self.cache_dir,
+            keep=[fusion_utils.get_fusion_cache_path(key, self.cache_dir)
+                  for key in fusion_keys.values()] +
+                 self.get_shown_fusion_paths())
+
+
+    def stream_fusion(self, mfuseds, fusion_records, channels, paths):
+        """
+        Fuse channels one after the other, one time point at a time.
+        Partial results are kept, such that an interrupted fusion
+        is resumed the next time the same inputs are fused.
 
-            fused_layer = self.viewer.add_image(fused_ch_layer_tuple[0], **fused_ch_layer_tuple[1])
-        
-            self.fused_layers.append(fused_layer)
+        Yields (channel, path) as soon as a channel has been written.
+        """
+
+        n_t = {ch: len(msi_utils.get_sim_from_msim(mfuseds[ch]).coords['t'])
+               for ch in channels}
+
+        with _utils.progress(total=sum(n_t.values()),
+                             desc='Fusing time points') as pbar:
+
+            for ch, path in zip(channels, paths):
+
+                _, sims, transform_key = self.get_fusion_inputs(ch)
+
+                for time_indices in fusion_utils.stream_fusion_to_zarr(
+                        sims, transform_key, path + '.partial',
+                        scheduler=self.client):
+                    pbar.set_description('Fused channel %s, time point %s'
+                                         %(ch, time_indices[-1]))
+                    pbar.update(len(time_indices))
+
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+                os.replace(path + '.partial', path)
+                self.fusion_records[ch] = dict(fusion_records[ch], path=path)
+                yield ch, path
+
+
+    def add_fused_layer(self, ch, path):
+
+        mfused = msi_utils.multiscale_spatial_image_from_zarr(path)
+
+        fused_ch_layer_tuple = viewer_utils.create_image_layer_tuples_from_msim(
+            mfused,
+            colormap=None,
+            name_prefix='fused',
+        )[0]
+
+        fused_layer = self.viewer.add_image(fused_ch_layer_tuple[0], **fused_ch_layer_tuple[1])
+        fused_layer.metadata['fusion_path'] = path
+    
+        self.fused_layers.append(fused_layer)
+
+
+    def get_shown_fusion_paths(self):
+        """
+        Fusion cache paths of the fused layers still shown in the viewer,
+        which need to be kept when evicting the cache.
+        """
+
+        return [l.metadata['fusion_path'] for l in self.fused_layers
+                if l in self.viewer.layers and 'fusion_path' in l.metadata]
 
 
     def reset(self):
             
+        self.affine_lut = dict()
+        self.shown_transformations = None
+        self.fusion_records = dict()
         self.msims = {}
         self.params = dict()
         self.reg_ch_picker.choices = ()
@@ -371,6 +1164,8 @@ class StitcherQWidget(QWidget):
                     sw.enabled = True
             w.enabled = True
 
+        self.reg_binning_z.enabled = 'z' in reference_sim.dims
+
 
     def load_layers_all(self):
 
@@ -395,39 +1190,123 @@ class StitcherQWidget(QWidget):
         self.load_layers([l for l in self.viewer.layers.selection])
 
 
+    def add_layers_new(self):
+        """
+        Add the layers which are not loaded yet and reload the loaded
+        layers whose data changed in size (e.g. gained timepoints).
+        """
+
+        if not len(self.input_layers):
+            return self.load_layers_all()
+
+        layers = []
+        for l in self.viewer.layers:
+            if l in self.fused_layers: continue
+            if l.name not in self.msims:
+                layers.append(l)
+                continue
+            ldata = l.data[0] if l.multiscale else l.data
+            if np.prod(ldata.shape) != msi_utils.get_sim_from_msim(
+                    self.msims[l.name]).data.size:
+                layers.append(l)
+
+        if not len(layers):
+            notifications.notification_manager.receive_info(
+                'No new layers or timepoints.')
+            return
+
+        self.add_layers(layers)
+
+
+    def add_layers(self, layers):
+        """
+        Load layers in addition to the loaded ones (replacing loaded
+        layers of the same name), keeping registration results.
+        """
+
+        msims = self.layers_to_msims(layers)
+        if msims is None:
+            return
+
+        self.input_layers = [l for l in self.input_layers if l not in layers] + \
+            [l for l in layers]
+        self.layers_selection.choices = sorted([l.name for l in self.input_layers])
+
+        self.msims.update({l.name: msim for l, msim in zip(layers, msims)})
+
+        # reapply the transforms of already registered views
+        for l in layers:
+            view = _utils.get_str_unique_to_view_from_layer_name(l.name)
+            if self.params.get(view) is not None:
+                msi_utils.set_affine_transform(
+                    self.msims[l.name], self.params[view],
+                    transform_key='affine_registered',
+                    base_transform_key='affine_metadata')
+
+        self.link_channel_layers(self.input_layers)
+
+        self.load_metadata()
+        self.update_affine_lut()
+        self.update_viewer_transformations()
+
+
     def load_layers(self, layers):
 
         self.reset()
+
+        msims = self.layers_to_msims(layers)
+        if msims is None:
+            self.layers_selection.choices = []
+            return
+
         self.layers_selection.choices = sorted([l.name for l in layers])
 
         self.input_layers = [l for l in layers]
 
-        # load in layers as sims
-        for l in layers:
+        self.msims = {l.name: msim for l, msim in zip(layers, msims)}
 
-            msim = viewer_utils.image_layer_to_msim(l, self.viewer)
-            
+        if len(layers):
+            self.link_channel_layers(layers)
+
+        self.load_metadata()
+        self.update_affine_lut()
+
+
+    def layers_to_msims(self, layers):
+        """
+        Load layers as msims concurrently. Returns None
+        if a layer cannot be loaded.
+        """
+
+        registration_binning = {
+            'z': self.reg_binning_z.value,
+            'y': self.reg_binning_xy.value,
+            'x': self.reg_binning_xy.value}
+
+        def layer_to_msim(l):
+            msim = viewer_utils.image_layer_to_msim(
+                l, self.viewer, registration_binning=registration_binning)
+            if 'c' in msim['scale0/image'].dims:
+                return msim
+            return msi_utils.ensure_time_dim(msim)
+
+        # load in layers as msims concurrently
+        with ThreadPoolExecutor() as executor,\
+            _utils.progress(total=len(layers), desc='Loading layers') as pbar:
+
+            msims = []
+            for msim in executor.map(layer_to_msim, layers):
+                msims.append(msim)
+                pbar.update(1)
+
+        for l, msim in zip(layers, msims):
             if 'c' in msim['scale0/image'].dims:
                 notifications.notification_manager.receive_info(
                     "Layer '%s' has more than one channel.Consider splitting the stack (right click on layer -> 'Split Stack')." %l.name
                 )
-                self.layers_selection.choices = []
-                self.reset()
-                return
-            
-            msim = msi_utils.ensure_time_dim(msim)
-            self.msims[l.name] = msim
-
-        sims = [msi_utils.get_sim_from_msim(msim) for l.name, msim in self.msims.items()]
-
-        number_of_channels = len(np.unique([
-            _utils.get_str_unique_to_ch_from_sim_coords(sim.coords)
-                for sim in sims]))
-        
-        if len(layers) and number_of_channels > 1:
-            self.link_channel_layers(layers)
+                return None
 
-        self.load_metadata()
+        return msims
 
 
     def link_channel_layers(self, layers):
@@ -438,20 +1317,26 @@ class StitcherQWidget(QWidget):
         sims = {l.name: msi_utils.get_sim_from_msim(self.msims[l.name])
                 for l in layers}
 
-        channels = [_utils.get_str_unique_to_ch_from_sim_coords(sim.coords) for sim in sims.values()]
-        for ch in channels:
-            ch_layers = list(_utils.filter_layers(layers, sims, ch=ch))
+        _, layers_by_ch = _utils.index_layers_by_view_and_ch(layers, sims)
 
-            if len(ch_layers):
-                link_layers(ch_layers, ('contrast_limits', 'visible'))
+        # nothing to link for a single channel
+        if len(layers_by_ch) < 2:
+            return
+
+        for ch_layers in layers_by_ch.values():
+            link_layers(ch_layers, ('contrast_limits', 'visible'))
 
 
     def __del__(self):
 
         print('Deleting napari-stitcher widget')
 
+        self.cancel_job()
+        self.disconnect_cluster()
+
         # clean up callbacks
-        self.viewer.dims.events.disconnect(self.update_viewer_transformations)
+        self.viewer.dims.events.current_step.disconnect(
+            self.schedule_viewer_transformations_update)
 
 
 if __name__ == "__main__":
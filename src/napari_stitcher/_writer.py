@@ -8,13 +8,20 @@ Replace code below according to your needs.
 """
 from __future__ import annotations
 
+import itertools
+import tempfile
+from pathlib import Path
+
 import numpy as np
-import xarray as xr
+import dask
+import dask.array as da
+import tifffile
+import zarr
+from numcodecs import Blosc
 
-import warnings
 from typing import TYPE_CHECKING, Any, List, Sequence, Tuple, Union
 
-from multiview_stitcher import spatial_image_utils, io
+from multiview_stitcher import spatial_image_utils
 
 if TYPE_CHECKING:
     DataType = Union[Any, Sequence[Any]]
@@ -22,12 +29,12 @@ if TYPE_CHECKING:
 
 
 def write_single_image(path: str, data: Any, meta: dict) -> List[str]:
-    """Writes a single image layer"""
+    """Writes a single image layer (.tif or OME-Zarr)"""
 
-    # implement your writer logic here ...
+    if path.endswith('.zarr'):
+        return write_multiple_ome_zarr(path, [(data, meta, 'image')])
 
-    # return path to any file(s) that were successfully written
-    return [path]
+    return write_multiple(path, [(data, meta, 'image')])
 
 
 def write_multiple(path: str, data: List[FullLayerData]) -> List[str]:
@@ -37,12 +44,49 @@ def write_multiple(path: str, data: List[FullLayerData]) -> List[str]:
     FullLayerData: 3-tuple with (data, meta, layer_type)
     """
 
-    # implement your writer logic here ...
-
     if not path.endswith('.tif'):
         raise ValueError('Only .tif file saving is supported.')
     
-    sims = [d[0][0] for d in data]
+    sims = [layer_sims[0] for layer_sims in get_sims_from_layer_data(data)]
+
+    save_sims_as_tif(path, sims)
+
+    # return path to any file(s) that were successfully written
+    return [path]
+
+
+def write_multiple_ome_zarr(path: str, data: List[FullLayerData]) -> List[str]:
+    """
+    Writes fused images as channels of a multiscale OME-Zarr image.
+    Ignores transform_keys.
+    FullLayerData: 3-tuple with (data, meta, layer_type)
+    """
+
+    if not path.endswith('.zarr'):
+        raise ValueError('OME-Zarr files need to end with .zarr.')
+
+    save_sims_as_ome_zarr(path, get_sims_from_layer_data(data))
+
+    # return path to any file(s) that were successfully written
+    return [path]
+
+
+def get_sims_from_layer_data(data):
+    """
+    Get the (multiscale) spatial images of each layer,
+    making sure that all layers occupy the same space.
+
+    Returns
+    -------
+    list of list of SpatialImage
+        Scales of each layer
+    """
+
+    # multiscale layer data (e.g. napari's MultiScaleData)
+    # is a sequence of scales rather than an image
+    layers_sims = [[d[0]] if hasattr(d[0], 'dims') else list(d[0])
+                   for d in data]
+    sims = [layer_sims[0] for layer_sims in layers_sims]
 
     spacings = [spatial_image_utils.get_spacing_from_sim(sim, asarray=True) for sim in sims]
     origins = [spatial_image_utils.get_origin_from_sim(sim, asarray=True) for sim in sims]
@@ -54,12 +98,293 @@ def write_multiple(path: str, data: List[FullLayerData]) -> List[str]:
            not np.allclose(shapes[isim], shapes[0]):
             raise ValueError('Image saving: Data of all layers must occupy the same space.')
 
-    # suppress pandas future warning occuring within xarray.concat
-    with warnings.catch_warnings():
-        warnings.simplefilter(action='ignore', category=FutureWarning)
-        sim_to_write = xr.concat([sim for sim in sims], dim='c')
+    return layers_sims
 
-    io.save_sim_as_tif(path, sim_to_write)
 
-    # return path to any file(s) that were successfully written
-    return [path]
+def save_sims_as_ome_zarr(
+        path,
+        layers_sims,
+        compression='zstd',
+        compression_level=5,
+        scheduler=None,
+        ):
+    """
+    Write (multiscale) channel images into an OME-Zarr (NGFF v0.4) image.
+
+    The scales of all channels are written in parallel
+    within a single dask computation.
+
+    Parameters
+    ----------
+    path : str
+    layers_sims : list of list of SpatialImage
+        Scales of each channel image. All channels need to
+        occupy the same space.
+    compression : str, optional
+        Blosc compressor, e.g. 'zstd' or 'lz4', or None for no
+        compression, by default 'zstd'
+    compression_level : int, optional
+        Compression level, by default 5
+    scheduler : optional
+        Dask scheduler used for computing the images,
+        by default the current dask scheduler
+    """
+
+    n_scales = min(len(layer_sims) for layer_sims in layers_sims)
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(layers_sims[0][0])
+
+    if compression is None:
+        compressor = None
+    else:
+        compressor = Blosc(
+            cname=compression, clevel=compression_level, shuffle=Blosc.BITSHUFFLE)
+
+    root = zarr.open_group(path, mode='w')
+
+    datasets, sources, targets = [], [], []
+    for iscale in range(n_scales):
+
+        scale_sims = [layer_sims[iscale] for layer_sims in layers_sims]
+
+        # stack channels lazily into an array of shape (t, c, [z,] y, x)
+        arrays = []
+        for sim in scale_sims:
+            if 't' not in sim.dims:
+                sim = sim.expand_dims('t')
+            if 'c' in sim.dims:
+                sim = sim.isel(c=0)
+            arrays.append(sim.transpose(*(['t'] + spatial_dims)).data)
+
+        array = da.stack([da.asarray(a) for a in arrays], axis=1)
+
+        # regular chunks aligned with the zarr chunks,
+        # such that chunks can be written in parallel
+        chunks = (1, 1) + tuple(max(c) for c in array.chunks[2:])
+        array = array.rechunk(chunks)
+
+        targets.append(root.create_dataset(
+            str(iscale),
+            shape=array.shape,
+            chunks=chunks,
+            dtype=array.dtype,
+            compressor=compressor,
+            dimension_separator='/',
+            overwrite=True,
+        ))
+        sources.append(array)
+
+        spacing = spatial_image_utils.get_spacing_from_sim(scale_sims[0])
+        origin = spatial_image_utils.get_origin_from_sim(scale_sims[0])
+
+        datasets.append({
+            'path': str(iscale),
+            'coordinateTransformations': [
+                {'type': 'scale',
+                 'scale': [1., 1.] + [float(spacing[dim]) for dim in spatial_dims]},
+                {'type': 'translation',
+                 'translation': [0., 0.] + [float(origin[dim]) for dim in spatial_dims]},
+            ]})
+
+    root.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': Path(path).stem,
+        'axes': [{'name': 't', 'type': 'time'},
+                 {'name': 'c', 'type': 'channel'}] +\
+                [{'name': dim, 'type': 'space', 'unit': 'micrometer'}
+                 for dim in spatial_dims],
+        'datasets': datasets,
+    }]
+
+    root.attrs['omero'] = {
+        'channels': [
+            {'label': str(layer_sims[0].coords['c'].values.flatten()[0])
+                      if 'c' in layer_sims[0].coords else str(ich)}
+            for ich, layer_sims in enumerate(layers_sims)]
+    }
+
+    da.store(sources, targets, lock=False, scheduler=scheduler)
+
+    zarr.consolidate_metadata(path)
+
+    return
+
+
+def save_sims_as_tif(
+        path,
+        sims,
+        memory_budget=2 * 1024 ** 3,
+        tile=(256, 256),
+        compression=None,
+        scheduler=None,
+        ):
+    """
+    Stream (channel) images occupying the same space into a
+    tiled OME BigTIFF file.
+
+    The data is computed in slabs of z-planes (or of rows, if a single
+    plane exceeds the memory budget) aligned to the dask chunks and
+    written tile by tile, such that the images are never concatenated
+    or loaded into memory as a whole.
+
+    Parameters
+    ----------
+    path : str
+    sims : list of SpatialImage
+        One image per channel, all with the same shape, spacing and origin
+    memory_budget : int, optional
+        Maximum number of bytes computed at once, by default 2 GB
+    tile : tuple of int, optional
+        Tile shape (multiples of 16), by default (256, 256)
+    compression : str, optional
+        Compression passed to tifffile, e.g. 'zlib' or 'zstd',
+        by default None
+    scheduler : optional
+        Dask scheduler used for computing the slabs,
+        by default the current dask scheduler
+    """
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+    spacing = spatial_image_utils.get_spacing_from_sim(sims[0])
+
+    # arrays of shape (t, z, y, x) or (t, y, x)
+    arrays = []
+    for sim in sims:
+        if 't' not in sim.dims:
+            sim = sim.expand_dims('t')
+        if 'c' in sim.dims:
+            sim = sim.isel(c=0)
+        arrays.append(sim.transpose(*(['t'] + spatial_dims)).data)
+
+    channels = [str(sim.coords['c'].values.flatten()[0])
+                if 'c' in sim.coords else str(isim)
+                for isim, sim in enumerate(sims)]
+
+    n_t = arrays[0].shape[0]
+    n_c = len(arrays)
+    plane_shape = arrays[0].shape[-2:]
+    n_z = arrays[0].shape[1] if 'z' in spatial_dims else 1
+
+    # leave out singleton time and channel dimensions
+    shape, axes = [], ''
+    for axis, n in zip('TC', [n_t, n_c]):
+        if n > 1:
+            shape.append(n)
+            axes += axis
+    if 'z' in spatial_dims:
+        shape.append(n_z)
+        axes += 'Z'
+    shape += list(plane_shape)
+    axes += 'YX'
+
+    metadata = {
+        'axes': axes,
+        'Channel': {'Name': channels},
+    }
+    for dim in spatial_dims:
+        metadata['PhysicalSize%s' %dim.upper()] = spacing[dim]
+        metadata['PhysicalSize%sUnit' %dim.upper()] = 'µm'
+
+    with tifffile.TiffWriter(path, bigtiff=True, ome=True) as tif:
+        tif.write(
+            _iterate_tiles(arrays, n_z, tile, memory_budget, scheduler),
+            shape=tuple(shape),
+            dtype=arrays[0].dtype,
+            tile=tile,
+            compression=compression,
+            resolution=(1. / spacing['x'], 1. / spacing['y']),
+            resolutionunit='MICROMETER',
+            metadata=metadata,
+        )
+
+    return
+
+
+def _iterate_tiles(arrays, n_z, tile, memory_budget, scheduler=None):
+    """
+    Yield the tiles of all planes in TCZYX order, computing
+    slabs of the dask arrays within the given memory budget.
+
+    Slabs consist of whole dask chunks, such that each chunk is
+    computed only once. If a single chunk of z-planes exceeds the
+    memory budget, it is computed in strips of whole chunks along y,
+    which are gathered in a temporary file before writing its planes.
+    """
+
+    plane_shape = arrays[0].shape[-2:]
+    row_nbytes = plane_shape[1] * arrays[0].dtype.itemsize
+    plane_nbytes = plane_shape[0] * row_nbytes
+
+    for it, array in itertools.product(range(arrays[0].shape[0]), arrays):
+
+        field = array[it]
+        if field.ndim == 2:
+            field = field[None]
+
+        z_chunks, y_chunks = _get_chunks(field)[:2]
+
+        for z_start, z_stop in _group_chunks(
+                z_chunks, plane_nbytes, memory_budget):
+
+            if (z_stop - z_start) * plane_nbytes <= memory_budget:
+                slab = _compute(field[z_start: z_stop], scheduler)
+                for plane in slab:
+                    yield from _iterate_plane_tiles(plane, tile)
+                continue
+
+            # a single chunk of z-planes exceeds the memory budget
+            with tempfile.TemporaryFile() as f:
+                slab = np.memmap(
+                    f, dtype=field.dtype, mode='w+',
+                    shape=(z_stop - z_start,) + tuple(plane_shape))
+                for y_start, y_stop in _group_chunks(
+                        y_chunks, (z_stop - z_start) * row_nbytes,
+                        memory_budget):
+                    slab[:, y_start: y_stop] = _compute(
+                        field[z_start: z_stop, y_start: y_stop], scheduler)
+                for plane in slab:
+                    yield from _iterate_plane_tiles(plane, tile)
+                del slab
+
+
+def _get_chunks(array):
+    """
+    Chunks of a dask array or, for other arrays, chunks of size one.
+    """
+    if isinstance(array, dask.array.Array):
+        return array.chunks
+    return tuple((1,) * n for n in array.shape)
+
+
+def _group_chunks(chunks, nbytes_per_item, memory_budget):
+    """
+    Group consecutive chunks along an axis into slabs of at most
+    memory_budget bytes (at least one chunk per slab).
+
+    Returns
+    -------
+    list of tuple of int
+        Start and stop of each slab
+    """
+    slabs = []
+    start, stop = 0, 0
+    for chunk in chunks:
+        if stop > start and \
+                (stop + chunk - start) * nbytes_per_item > memory_budget:
+            slabs.append((start, stop))
+            start = stop
+        stop += chunk
+    if stop > start:
+        slabs.append((start, stop))
+    return slabs
+
+
+def _iterate_plane_tiles(plane, tile):
+    for y in range(0, plane.shape[0], tile[0]):
+        for x in range(0, plane.shape[1], tile[1]):
+            yield plane[y: y + tile[0], x: x + tile[1]]
+
+
+def _compute(array, scheduler=None):
+    if isinstance(array, dask.array.Array):
+        return array.compute(scheduler=scheduler)
+    return np.asarray(array)
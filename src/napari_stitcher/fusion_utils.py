@@ -0,0 +1,724 @@
+"""
+Fusion helpers for napari-stitcher.
+"""
+
+import os
+import json
+import math
+import itertools
+import shutil
+import hashlib
+import time
+
+import numpy as np
+import zarr
+import dask.array as da
+from dask import delayed
+import spatial_image as si
+
+from multiview_stitcher import (
+    fusion,
+    msi_utils,
+    param_utils,
+    spatial_image_utils,
+    )
+
+from napari_stitcher import _utils
+
+
+# environment variable configuring the size of the fusion cache
+FUSION_CACHE_SIZE_ENV = 'NAPARI_STITCHER_CACHE_SIZE'
+
+# default maximal size of the fusion cache in bytes
+DEFAULT_FUSION_CACHE_SIZE = 20 * 1024 ** 3
+
+# seconds during which partial fusion results (being written or to be
+# resumed) are not evicted from the fusion cache
+FUSION_PARTIAL_GRACE_PERIOD = 60 * 60
+
+# zarr attribute listing the time indices written by streaming fusion
+FUSED_TIME_INDICES_ATTR = 'napari_stitcher_fused_time_indices'
+
+
+def multiscale_spatial_image_to_zarr(msim, path, compute=True):
+    """
+    Write a MultiscaleSpatialImage to zarr.
+
+    In contrast to datatree's `to_zarr`, the data of all scales is
+    written within a single computation. With compute=False a delayed
+    object is returned, such that several images can be written
+    concurrently on the same dask scheduler.
+
+    Parameters
+    ----------
+    msim : MultiscaleSpatialImage
+    path : str
+        Path of the zarr store to create
+    compute : bool, optional
+        Whether to write the data immediately, by default True
+
+    Returns
+    -------
+    dask.delayed.Delayed or None
+        Delayed write if compute=False
+    """
+
+    store = _create_multiscale_spatial_image_zarr(msim, path)
+    scale_keys = msi_utils.get_sorted_scale_keys(msim)
+
+    writes = da.store(
+        [msim[scale_key]['image'].data for scale_key in scale_keys],
+        [store[scale_key]['image'] for scale_key in scale_keys],
+        lock=False,
+        compute=False,
+    )
+
+    write = delayed(_consolidate_metadata)(writes, path)
+
+    if compute:
+        write.compute()
+        return None
+
+    return write
+
+
+def _create_multiscale_spatial_image_zarr(msim, path):
+    """
+    Create the zarr groups and arrays of a MultiscaleSpatialImage
+    including all metadata, without writing the image data.
+    """
+
+    # workaround for a bug in xarray/zarr, see
+    # msi_utils.multiscale_spatial_image_to_zarr
+    for scale_key in msi_utils.get_sorted_scale_keys(msim):
+        if 'chunks' in msim[scale_key]['image'].encoding:
+            del msim[scale_key]['image'].encoding['chunks']
+
+    # the data writes returned by xarray are discarded, as
+    # separately computing them would compute the data once per scale
+    mode = 'w'
+    for node in msim.subtree:
+        node.ds.to_zarr(
+            path,
+            group=node.path,
+            mode=mode,
+            consolidated=False,
+            compute=False,
+        )
+        mode = 'a'
+
+    return zarr.open_group(path, mode='r+')
+
+
+def _consolidate_metadata(writes, path):
+    zarr.consolidate_metadata(path)
+
+
+def get_fusion_stack_properties(sims, transform_key):
+    """
+    Output stack containing all (transformed) views over all timepoints,
+    as determined by `fusion.fuse`.
+    """
+
+    params = [param_utils.invert_xparams(
+                spatial_image_utils.get_affine_from_sim(sim, transform_key))
+              for sim in sims]
+
+    return fusion.calc_fusion_stack_properties(
+        sims,
+        params=params,
+        spacing=spatial_image_utils.get_spacing_from_sim(sims[0]),
+        mode='union',
+    )
+
+
+def get_fusion_template(sims, transform_key, output_stack_properties,
+                        output_chunksize=512):
+    """
+    Lazy placeholder with the layout of the fusion of a channel over all
+    timepoints (see `fuse_time_indices`), without building the fusion graph.
+    """
+
+    sdims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+    t_coords = sims[0].coords['t'].values
+
+    data = da.zeros(
+        [len(t_coords)] + [output_stack_properties['shape'][dim] for dim in sdims],
+        dtype=sims[0].dtype,
+        chunks=[1] + [output_chunksize] * len(sdims),
+    )
+
+    template = si.to_spatial_image(
+        data,
+        dims=['t'] + sdims,
+        scale=output_stack_properties['spacing'],
+        translation=output_stack_properties['origin'],
+        t_coords=t_coords,
+    )
+
+    template = template.expand_dims({'c': [sims[0].coords['c'].values]})
+
+    spatial_image_utils.set_sim_affine(
+        template,
+        param_utils.identity_transform(len(sdims)),
+        transform_key,
+    )
+
+    return template
+
+
+def fuse_time_indices(sims, transform_key, output_stack_properties,
+                      time_indices, output_chunksize=512):
+    """
+    Lazily fuse a channel for a subset of its timepoints into the given
+    output stack.
+    """
+
+    ssims = []
+    for sim in sims:
+        # sim_sel_coords modifies the transforms in place, which
+        # are shared between shallow copies and may be a xr.Dataset
+        sim = sim.copy(deep=False)
+        sim.attrs['transforms'] = dict(sim.attrs['transforms'])
+        ssims.append(spatial_image_utils.sim_sel_coords(
+            sim, {'t': [sim.coords['t'][it] for it in time_indices]}))
+
+    fused = fusion.fuse(
+        ssims,
+        transform_key=transform_key,
+        output_stack_properties=output_stack_properties,
+        output_chunksize=output_chunksize,
+    )
+
+    return fused.expand_dims({'c': [sims[0].coords['c'].values]})
+
+
+def stream_fusion_to_zarr(
+    sims,
+    transform_key,
+    path,
+    output_stack_properties=None,
+    output_chunksize=512,
+    timepoint_batch_size=1,
+    n_in_flight=2,
+    scheduler=None,
+):
+    """
+    Fuse a channel and write it to zarr one batch of timepoints at a time.
+
+    In contrast to writing the fusion of all timepoints within a single
+    computation, the size of the dask graphs and the memory used remain
+    bounded for long time lapses: the graph of a batch is only built once
+    one of the n_in_flight running batches has been written.
+
+    The time indices written so far are stored in the zarr attributes,
+    such that an interrupted fusion is resumed when called again with
+    the same path. The metadata is consolidated once all timepoints
+    have been written.
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+        Views of a single channel
+    transform_key : str
+    path : str
+        Path of the zarr store to write into
+    output_stack_properties : dict, optional
+        By default, the stack containing all views over all timepoints
+    output_chunksize : int, optional
+        By default 512
+    timepoint_batch_size : int, optional
+        Number of timepoints fused within a computation, by default 1
+    n_in_flight : int, optional
+        Maximal number of batches computed concurrently, by default 2
+    scheduler : optional
+        Dask scheduler used to write the batches, e.g. a distributed
+        Client. By default the current dask scheduler.
+
+    Yields
+    ------
+    list of int
+        Time indices written by each batch. When resuming, the time
+        indices written previously are yielded first.
+    """
+
+    if output_stack_properties is None:
+        output_stack_properties = get_fusion_stack_properties(sims, transform_key)
+
+    template = get_fusion_template(
+        sims, transform_key, output_stack_properties, output_chunksize)
+    mtemplate = msi_utils.get_msim_from_sim(template, scale_factors=None)
+    scale_keys = msi_utils.get_sorted_scale_keys(mtemplate)
+
+    store = None
+    if os.path.exists(path):
+        store = zarr.open_group(path, mode='r+')
+        if FUSED_TIME_INDICES_ATTR not in store.attrs:
+            store = None
+
+    if store is None:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        store = _create_multiscale_spatial_image_zarr(mtemplate, path)
+        store.attrs[FUSED_TIME_INDICES_ATTR] = []
+
+    written = set(store.attrs[FUSED_TIME_INDICES_ATTR])
+    if len(written):
+        yield sorted(written)
+
+    n_t = len(template.coords['t'])
+    batches = [list(range(it, min(it + timepoint_batch_size, n_t)))
+               for it in range(0, n_t, timepoint_batch_size)]
+    batches = [batch for batch in batches if not written.issuperset(batch)]
+
+    def batch_writes():
+        for batch in batches:
+
+            mfused = msi_utils.get_msim_from_sim(
+                fuse_time_indices(sims, transform_key, output_stack_properties,
+                                  batch, output_chunksize),
+                scale_factors=None)
+
+            yield da.store(
+                [mfused[scale_key]['image'].data for scale_key in scale_keys],
+                [store[scale_key]['image'] for scale_key in scale_keys],
+                regions=[(slice(batch[0], batch[-1] + 1),)] * len(scale_keys),
+                lock=False,
+                compute=False,
+            )
+
+    for ibatch in _utils.compute_bounded(
+            batch_writes(), n_in_flight=n_in_flight, scheduler=scheduler):
+        written.update(batches[ibatch])
+        store.attrs[FUSED_TIME_INDICES_ATTR] = sorted(written)
+        yield batches[ibatch]
+
+    zarr.consolidate_metadata(path)
+
+
+def get_fusion_cache_dir():
+    """
+    Directory in which fused images are cached, by default
+    ~/.cache/napari-stitcher/fusion (see `_utils.get_cache_dir`).
+    """
+
+    return _utils.get_cache_dir('fusion')
+
+
+def get_fusion_cache_size():
+    """
+    Maximal size of the fusion cache in bytes. Configured by the
+    environment variable NAPARI_STITCHER_CACHE_SIZE, by default 20 GB.
+    """
+
+    return int(os.environ.get(FUSION_CACHE_SIZE_ENV, DEFAULT_FUSION_CACHE_SIZE))
+
+
+def get_fusion_key(sims, tile_ids, transform_key, channel):
+    """
+    Hash identifying the fusion of a channel given its input tiles,
+    their time range and transform parameters.
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+        Input tiles (with the time range to fuse)
+    tile_ids : list of str or dict
+        Identifiers of the input tiles, see `_utils.get_tile_id`
+    transform_key : str
+        Transform parameters to consider. If None, the key
+        doesn't depend on transform parameters.
+    channel : str
+
+    Returns
+    -------
+    str
+    """
+
+    h = hashlib.sha256()
+
+    h.update(json.dumps({
+        'tile_ids': [str(tile_id) for tile_id in tile_ids],
+        'transform_key': transform_key,
+        'channel': str(channel),
+    }).encode())
+
+    for sim in sims:
+        h.update(json.dumps({
+            't': [str(t) for t in np.atleast_1d(sim.coords['t'].values)]
+                 if 't' in sim.coords else None,
+            'shape': [int(s) for s in sim.shape],
+            'dtype': str(sim.dtype),
+            'spacing': {dim: float(s) for dim, s in
+                        spatial_image_utils.get_spacing_from_sim(sim).items()},
+            'origin': {dim: float(o) for dim, o in
+                       spatial_image_utils.get_origin_from_sim(sim).items()},
+        }).encode())
+        if transform_key is not None:
+            h.update(np.ascontiguousarray(
+                spatial_image_utils.get_affine_from_sim(sim, transform_key),
+                dtype=np.float64).round(decimals=9).tobytes())
+
+    return h.hexdigest()[:32]
+
+
+def get_fusion_cache_path(key, cache_dir):
+    return os.path.join(cache_dir, '%s.zarr' %key)
+
+
+def get_cached_fusion_path(key, cache_dir):
+    """
+    Path of a cached fusion result or None if not cached.
+    Marks the result as recently used.
+    """
+
+    path = get_fusion_cache_path(key, cache_dir)
+
+    if not os.path.exists(os.path.join(path, '.zmetadata')):
+        return None
+
+    os.utime(path)
+
+    return path
+
+
+def evict_fusion_cache(cache_dir, max_size=None, keep=()):
+    """
+    Remove the least recently used fusion results
+    until the cache is smaller than max_size.
+
+    Partial results left by interrupted fusions ('.zarr.partial') count
+    towards the cache size and are removed in the same order, unless
+    they have been written to within `FUSION_PARTIAL_GRACE_PERIOD`.
+
+    Parameters
+    ----------
+    cache_dir : str
+    max_size : int, optional
+        Maximal size in bytes, by default `get_fusion_cache_size()`
+    keep : list of str, optional
+        Paths that are not removed, by default ()
+    """
+
+    if max_size is None:
+        max_size = get_fusion_cache_size()
+
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+               if name.endswith('.zarr') or name.endswith('.zarr.partial')]
+
+    sizes = {path: _get_dir_size(path) for path in entries}
+
+    # partial results are written to without touching their folder
+    mtimes = {path: _get_last_modified(path) if path.endswith('.partial')
+                    else os.path.getmtime(path)
+              for path in entries}
+
+    total_size = sum(sizes.values())
+    for path in sorted(entries, key=mtimes.get):
+        if total_size <= max_size:
+            break
+        if path in keep:
+            continue
+        if path.endswith('.partial') and \
+                time.time() - mtimes[path] < FUSION_PARTIAL_GRACE_PERIOD:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= sizes[path]
+
+    return
+
+
+def _get_last_modified(path):
+    return max([os.path.getmtime(root) for root, _, _ in os.walk(path)] +
+               [os.path.getmtime(os.path.join(root, f))
+                for root, _, files in os.walk(path) for f in files])
+
+
+def _get_dir_size(path):
+    # files hardlinked between entries (see `link_zarr_store`)
+    # are shared out between them
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            stat = os.stat(os.path.join(root, f))
+            size += stat.st_size / max(stat.st_nlink, 1)
+    return int(size)
+
+
+def link_zarr_store(path, new_path):
+    """
+    Copy a zarr store by hardlinking its files (copying them where
+    hardlinks aren't supported). zarr writes chunks into new files
+    which replace the links, such that updating the chunks of the copy
+    (see `update_multiscale_spatial_image_zarr`) leaves the original
+    store untouched.
+    """
+
+    def link(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    shutil.copytree(path, new_path, copy_function=link)
+
+
+def get_fusion_record(sims, tile_ids, transform_key, channel, fused_sim):
+    """
+    Describe a fusion such that it can later be updated incrementally
+    (see `get_incremental_fusion_boxes`).
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+        Input tiles (with the time range to fuse)
+    tile_ids : list of str or dict
+    transform_key : str
+    channel : str
+    fused_sim : SpatialImage
+        (Lazy) fusion result
+
+    Returns
+    -------
+    dict
+    """
+
+    return {
+        'key': get_fusion_key(sims, tile_ids, transform_key, channel),
+        'base_key': get_fusion_key(sims, tile_ids, None, channel),
+        'sims': sims,
+        'params': [_get_params_over_time(sim, transform_key) for sim in sims],
+        'output_stack_properties': {
+            'shape': spatial_image_utils.get_shape_from_sim(fused_sim, asarray=True),
+            'spacing': spatial_image_utils.get_spacing_from_sim(fused_sim, asarray=True),
+            'origin': spatial_image_utils.get_origin_from_sim(fused_sim, asarray=True),
+        },
+        'chunks': [fused_sim.chunks[fused_sim.dims.index(dim)]
+                   for dim in spatial_image_utils.get_spatial_dims_from_sim(fused_sim)],
+    }
+
+
+def get_incremental_fusion_boxes(previous_record, record, max_fraction=0.5):
+    """
+    Determine whether a previous fusion result can be updated instead
+    of fusing from scratch. This is the case if only transform parameters
+    changed and the output stack remained the same.
+
+    Parameters
+    ----------
+    previous_record : dict
+        Record of the previous fusion including its 'path'
+    record : dict
+        Record of the new fusion
+    max_fraction : float, optional
+        Maximal fraction of changed output chunks, by default 0.5
+
+    Returns
+    -------
+    dict or None
+        Bounding boxes of the changed tiles (before and after the change)
+        for each time index, None if a full fusion is required
+    """
+
+    if previous_record['base_key'] != record['base_key']:
+        return None
+
+    if 'path' not in previous_record or not os.path.exists(
+            os.path.join(previous_record['path'], '.zmetadata')):
+        return None
+
+    for prop in ['shape', 'spacing', 'origin']:
+        if not np.allclose(previous_record['output_stack_properties'][prop],
+                           record['output_stack_properties'][prop]):
+            return None
+
+    boxes = get_changed_tile_boxes(
+        record['sims'], previous_record['params'], record['params'])
+
+    # fraction of output chunks to rewrite
+    stack_props = record['output_stack_properties']
+    chunks = record['chunks']
+    n_touched = sum(len(_get_touched_blocks(
+                        it_boxes, stack_props['origin'], stack_props['spacing'],
+                        chunks))
+                    for it_boxes in boxes.values())
+    n_blocks = len(record['params'][0]) * np.prod([len(c) for c in chunks])
+
+    if n_touched > max_fraction * n_blocks:
+        return None
+
+    return boxes
+
+
+def get_tile_bounding_box(sim, affine):
+    """
+    Bounding box (lower and upper corner) of a tile
+    in world coordinates given its affine transform.
+    """
+
+    ndim = spatial_image_utils.get_ndim_from_sim(sim)
+    origin = spatial_image_utils.get_origin_from_sim(sim, asarray=True)
+    spacing = spatial_image_utils.get_spacing_from_sim(sim, asarray=True)
+    shape = spatial_image_utils.get_shape_from_sim(sim, asarray=True)
+
+    corners = np.array(list(itertools.product(
+        *[[o, o + (n - 1) * s] for o, s, n in zip(origin, spacing, shape)])))
+
+    affine = np.asarray(affine)
+    corners = corners @ affine[:ndim, :ndim].T + affine[:ndim, ndim]
+
+    return np.min(corners, 0), np.max(corners, 0)
+
+
+def get_changed_tile_boxes(sims, previous_params, params):
+    """
+    Bounding boxes of tiles whose transform parameters changed,
+    before and after the change, for each time index.
+    """
+
+    boxes = dict()
+    for sim, tile_previous_params, tile_params in zip(
+            sims, previous_params, params):
+        for it, (p_previous, p) in enumerate(zip(tile_previous_params, tile_params)):
+            if np.allclose(p_previous, p):
+                continue
+            boxes.setdefault(it, []).extend([
+                get_tile_bounding_box(sim, p_previous),
+                get_tile_bounding_box(sim, p)])
+
+    return boxes
+
+
+def get_regions_touched_by_boxes(sim, boxes, margin=1):
+    """
+    Chunk aligned regions of the data of a fused image with dimensions
+    (t, c, spatial dims) touched by bounding boxes.
+
+    Parameters
+    ----------
+    sim : SpatialImage
+    boxes : dict
+        Bounding boxes (lower, upper) in world coordinates for each time index
+    margin : int, optional
+        Number of pixels added around each box, by default 1
+
+    Returns
+    -------
+    list of tuple of slice
+    """
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sim)
+    origin = spatial_image_utils.get_origin_from_sim(sim, asarray=True)
+    spacing = spatial_image_utils.get_spacing_from_sim(sim, asarray=True)
+
+    chunks = dict(zip(sim.dims, sim.data.chunks))
+    boundaries = {dim: np.concatenate([[0], np.cumsum(chunks[dim])])
+                  for dim in sim.dims}
+
+    regions = []
+    for it, it_boxes in boxes.items():
+
+        t_block = np.searchsorted(boundaries['t'], it, side='right') - 1
+
+        for spatial_block in sorted(_get_touched_blocks(
+                it_boxes, origin, spacing,
+                [chunks[dim] for dim in spatial_dims], margin=margin)):
+
+            block = dict(zip(spatial_dims, spatial_block))
+            block['t'] = t_block
+
+            for c_block in range(len(chunks['c']) if 'c' in chunks else 1):
+
+                block['c'] = c_block
+
+                regions.append(tuple(
+                    slice(int(boundaries[dim][block[dim]]),
+                          int(boundaries[dim][block[dim] + 1]))
+                    for dim in sim.dims))
+
+    return regions
+
+
+def update_multiscale_spatial_image_zarr(msim, path, boxes, compute=True):
+    """
+    Rewrite the chunks of a MultiscaleSpatialImage previously written
+    to zarr (see `multiscale_spatial_image_to_zarr`) which are touched
+    by the given bounding boxes. All scales are updated.
+
+    Parameters
+    ----------
+    msim : MultiscaleSpatialImage
+        Image with the same scales, shapes and chunks as the zarr store
+    path : str
+    boxes : dict
+        Bounding boxes (lower, upper) in world coordinates for each time index
+    compute : bool, optional
+        Whether to write the data immediately, by default True
+
+    Returns
+    -------
+    dask.delayed.Delayed or None
+        Delayed write if compute=False
+    """
+
+    store = zarr.open_group(path, mode='r+')
+
+    sources, targets, regions = [], [], []
+    for scale_key in msi_utils.get_sorted_scale_keys(msim):
+        sim = msim[scale_key]['image']
+        for region in get_regions_touched_by_boxes(sim, boxes):
+            sources.append(sim.data[region])
+            targets.append(store[scale_key]['image'])
+            regions.append(region)
+
+    writes = da.store(
+        sources, targets, regions=regions, lock=False, compute=False)\
+        if len(sources) else []
+
+    write = delayed(_consolidate_metadata)(writes, path)
+
+    if compute:
+        write.compute()
+        return None
+
+    return write
+
+
+def _get_touched_blocks(boxes, origin, spacing, chunks, margin=1):
+    """
+    Indices of the spatial blocks of an array touched by bounding boxes.
+    """
+
+    boundaries = [np.concatenate([[0], np.cumsum(c)]) for c in chunks]
+
+    blocks = set()
+    for lower, upper in boxes:
+
+        block_ranges = []
+        for idim in range(len(chunks)):
+            size = boundaries[idim][-1]
+            start = max(0, math.floor(
+                (lower[idim] - origin[idim]) / spacing[idim]) - margin)
+            stop = min(size, math.ceil(
+                (upper[idim] - origin[idim]) / spacing[idim]) + margin + 1)
+            if start >= stop:
+                break
+            block_ranges.append(range(
+                np.searchsorted(boundaries[idim], start, side='right') - 1,
+                np.searchsorted(boundaries[idim], stop, side='left')))
+        else:
+            blocks.update(itertools.product(*block_ranges))
+
+    return blocks
+
+
+def _get_params_over_time(sim, transform_key):
+    """
+    Affine parameters of a tile as an array of shape (n_t, ndim + 1, ndim + 1).
+    """
+
+    params = np.asarray(spatial_image_utils.get_affine_from_sim(sim, transform_key))
+    if params.ndim == 2:
+        params = np.stack([params] * len(sim.coords['t']))
+
+    return params
@@ -0,0 +1,1065 @@
+"""
+Registration of tiles loaded into napari-stitcher.
+
+Follows the logic of `multiview_stitcher.registration.register`, but
+computes the pairwise registrations such that progress can be reported
+for each registered pair of views.
+"""
+
+import os
+import json
+import hashlib
+import time
+
+import numpy as np
+import xarray as xr
+import networkx as nx
+from dask import compute, delayed
+
+from multiview_stitcher import (
+    registration,
+    mv_graph,
+    msi_utils,
+    param_utils,
+    spatial_image_utils,
+    )
+
+from napari_stitcher import _utils
+
+
+# environment variable configuring the maximal number of
+# pairwise registration results kept in the registration cache
+REGISTRATION_CACHE_SIZE_ENV = 'NAPARI_STITCHER_REGISTRATION_CACHE_SIZE'
+
+# default maximal number of entries of the registration cache
+# (each of a few hundred bytes)
+DEFAULT_REGISTRATION_CACHE_SIZE = 100000
+
+# transform key under which intermediate results of
+# coarse-to-fine registration are stored in the input views
+COARSE_TRANSFORM_KEY = 'affine_registered_coarse'
+
+# transform key under which the results of the previous timepoint
+# are stored in the input views when warm starting the registration
+WARM_START_TRANSFORM_KEY = 'affine_registered_warm_start'
+
+
+def register(
+    msims,
+    transform_key,
+    registration_binning=None,
+    n_pyramid_levels=1,
+    pre_registration_pruning_method='shortest_paths_overlap_weighted',
+    pair_callback=None,
+    tile_ids=None,
+    cache_dir=None,
+    previous_params=None,
+    scheduler=None,
+):
+    """
+    Register a list of views to a common extrinsic coordinate system.
+
+    1) Build a graph of pairwise overlaps between views
+    2) Prune the graph to the pairs relevant for registration
+    3) Register each pair of views (in parallel)
+    4) Determine the parameters mapping each view into the new
+       extrinsic coordinate system
+
+    With n_pyramid_levels > 1, steps 3) and 4) are performed in a
+    coarse-to-fine manner: the views are first registered using a binning
+    of registration_binning * 2 ** (n_pyramid_levels - 1). Each subsequent
+    level halves the binning and refines the previous result, considering
+    only the overlap regions between the previously registered views.
+    Without registration_binning, the finest level uses the binning
+    multiview-stitcher considers optimal for the pairs of views. Levels
+    are read from coarser scales of the views where these exist.
+
+    Parameters
+    ----------
+    msims : list of MultiscaleSpatialImage
+        Input views
+    transform_key : str
+        Extrinsic coordinate system to use as a starting point
+        for the registration
+    registration_binning : dict, optional
+        Binning applied to each dimension during registration, by default None
+    n_pyramid_levels : int, optional
+        Number of levels used for coarse-to-fine registration, by default 1.
+        Intermediate results are stored in the input views under
+        COARSE_TRANSFORM_KEY.
+    pre_registration_pruning_method : str, optional
+        Method used to prune the view adjacency graph before registration,
+        by default 'shortest_paths_overlap_weighted'
+    pair_callback : func, optional
+        Called with the pair of view indices (and the total number of pairs)
+        each time the registration of a pair has finished, by default None
+    tile_ids : list of str or dict, optional
+        Identifiers of the views which are stable across sessions
+        (see `_utils.get_tile_id`), or of each time coordinate of
+        the views, by default None
+    cache_dir : str, optional
+        Directory in which pairwise registration results are cached
+        for each timepoint, see `get_registration_cache_dir`. Only used
+        if tile_ids are given. By default None (no caching).
+    previous_params : list of xr.DataArray, optional
+        Parameters of a previous registration for each view, None for
+        views which haven't been registered before. The new parameters
+        are anchored to the previous ones (see `anchor_params`), such
+        that adding views or timepoints doesn't move the registered
+        views. By default None.
+    scheduler : optional
+        Dask scheduler used to register the pairs of views, e.g. a
+        distributed Client. By default the current dask scheduler.
+
+    Returns
+    -------
+    list of xr.DataArray
+        Parameters mapping each view into a new extrinsic coordinate system
+    """
+
+    g_reg, pairs = get_registration_graph(
+        msims,
+        transform_key=transform_key,
+        pre_registration_pruning_method=pre_registration_pruning_method,
+    )
+
+    return register_pairs(
+        msims,
+        g_reg,
+        pairs,
+        transform_key=transform_key,
+        registration_binning=registration_binning,
+        n_pyramid_levels=n_pyramid_levels,
+        pair_callback=pair_callback,
+        tile_ids=tile_ids,
+        cache_dir=cache_dir,
+        previous_params=previous_params,
+        scheduler=scheduler,
+    )
+
+
+def register_timepoints(
+    msims,
+    transform_key,
+    n_workers=2,
+    pre_registration_pruning_method='shortest_paths_overlap_weighted',
+    **kwargs,
+):
+    """
+    Register the timepoints of a list of views independently of each other.
+
+    The graph of overlapping views is determined once for all timepoints.
+    Then, up to n_workers timepoints are registered concurrently, each
+    within its own computation on the given scheduler (e.g. a distributed
+    Client). This bounds the memory used at a time and allows to use the
+    results of the first timepoints while the others are registered.
+
+    Parameters
+    ----------
+    msims : list of MultiscaleSpatialImage
+        Input views
+    transform_key : str
+    n_workers : int, optional
+        Number of timepoints registered concurrently, by default 2
+    pre_registration_pruning_method : str, optional
+    **kwargs
+        Passed on to `register_pairs` (e.g. registration_binning,
+        n_pyramid_levels, tile_ids, cache_dir, previous_params, scheduler)
+
+    Yields
+    ------
+    tuple
+        Time coordinate and parameters for each view (as returned by
+        `register`) in the order in which the timepoints finish
+    """
+
+    g_reg, pairs = get_registration_graph(
+        msims,
+        transform_key=transform_key,
+        pre_registration_pruning_method=pre_registration_pruning_method,
+    )
+
+    ts = msi_utils.get_sim_from_msim(msims[0]).coords['t'].values
+
+    def register_timepoint(t):
+        return register_pairs(
+            [msi_utils.multiscale_sel_coords(msim, {'t': [t]}) for msim in msims],
+            g_reg.copy(),
+            pairs,
+            transform_key=transform_key,
+            **kwargs,
+        )
+
+    for it, params in _utils.map_bounded(register_timepoint, ts, n_workers):
+        yield ts[it], params
+
+
+def register_timepoints_warm_start(
+    msims,
+    transform_key,
+    n_pyramid_levels=1,
+    search_radius=10,
+    min_quality_ratio=0.5,
+    pre_registration_pruning_method='shortest_paths_overlap_weighted',
+    previous_params=None,
+    **kwargs,
+):
+    """
+    Register the timepoints of a list of views one after the other,
+    seeding each timepoint with the result of the previous one.
+
+    Timepoints are registered coarse-to-fine using at least two pyramid
+    levels. Starting from the parameters of the previous timepoint
+    (stored in the views under WARM_START_TRANSFORM_KEY), the pairs are
+    first registered at the coarsest level only, within the overlap
+    regions given by the seed. The result is accepted if no view moves
+    further than search_radius pixels away from the seed and the quality
+    of each pair remains above min_quality_ratio times its quality at the
+    coarsest level of the last timepoint registered from scratch. An
+    accepted result is refined at the finer levels, while otherwise the
+    timepoint is registered from scratch starting from transform_key.
+    Rejected timepoints therefore only cost an additional registration
+    at the coarsest level.
+
+    Parameters
+    ----------
+    msims : list of MultiscaleSpatialImage
+        Input views
+    transform_key : str
+    n_pyramid_levels : int, optional
+        Number of pyramid levels (at least two are used), by default 1
+    search_radius : float, optional
+        Maximal deviation from the seed in pixels, by default 10
+    min_quality_ratio : float, optional
+        Minimal ratio between the qualities of a pair at the coarsest
+        level and at the last timepoint registered from scratch,
+        by default 0.5
+    pre_registration_pruning_method : str, optional
+    previous_params : list of xr.DataArray, optional
+        See `register`
+    **kwargs
+        Passed on to `compute_params_from_pairs` (e.g.
+        registration_binning of the finest level, tile_ids,
+        cache_dir, scheduler)
+
+    Yields
+    ------
+    tuple
+        Time coordinate, parameters for each view and whether the
+        timepoint has been registered starting from the seed
+    """
+
+    registration_binning = kwargs.pop('registration_binning', None)
+
+    g_reg, pairs = get_registration_graph(
+        msims,
+        transform_key=transform_key,
+        pre_registration_pruning_method=pre_registration_pruning_method,
+    )
+
+    sim = msi_utils.get_sim_from_msim(msims[0])
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sim)
+    ndim = len(spatial_dims)
+    max_shift = search_radius * spatial_image_utils.get_spacing_from_sim(
+        sim, asarray=True)
+
+    if registration_binning is None:
+        registration_binning = get_optimal_registration_binning(
+            msims, pairs, transform_key)
+
+    level_binnings = get_pyramid_binnings(
+        registration_binning, spatial_dims, max(n_pyramid_levels, 2))
+
+    seed_params, seed_qualities = None, None
+    for t in sim.coords['t'].values:
+
+        msims_t = [msi_utils.multiscale_sel_coords(msim, {'t': [t]})
+                   for msim in msims]
+
+        g_t = g_reg.copy()
+
+        coarse_params, warm_started = None, False
+        if seed_params is not None:
+
+            for msim, p in zip(msims_t, seed_params):
+                msi_utils.set_affine_transform(
+                    msim, p.assign_coords(t=[t]),
+                    transform_key=WARM_START_TRANSFORM_KEY,
+                    base_transform_key=transform_key)
+
+            residual_params = register_levels(
+                msims_t, g_t, pairs,
+                transform_key=WARM_START_TRANSFORM_KEY,
+                level_binnings=level_binnings[:1],
+                **kwargs,
+            )
+
+            qualities = _get_pair_qualities(g_t, pairs)
+            shifts = [np.abs(_sel_time(p, t)[:ndim, ndim]) for p in residual_params]
+
+            if all(np.all(shift <= max_shift) for shift in shifts) and\
+                all(qualities[pair] >= min_quality_ratio * seed_qualities[pair]
+                    for pair in pairs):
+                coarse_params = [param_utils.rebase_affine(residual_p, p.assign_coords(t=[t]))
+                                 for residual_p, p in zip(residual_params, seed_params)]
+                warm_started = True
+
+        if coarse_params is None:
+            coarse_params = register_levels(
+                msims_t, g_t, pairs,
+                transform_key=transform_key,
+                level_binnings=level_binnings[:1],
+                **kwargs,
+            )
+            # the qualities obtained from scratch serve as a reference
+            # as long as the seed is followed
+            seed_qualities = _get_pair_qualities(g_t, pairs)
+
+        # refine the result of the coarsest level
+        params = register_levels(
+            msims_t, g_t, pairs,
+            transform_key=transform_key,
+            level_binnings=level_binnings[1:],
+            initial_params=coarse_params,
+            **kwargs,
+        )
+
+        params = _anchor_params_to_previous(params, previous_params, g_reg)
+
+        seed_params = [p.sel(t=[t]) for p in params]
+
+        yield t, params, warm_started
+
+
+def _get_pair_qualities(g_reg, pairs):
+    return {pair: float(np.min(g_reg.edges[pair]['quality'])) for pair in pairs}
+
+
+def get_registration_graph(
+    msims,
+    transform_key,
+    pre_registration_pruning_method='shortest_paths_overlap_weighted',
+):
+    """
+    Build the graph of pairwise overlaps between views and prune it
+    to the pairs relevant for registration.
+
+    Returns
+    -------
+    tuple
+        Pruned graph and sorted list of pairs to register
+    """
+
+    g = mv_graph.build_view_adjacency_graph_from_msims(
+        msims,
+        transform_key=transform_key,
+    )
+
+    g_reg = registration.prune_view_adjacency_graph(
+        g,
+        method=pre_registration_pruning_method,
+    )
+
+    pairs = sorted([tuple(sorted(e)) for e in g_reg.edges])
+
+    return g_reg, pairs
+
+
+def register_pairs(
+    msims,
+    g_reg,
+    pairs,
+    transform_key,
+    registration_binning=None,
+    n_pyramid_levels=1,
+    pair_callback=None,
+    tile_ids=None,
+    cache_dir=None,
+    previous_params=None,
+    scheduler=None,
+):
+    """
+    Register the given pairs of views and determine the parameters
+    of each view (steps 3 and 4 of `register`).
+    """
+
+    if n_pyramid_levels == 1:
+        params = compute_params_from_pairs(
+            msims,
+            g_reg,
+            pairs,
+            transform_key=transform_key,
+            registration_binning=registration_binning,
+            pair_callback=pair_callback,
+            n_pairs_total=len(pairs),
+            tile_ids=tile_ids,
+            cache_dir=cache_dir,
+            scheduler=scheduler,
+        )
+        return _anchor_params_to_previous(params, previous_params, g_reg)
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(
+        msi_utils.get_sim_from_msim(msims[0]))
+
+    if registration_binning is None:
+        registration_binning = get_optimal_registration_binning(
+            msims, pairs, transform_key)
+
+    params = register_levels(
+        msims,
+        g_reg,
+        pairs,
+        transform_key=transform_key,
+        level_binnings=get_pyramid_binnings(
+            registration_binning, spatial_dims, n_pyramid_levels),
+        pair_callback=pair_callback,
+        n_pairs_total=len(pairs) * n_pyramid_levels,
+        tile_ids=tile_ids,
+        cache_dir=cache_dir,
+        scheduler=scheduler,
+    )
+
+    return _anchor_params_to_previous(params, previous_params, g_reg)
+
+
+def register_levels(
+    msims,
+    g_reg,
+    pairs,
+    transform_key,
+    level_binnings,
+    initial_params=None,
+    **kwargs,
+):
+    """
+    Register the given pairs of views at the given pyramid levels,
+    coarsest first. Each level refines the result of the previous
+    levels (or initial_params, relative to transform_key), which is
+    stored in the views under COARSE_TRANSFORM_KEY. Levels are read
+    from coarser scales of the views where possible (see
+    `get_level_msims`).
+
+    kwargs are passed on to `compute_params_from_pairs`.
+    """
+
+    params = initial_params
+    for level_binning in level_binnings:
+
+        level_transform_key = transform_key
+        if params is not None:
+            for msim, p in zip(msims, params):
+                msi_utils.set_affine_transform(
+                    msim, p,
+                    transform_key=COARSE_TRANSFORM_KEY,
+                    base_transform_key=transform_key)
+            level_transform_key = COARSE_TRANSFORM_KEY
+
+        level_msims, level_binning = get_level_msims(msims, level_binning)
+
+        level_params = compute_params_from_pairs(
+            level_msims,
+            g_reg,
+            pairs,
+            transform_key=level_transform_key,
+            registration_binning=level_binning,
+            **kwargs,
+        )
+
+        # chain the refinement with the results of the coarser levels
+        if params is None:
+            params = level_params
+        else:
+            params = [param_utils.rebase_affine(level_p, p)
+                      for level_p, p in zip(level_params, params)]
+
+    return params
+
+
+def compute_params_from_pairs(
+    msims,
+    g_reg,
+    pairs,
+    transform_key,
+    registration_binning=None,
+    pair_callback=None,
+    n_pairs_total=None,
+    tile_ids=None,
+    cache_dir=None,
+    scheduler=None,
+):
+    """
+    Register the given pairs of views and concatenate the pairwise
+    transforms into parameters for each view.
+
+    If tile_ids and cache_dir are given, only the timepoints of the pairs
+    not found in the registration cache are registered. The cache is
+    read and written by the calling process, also when registering
+    on a distributed cluster.
+    """
+
+    if n_pairs_total is None:
+        n_pairs_total = len(pairs)
+
+    use_cache = tile_ids is not None and cache_dir is not None
+
+    # lazy registration of each pair (None if fully cached)
+    pair_tasks, pair_caches = [], []
+    for pair in pairs:
+
+        if not use_cache:
+            pair_tasks.append(registration.register_pair_of_msims_over_time(
+                msims[pair[0]],
+                msims[pair[1]],
+                transform_key=transform_key,
+                registration_binning=registration_binning,
+            ))
+            continue
+
+        keys = get_pair_registration_keys(
+            msims[pair[0]], msims[pair[1]],
+            tile_ids[pair[0]], tile_ids[pair[1]],
+            transform_key=transform_key,
+            registration_binning=registration_binning,
+        )
+
+        cached = {t: load_pair_registration(key, cache_dir)
+                  for t, key in keys.items()}
+        missing_ts = [t for t, entry in cached.items() if entry is None]
+
+        computed = None
+        if len(missing_ts):
+            computed = registration.register_pair_of_msims_over_time(
+                *[msi_utils.multiscale_sel_coords(
+                      msims[iview], {'t': missing_ts}) for iview in pair],
+                transform_key=transform_key,
+                registration_binning=registration_binning,
+            )
+
+        pair_tasks.append(computed)
+        pair_caches.append((cached, keys))
+
+    computed_results = _compute_pair_tasks(
+        pair_tasks, pairs, n_pairs_total, pair_callback, scheduler)
+
+    if use_cache:
+        pair_results = [
+            _merge_cached_pair_result(computed, cached, keys, cache_dir)
+            for computed, (cached, keys) in zip(computed_results, pair_caches)]
+        evict_registration_cache(cache_dir)
+    else:
+        pair_results = computed_results
+
+    for pair, pair_result in zip(pairs, pair_results):
+        g_reg.edges[pair]['transform'] = pair_result['transform']
+        g_reg.edges[pair]['quality'] = pair_result['quality']
+
+    params = registration.get_node_params_from_reg_graph(g_reg)
+
+    return [params[iview] for iview in sorted(g_reg.nodes())]
+
+
+def anchor_params(params, previous_params, components=None,
+                  transform_type='rigid'):
+    """
+    Anchor registration parameters to those of a previous registration.
+
+    Parameters of connected views are determined up to a common
+    transformation (e.g. relative to a reference view). For each
+    connected component and timepoint, this transformation is chosen
+    such that the parameters of the previously registered views agree
+    with their previous parameters as well as possible (least squares).
+
+    Parameters
+    ----------
+    params : list of xr.DataArray
+        Parameters for each view
+    previous_params : list of xr.DataArray or None
+        Previous parameters for each view, None if not available
+    components : list of list of int, optional
+        Groups of views registered together, by default all views
+    transform_type : str, optional
+        Type of the common transformation, see `get_anchoring_affine`.
+        It should match the type of the registration, such that anchoring
+        doesn't add e.g. shear to rigid parameters. By default 'rigid'.
+
+    Returns
+    -------
+    list of xr.DataArray
+        Anchored parameters
+    """
+
+    if components is None:
+        components = [list(range(len(params)))]
+
+    params = [p.transpose(..., 'x_in', 'x_out').copy() for p in params]
+
+    for component in components:
+        for t in _get_time_coords(params[component[0]]):
+
+            views, P, Q = [], [], []
+            for iview in component:
+                p_prev = _sel_time(previous_params[iview], t)
+                if p_prev is None or np.any(np.isnan(p_prev)):
+                    continue
+                views.append(iview)
+                P.append(_sel_time(params[iview], t))
+                Q.append(p_prev)
+
+            if not len(views):
+                continue
+
+            anchor = get_anchoring_affine(P, Q, transform_type)
+
+            for iview in component:
+                p = anchor @ _sel_time(params[iview], t)
+                if t is None:
+                    params[iview].values = p
+                else:
+                    params[iview].loc[{'t': t}] = p
+
+    return params
+
+
+def get_anchoring_affine(P, Q, transform_type='rigid'):
+    """
+    Affine matrix A minimizing the sum of ||A @ P_i - Q_i|| over all
+    pairs of (homogeneous) affine matrices P_i and Q_i.
+
+    Parameters
+    ----------
+    P, Q : list of np.ndarray
+    transform_type : str, optional
+        Type of A: 'translation', 'rigid' (rotation and translation,
+        Kabsch algorithm) or 'affine'. By default 'rigid'.
+
+    Returns
+    -------
+    np.ndarray
+    """
+
+    P, Q = np.array(P, dtype=float), np.array(Q, dtype=float)
+    ndim = P.shape[-1] - 1
+
+    if transform_type == 'affine':
+        PP = np.sum([p @ p.T for p in P], axis=0)
+        QP = np.sum([q @ p.T for p, q in zip(P, Q)], axis=0)
+
+        anchor = QP @ np.linalg.pinv(PP)
+        anchor[-1] = np.eye(len(anchor))[-1]
+
+        return anchor
+
+    if transform_type not in ['translation', 'rigid']:
+        raise ValueError('Unknown transform type %s' %transform_type)
+
+    # the linear parts of P_i are only rotated, while their
+    # translations are rotated and shifted
+    tp, tq = P[:, :ndim, ndim], Q[:, :ndim, ndim]
+
+    rotation = np.eye(ndim)
+    if transform_type == 'rigid':
+        M = np.sum([q[:ndim, :ndim] @ p[:ndim, :ndim].T
+                    for p, q in zip(P, Q)], axis=0)
+        M += (tq - tq.mean(axis=0)).T @ (tp - tp.mean(axis=0))
+        U, _, Vt = np.linalg.svd(M)
+        # avoid reflections
+        D = np.eye(ndim)
+        D[-1, -1] = np.sign(np.linalg.det(U @ Vt))
+        rotation = U @ D @ Vt
+
+    anchor = np.eye(ndim + 1)
+    anchor[:ndim, :ndim] = rotation
+    anchor[:ndim, ndim] = np.mean(tq - tp @ rotation.T, axis=0)
+
+    return anchor
+
+
+def _anchor_params_to_previous(params, previous_params, g_reg):
+
+    if previous_params is None:
+        return params
+
+    components = [sorted(c) for c in nx.connected_components(g_reg)]
+
+    # pairs of views are registered by phase correlation
+    return anchor_params(
+        params, previous_params, components, transform_type='translation')
+
+
+def _get_time_coords(p):
+    return p.coords['t'].values if 't' in p.dims else [None]
+
+
+def _sel_time(p, t):
+    """
+    Parameters at timepoint t as an array, None if not available.
+    """
+
+    if p is None:
+        return None
+
+    if 't' in p.dims:
+        if t is None or t not in p.coords['t'].values:
+            return None
+        p = p.sel(t=t)
+
+    return np.asarray(p.transpose('x_in', 'x_out'))
+
+
+def get_pyramid_binnings(registration_binning, spatial_dims, n_pyramid_levels):
+    """
+    Binnings used for coarse-to-fine registration, coarsest first.
+    The finest level uses registration_binning (no binning if None,
+    see `get_optimal_registration_binning` for the binning used
+    by `register_pairs` in this case).
+    """
+
+    if registration_binning is None:
+        registration_binning = {dim: 1 for dim in spatial_dims}
+
+    return [{dim: registration_binning.get(dim, 1) * 2 ** (n_pyramid_levels - 1 - ilevel)
+             for dim in spatial_dims}
+            for ilevel in range(n_pyramid_levels)]
+
+
+def get_optimal_registration_binning(msims, pairs, transform_key):
+    """
+    Binning multiview-stitcher chooses when registering the overlap
+    regions of the given pairs of views without binning being specified
+    (see `registration.get_optimal_registration_binning`), maximised
+    over the pairs. Only the metadata of the views is used.
+    """
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(
+        msi_utils.get_sim_from_msim(msims[0]))
+
+    binning = {dim: 1 for dim in spatial_dims}
+    for pair in pairs:
+        sims = [spatial_image_utils.get_sim_field(
+                    msi_utils.get_sim_from_msim(msims[iview]))
+                for iview in pair]
+
+        lowers, uppers = registration.get_overlap_bboxes(
+            *sims, input_transform_key=transform_key, output_transform_key=None)
+
+        overlap_sims = [
+            sim.sel({dim: slice(lowers[isim][idim] - 0.001,
+                                uppers[isim][idim] + 0.001)
+                     for idim, dim in enumerate(spatial_dims)})
+            for isim, sim in enumerate(sims)]
+
+        pair_binning = registration.get_optimal_registration_binning(
+            *overlap_sims)
+        binning = {dim: max(binning[dim], pair_binning[dim])
+                   for dim in spatial_dims}
+
+    return binning
+
+
+def get_level_msims(msims, binning):
+    """
+    Views to register at a pyramid level with the given binning.
+
+    If all views contain a coarser scale with the same downsampling
+    evenly dividing the binning, the coarsest such scale is used instead
+    of binning the finest scale.
+
+    Returns
+    -------
+    tuple
+        Views and binning to apply to them during registration
+    """
+
+    scale_binnings = [get_scale_binnings(msim) for msim in msims]
+
+    level_scale_key, level_binning = None, binning
+    for scale_key, scale_binning in scale_binnings[0].items():
+        if scale_key == 'scale0': continue
+        if any(sb.get(scale_key) != scale_binning for sb in scale_binnings):
+            continue
+        if any(binning[dim] % scale_binning[dim] for dim in binning):
+            continue
+        level_scale_key = scale_key
+        level_binning = {dim: binning[dim] // scale_binning[dim]
+                         for dim in binning}
+
+    if level_scale_key is None:
+        return msims, binning
+
+    level_msims = [
+        msi_utils.get_msim_from_sim(
+            msi_utils.get_sim_from_msim(msim, scale=level_scale_key),
+            scale_factors=[])
+        for msim in msims]
+
+    return level_msims, level_binning
+
+
+def get_scale_binnings(msim):
+    """
+    Downsampling of each scale of a view relative to its finest scale.
+    """
+
+    spacing = spatial_image_utils.get_spacing_from_sim(
+        msi_utils.get_sim_from_msim(msim))
+
+    scale_binnings = dict()
+    for scale_key in msi_utils.get_sorted_scale_keys(msim):
+        scale_spacing = spatial_image_utils.get_spacing_from_sim(
+            msi_utils.get_sim_from_msim(msim, scale=scale_key))
+        scale_binnings[scale_key] = {
+            dim: int(round(scale_spacing[dim] / spacing[dim]))
+            for dim in spacing}
+
+    return scale_binnings
+
+
+def get_registration_cache_dir():
+    """
+    Directory in which pairwise registration results are cached, by default
+    ~/.cache/napari-stitcher/registration (see `_utils.get_cache_dir`).
+    """
+
+    return _utils.get_cache_dir('registration')
+
+
+def get_registration_cache_size():
+    """
+    Maximal number of entries of the registration cache. Configured by
+    the environment variable NAPARI_STITCHER_REGISTRATION_CACHE_SIZE,
+    by default 100000.
+    """
+
+    return int(os.environ.get(
+        REGISTRATION_CACHE_SIZE_ENV, DEFAULT_REGISTRATION_CACHE_SIZE))
+
+
+def evict_registration_cache(cache_dir, max_entries=None):
+    """
+    Remove the least recently used pairwise registration results
+    until the cache holds at most max_entries results. Temporary files
+    left by interrupted writes are removed once they are an hour old.
+
+    Parameters
+    ----------
+    cache_dir : str
+    max_entries : int, optional
+        Maximal number of entries, by default `get_registration_cache_size()`
+    """
+
+    if max_entries is None:
+        max_entries = get_registration_cache_size()
+
+    entries, now = [], time.time()
+    for entry in os.scandir(cache_dir):
+        try:
+            mtime = entry.stat().st_mtime
+        except OSError:
+            continue
+        if entry.name.endswith('.json'):
+            entries.append((mtime, entry.path))
+        elif entry.name.endswith('.partial') and now - mtime > 60 * 60:
+            _remove_file(entry.path)
+
+    if len(entries) <= max_entries: return
+
+    for _, path in sorted(entries)[:len(entries) - max_entries]:
+        _remove_file(path)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def get_pair_registration_keys(
+    msim1,
+    msim2,
+    tile_id1,
+    tile_id2,
+    transform_key,
+    registration_binning=None,
+):
+    """
+    Hashes identifying the registration of a pair of views at each
+    timepoint. They combine the identifiers of the tiles (at the
+    timepoint, given a dict for each tile) and their geometry,
+    their transform parameters at the timepoint (determining the overlap),
+    the channel and the registration settings.
+
+    Returns
+    -------
+    dict
+        Key for each time coordinate
+    """
+
+    sims = [msi_utils.get_sim_from_msim(msim) for msim in [msim1, msim2]]
+
+    h = hashlib.sha256()
+
+    h.update(json.dumps({
+        'channel': str(sims[0].coords['c'].values)
+                   if 'c' in sims[0].coords else None,
+        'registration_binning': {dim: int(b) for dim, b in
+                                 registration_binning.items()}
+                                if registration_binning is not None else None,
+    }).encode())
+
+    for sim in sims:
+        h.update(json.dumps({
+            'shape': {dim: int(sim.sizes[dim]) for dim in
+                      spatial_image_utils.get_spatial_dims_from_sim(sim)},
+            'dtype': str(sim.dtype),
+            'spacing': {dim: float(s) for dim, s in
+                        spatial_image_utils.get_spacing_from_sim(sim).items()},
+            'origin': {dim: float(o) for dim, o in
+                       spatial_image_utils.get_origin_from_sim(sim).items()},
+        }).encode())
+
+    affines = [msi_utils.get_transform_from_msim(msim, transform_key)
+               for msim in [msim1, msim2]]
+
+    keys = dict()
+    for t in sims[0].coords['t'].values:
+        ht = h.copy()
+        ht.update(str(t).encode())
+        ht.update(json.dumps([str(_get_timepoint_tile_id(tile_id, t))
+                              for tile_id in [tile_id1, tile_id2]]).encode())
+        for affine in affines:
+            if 't' in affine.dims:
+                affine = affine.sel(t=t)
+            ht.update(np.ascontiguousarray(
+                affine, dtype=np.float64).round(decimals=9).tobytes())
+        keys[t] = ht.hexdigest()[:32]
+
+    return keys
+
+
+def _get_timepoint_tile_id(tile_id, t):
+    if isinstance(tile_id, dict):
+        return tile_id[t]
+    return tile_id
+
+
+def get_pair_registration_cache_path(key, cache_dir):
+    return os.path.join(cache_dir, '%s.json' %key)
+
+
+def load_pair_registration(key, cache_dir):
+    """
+    Cached registration of a pair of views at a timepoint
+    or None if not cached.
+
+    Returns
+    -------
+    dict or None
+        Transform (as nested list) and quality
+    """
+
+    path = get_pair_registration_cache_path(key, cache_dir)
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+        # mark the entry as recently used
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+
+    return entry
+
+
+def save_pair_registration(entry, key, cache_dir):
+    """
+    Cache the registration of a pair of views at a timepoint.
+    """
+
+    path = get_pair_registration_cache_path(key, cache_dir)
+
+    # write into a temporary file first, such that
+    # interrupted writes never end up in the cache
+    tmp_path = '%s.%s.partial' %(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+
+def _merge_cached_pair_result(computed, cached, keys, cache_dir):
+    """
+    Cache the (computed) registration results of the timepoints missing
+    from the cache and combine them with the cached ones into the result
+    of `registration.register_pair_of_msims_over_time`.
+    """
+
+    entries = dict(cached)
+
+    if computed is not None:
+        for t in computed['transform'].coords['t'].values:
+            entry = {
+                'transform': np.asarray(
+                    computed['transform'].sel(t=t)).tolist(),
+                'quality': float(computed['quality'].sel(t=t)),
+            }
+            save_pair_registration(entry, keys[t], cache_dir)
+            entries[t] = entry
+
+    ts = list(keys.keys())
+
+    return {
+        'transform': xr.DataArray(
+            np.array([entries[t]['transform'] for t in ts], dtype=float),
+            dims=['t', 'x_in', 'x_out'],
+            coords={'t': ts}),
+        'quality': xr.DataArray(
+            np.array([entries[t]['quality'] for t in ts], dtype=float),
+            dims=['t'],
+            coords={'t': ts}),
+    }
+
+
+def _compute_pair_tasks(pair_tasks, pairs, n_pairs, pair_callback, scheduler):
+    """
+    Compute the pairwise registrations, calling pair_callback each time
+    a pair has been registered. On a distributed Client, the callback
+    (e.g. updating a progress bar) is kept out of the graph and called
+    by the calling process as the results arrive.
+    """
+
+    if not _utils.is_distributed_client(scheduler):
+        return compute(
+            [delayed(_report_pair)(task, pair, n_pairs, pair_callback)
+             for task, pair in zip(pair_tasks, pairs)],
+            scheduler=scheduler)[0]
+
+    results = [None] * len(pairs)
+    itasks = [itask for itask, task in enumerate(pair_tasks)
+              if task is not None]
+
+    # fully cached pairs
+    for itask in range(len(pairs)):
+        if pair_tasks[itask] is None:
+            _report_pair(None, pairs[itask], n_pairs, pair_callback)
+
+    for i, result in _utils.compute_as_completed(
+            [pair_tasks[itask] for itask in itasks], scheduler):
+        results[itasks[i]] = _report_pair(
+            result, pairs[itasks[i]], n_pairs, pair_callback)
+
+    return results
+
+
+def _report_pair(pair_result, pair, n_pairs, pair_callback):
+    """
+    Pass through the (computed) result of a pairwise registration,
+    notifying `pair_callback` that the pair has been registered.
+    """
+
+    if pair_callback is not None:
+        pair_callback(pair, n_pairs)
+
+    return pair_result
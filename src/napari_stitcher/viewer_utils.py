@@ -1,28 +1,48 @@
+import logging
+import math
+import weakref
+from collections import OrderedDict
+from contextlib import ExitStack
+
 import numpy as np
-import networkx as nx
 import xarray as xr
 import dask.array as da
-from dask import compute
-from functools import partial
+from dask import compute, delayed
 
 import multiscale_spatial_image as msi
 from spatial_image import to_spatial_image
 
-from multiview_stitcher import mv_graph, spatial_image_utils, msi_utils, param_utils
+from multiview_stitcher import spatial_image_utils, msi_utils, param_utils
 
 from napari.experimental import link_layers
 from napari.utils import notifications
 
 
-def image_layer_to_msim(l, viewer):
+logger = logging.getLogger(__name__)
+
+
+# contrast limits estimated by get_contrast_limits_from_msims
+# for a given cache key (e.g. the path of a file),
+# dropping the least recently used entries beyond the maximum size
+_contrast_limits_cache = OrderedDict()
+CONTRAST_LIMITS_CACHE_SIZE = 256
+
+
+def image_layer_to_msim(l, viewer, registration_binning=None):
 
     """
     Convert a napari layer into a MultiscaleSpatialImage compatible with multiview-stitcher.
 
+    Layers without xarray data are downsampled lazily into a pyramid,
+    unless they are multiscale already.
+
     Parameters
     ----------
     l : napari.layers.Image
         l.data contains Union[array, xr.DataArray] for each scale
+    registration_binning : dict, optional
+        Binning intended to be used for registration. Chunks of non-dask
+        layer data are chosen to be multiples of it, by default None
 
     Returns
     -------
@@ -30,85 +50,68 @@ def image_layer_to_msim(l, viewer):
         MultiscaleSpatialImage compatible with multiview-stitcher
     """
 
-    if l.multiscale:
+    if l.multiscale and isinstance(l.data[0], xr.DataArray):
 
         msim = msi.MultiscaleSpatialImage()
         for isim, ldata in enumerate(l.data):
 
-            # convert to SpatialImage if necessary
-            if not isinstance(ldata, xr.DataArray):
-                # need to implement downsampling logic for this
-                raise(NotImplementedError('Multiscale layers with non-xarray data not supported yet.'))
-            else:
-                sdims = spatial_image_utils.get_spatial_dims_from_sim(ldata)
+            sdims = spatial_image_utils.get_spatial_dims_from_sim(ldata)
 
-                ldata = ldata.assign_coords({'c': str(ldata.coords['c'].values)})
+            ldata = ldata.assign_coords({'c': str(ldata.coords['c'].values)})
 
-                sim = to_spatial_image(
-                    ldata,
-                    scale={dim: s for dim, s in zip(sdims, l.scale[-len(sdims):])},
-                    translation={dim: t for dim, t in zip(sdims, l.translate[-len(sdims):])},
-                    dims=ldata.dims,
-                )
+            sim = to_spatial_image(
+                ldata,
+                scale={dim: s for dim, s in zip(sdims, l.scale[-len(sdims):])},
+                translation={dim: t for dim, t in zip(sdims, l.translate[-len(sdims):])},
+                dims=ldata.dims,
+            )
 
             msi.MultiscaleSpatialImage(name='scale%s' %isim, data=sim, parent=msim)
-        
-    else:
 
-        ldata = l.data
+    elif l.multiscale:
 
-        # use dimension labels from viewer if indicated
-        # consider that labels are set if x and y are present
+        # derive the spacing of each scale from its shape
+        # relative to the highest resolution scale
+        dims = get_layer_data_dims(l.data[0], viewer)
+        sdims = [dim for dim in dims if dim in ['x', 'y', 'z']]
 
-        if isinstance(ldata, xr.DataArray):
-            dims = ldata.dims
-        
-        else:
-            ndim = len(ldata.shape)
-            if 'x' in viewer.dims.axis_labels and 'y' in viewer.dims.axis_labels:
-
-                dims = viewer.dims.axis_labels[-ndim:]
-
-                if 'c' in dims:
-                    raise(NotImplementedError('Layers with channel dims are not supported yet.'))
-                
-                if 'y' in dims and 'x' in dims:
-                    if dims.index('y') > dims.index('x'):
-                        raise(Exception('y dimension must come before x dimension.'))
-                    
-                if 'z' in dims and 'y' in dims:
-                    if dims.index('z') > dims.index('y'):
-                        raise(Exception('z dimension must come before y dimension.'))
+        msim = msi.MultiscaleSpatialImage()
+        for isim, ldata in enumerate(l.data):
 
-            else:
-                dims = ['t', 'z', 'y', 'x'][-ndim:]
+            factors = [s0 / s for s0, s in zip(
+                l.data[0].shape[-len(sdims):], ldata.shape[-len(sdims):])]
 
-        sdims = [dim for dim in dims if dim in ['x', 'y', 'z']]
+            sim = layer_data_to_sim(
+                ldata, dims,
+                scale=[s * f for s, f in zip(l.scale[-len(sdims):], factors)],
+                # pixel centers of downsampled scales are shifted
+                translate=[t + (f - 1) / 2 * s for t, s, f in zip(
+                    l.translate[-len(sdims):], l.scale[-len(sdims):], factors)],
+                registration_binning=registration_binning if not isim else None,
+                )
 
-        if not 't' in dims:
-            dims = ['t'] + dims
-            ldata = ldata[np.newaxis]
+            msi.MultiscaleSpatialImage(name='scale%s' %isim, data=sim, parent=msim)
+
+    else:
+
+        ldata = l.data
 
-        # make sure to work with dask array
         if isinstance(ldata, xr.DataArray):
-            data = ldata.data
+            dims = ldata.dims
+            ldata = ldata.data
         else:
-            data = ldata
+            dims = get_layer_data_dims(ldata, viewer)
 
-        if not isinstance(data, da.Array):
-            data = da.from_array(data)
+        sdims = [dim for dim in dims if dim in ['x', 'y', 'z']]
 
-        sim = to_spatial_image(
-            data,
-            scale={dim: s for dim, s in zip(sdims, l.scale[-len(sdims):])},
-            translation={dim: t for dim, t in zip(sdims, l.translate[-len(sdims):])},
-            dims=dims,
-        )
+        sim = layer_data_to_sim(
+            ldata, dims,
+            scale=l.scale[-len(sdims):],
+            translate=l.translate[-len(sdims):],
+            registration_binning=registration_binning,
+            )
 
-        sim = sim.assign_coords(c='default_channel')
-            
-        msim = msi.MultiscaleSpatialImage()
-        msi.MultiscaleSpatialImage(name='scale%s' %0, data=sim, parent=msim)
+        msim = get_msim_from_sim_preserving_chunks(sim)
         
     ndim = spatial_image_utils.get_ndim_from_sim(msi_utils.get_sim_from_msim(msim))
     affine = np.array(l.affine.affine_matrix)[-(ndim+1):, -(ndim+1):]
@@ -120,6 +123,219 @@ def image_layer_to_msim(l, viewer):
     return msim
 
 
+def get_layer_data_dims(ldata, viewer):
+    """
+    Get the dimension labels of (non-xarray) layer data.
+
+    Use dimension labels from the viewer if indicated, considering
+    that labels are set if x and y are present.
+    """
+
+    ndim = len(ldata.shape)
+    if 'x' in viewer.dims.axis_labels and 'y' in viewer.dims.axis_labels:
+
+        dims = list(viewer.dims.axis_labels[-ndim:])
+
+        if 'c' in dims:
+            raise(NotImplementedError('Layers with channel dims are not supported yet.'))
+        
+        if 'y' in dims and 'x' in dims:
+            if dims.index('y') > dims.index('x'):
+                raise(Exception('y dimension must come before x dimension.'))
+            
+        if 'z' in dims and 'y' in dims:
+            if dims.index('z') > dims.index('y'):
+                raise(Exception('z dimension must come before y dimension.'))
+
+    else:
+        dims = ['t', 'z', 'y', 'x'][-ndim:]
+
+    return dims
+
+
+def layer_data_to_sim(ldata, dims, scale, translate, registration_binning=None):
+    """
+    Wrap (a scale of) layer data into a SpatialImage with a time dimension.
+
+    Numpy, memmap and zarr data is wrapped without copying it: the dask
+    array refers to the original array (which is not hashed) and the time
+    dimension is added lazily.
+    """
+
+    dims = list(dims)
+    sdims = [dim for dim in dims if dim in ['x', 'y', 'z']]
+
+    # make sure to work with dask array
+    if not isinstance(ldata, da.Array):
+
+        chunks = get_layer_data_chunks(
+            ldata.shape,
+            dims,
+            registration_binning=registration_binning,
+            # e.g. zarr arrays
+            storage_chunks=getattr(ldata, 'chunks', None),
+            )
+
+        # avoid copying numpy arrays and memmaps into the dask graph
+        if isinstance(ldata, np.ndarray):
+            ldata = da.from_array(
+                _NonCopyableArray(ldata),
+                chunks=chunks,
+                name=False,
+                meta=np.empty((0,) * ldata.ndim, dtype=ldata.dtype),
+                )
+        else:
+            ldata = da.from_array(ldata, chunks=chunks, name=False)
+
+        logger.info(
+            'Wrapping layer data of shape %s (%s) using chunks %s',
+            ldata.shape, ', '.join(dims), chunks)
+
+    if not 't' in dims:
+        dims = ['t'] + dims
+        ldata = ldata[np.newaxis]
+
+    sim = to_spatial_image(
+        ldata,
+        scale={dim: s for dim, s in zip(sdims, scale)},
+        translation={dim: t for dim, t in zip(sdims, translate)},
+        dims=dims,
+    )
+
+    sim = sim.assign_coords(c='default_channel')
+
+    return sim
+
+
+class _NonCopyableArray:
+    """
+    Array proxy without a `copy` method, such that `da.from_array`
+    wraps the underlying (e.g. memory mapped) array without copying it.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.ndim = array.ndim
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+
+def get_layer_data_chunks(
+        shape,
+        dims,
+        registration_binning=None,
+        storage_chunks=None,
+        target_chunksize=None,
+        ):
+    """
+    Choose chunks for wrapping layer data into a dask array.
+
+    Each spatial dimension is split into equally sized chunks close to
+    `target_chunksize`. This way, the overlap regions at the borders of
+    tiles lie within full sized edge chunks. Chunk sizes are multiples
+    of the registration binning (such that binned blocks don't span
+    several chunks) and of the storage chunks of the data (such that
+    reading a chunk maps to reading whole storage chunks).
+
+    Parameters
+    ----------
+    shape : tuple of int
+    dims : list of str
+    registration_binning : dict, optional
+        Binning used for registration, by default None
+    storage_chunks : tuple of int, optional
+        Chunks of the underlying storage, e.g. of a zarr array, by default None
+    target_chunksize : int, optional
+        Target number of pixels per spatial dimension,
+        by default 1024 for 2D and 128 for 3D data
+
+    Returns
+    -------
+    tuple of int
+    """
+
+    sdims = [dim for dim in dims if dim in ['x', 'y', 'z']]
+
+    if target_chunksize is None:
+        target_chunksize = 1024 if len(sdims) < 3 else 128
+
+    if registration_binning is None:
+        registration_binning = {}
+
+    chunks = []
+    for idim, (dim, size) in enumerate(zip(dims, shape)):
+
+        if dim not in sdims:
+            chunks.append(1)
+            continue
+
+        multiple = int(registration_binning.get(dim, 1))
+        if storage_chunks is not None:
+            storage_chunksize = int(storage_chunks[idim])
+            multiple = multiple * storage_chunksize\
+                // math.gcd(multiple, storage_chunksize)
+
+        n_chunks = max(1, round(size / target_chunksize))
+        chunksize = math.ceil(math.ceil(size / n_chunks) / multiple) * multiple
+
+        chunks.append(max(1, min(chunksize, size)))
+
+    return tuple(chunks)
+
+
+def get_msim_from_sim_preserving_chunks(sim, scale_factors=None):
+    """
+    Like `msi_utils.get_msim_from_sim`, but keeps the spatial chunking
+    of the input (e.g. one chunk per file subblock) for all scales instead
+    of rechunking, such that no input chunk is read more than once
+    when computing a chunk of the pyramid.
+    """
+
+    sim_attrs = sim.attrs.copy()
+
+    # scalar coordinates, e.g. the channel of single channel images
+    scalar_coords = {k: v for k, v in sim.coords.items()
+                     if k not in sim.dims and not v.ndim}
+
+    if 'c' in sim.dims and 't' in sim.dims:
+        sim = sim.transpose(
+            *(['t', 'c'] + [dim for dim in sim.dims if dim not in ['c', 't']]))
+
+    sim = to_spatial_image(
+        sim.data,
+        dims=sim.dims,
+        scale=spatial_image_utils.get_spacing_from_sim(sim),
+        translation=spatial_image_utils.get_origin_from_sim(sim),
+        t_coords=sim.coords['t'].values,
+        c_coords=sim.coords['c'].values if 'c' in sim.dims else None,
+    ).assign_coords(scalar_coords)
+
+    if scale_factors is None:
+        scale_factors = msi_utils.get_optimal_multi_scale_factors_from_sim(sim)
+
+    if sim.chunks is None:
+        chunks = None
+    else:
+        chunks = {dim: 1 if dim in ['t', 'c'] else max(dim_chunks)
+                  for dim, dim_chunks in zip(sim.dims, sim.chunks)}
+
+    msim = msi.to_multiscale(
+        sim,
+        chunks=chunks,
+        scale_factors=scale_factors,
+    )
+
+    if 'transforms' in sim_attrs:
+        for sk in msi_utils.get_sorted_scale_keys(msim):
+            for transform_key, transform in sim_attrs['transforms'].items():
+                msim[sk][transform_key] = transform
+
+    return msim
+
+
 def add_image_layer_tuples_to_viewer(
         viewer, lds,
         do_link_layers=False,
@@ -128,17 +344,17 @@ def add_image_layer_tuples_to_viewer(
     """
     """
 
+    # manage viewer transformations
+    # (napari doesn't yet support different affine transforms for a single layer)
+    # the manager sets the transforms of each layer once it's inserted
+    if manage_viewer_transformations:
+        get_viewer_transformation_manager(viewer)
+
     layers = [viewer.add_image(ld[0], **ld[1]) for ld in lds]
 
     if do_link_layers:
         link_layers(layers)
 
-    # add callback to manage viewer transformations
-    # (napari doesn't yet support different affine transforms for a single layer)
-    if manage_viewer_transformations:
-        viewer.dims.events.connect(
-            partial(manage_viewer_transformations_callback, viewer=viewer))
-
     return layers
 
 
@@ -157,6 +373,11 @@ def create_image_layer_tuples_from_msim(
     """
 
     if 'c' in msi_utils.get_dims(msim):
+
+        # estimate contrast limits of all channels at once
+        if contrast_limits is None:
+            contrast_limits = get_contrast_limits_from_msims([msim])[0]
+
         out_layers = []
         for ch_coord in msi_utils.get_sim_from_msim(msim).coords['c']:
 
@@ -175,18 +396,19 @@ def create_image_layer_tuples_from_msim(
     sim = msi_utils.get_sim_from_msim(msim)
     scale_keys = msi_utils.get_sorted_scale_keys(msim)
 
-    if contrast_limits is None:
-        sim_thumb = msim[scale_keys[-1]]['image'].sel(t=sim.coords['t'][0])
-        contrast_limits = [v for v in [
-                    compute(np.min(sim_thumb.data))[0],
-                    compute(np.max(sim_thumb.data))[0]]]
-
     if ch_name is None:
         try:
             ch_name = str(sim.coords['c'].values[0])
         except:
             ch_name = str(sim.coords['c'].data)
 
+    if contrast_limits is None:
+        contrast_limits = get_contrast_limits_from_msims([msim])[0]
+
+    # contrast limits given per channel
+    if isinstance(contrast_limits, dict):
+        contrast_limits = contrast_limits[ch_name]
+
     if colormap is None:
         if 'GFP' in ch_name:
             colormap = 'green'
@@ -254,10 +476,28 @@ def create_image_layer_tuples_from_msims(
         contrast_limits=None,
         ch_coord=None,
         data_as_array=False,
+        contrast_limits_n_sample_chunks=None,
+        contrast_limits_percentiles=None,
+        contrast_limits_cache_key=None,
 ):
 
+    if ch_coord is not None:
+        msims = [msi_utils.multiscale_sel_coords(msim, {'c': ch_coord})
+                 for msim in msims]
+
     sims = [msi_utils.get_sim_from_msim(msim) for msim in msims]
 
+    # estimate contrast limits of all tiles and channels in one computation
+    if contrast_limits is None:
+        contrast_limits = get_contrast_limits_from_msims(
+            msims,
+            n_sample_chunks=contrast_limits_n_sample_chunks,
+            percentiles=contrast_limits_percentiles,
+            cache_key=contrast_limits_cache_key,
+            )
+    else:
+        contrast_limits = [contrast_limits for _ in msims]
+
     if positional_cmaps:
         cmaps = get_cmaps_from_sims(
             [spatial_image_utils.sim_sel_coords(sim, {'t':sim.coords['t'][0]}) for sim in sims],
@@ -268,67 +508,207 @@ def create_image_layer_tuples_from_msims(
     out_layers = []
     for iview, msim in enumerate(msims):
         out_layers += create_image_layer_tuples_from_msim(
-            msim if ch_coord is None
-            else msi_utils.multiscale_sel_coords(msim, {'c': ch_coord}),
+            msim,
             cmaps[iview],
             name_prefix=name_prefix + '_%03d' %iview,
             transform_key=transform_key,
-            contrast_limits=contrast_limits,
+            contrast_limits=contrast_limits[iview],
             data_as_array=data_as_array,
             )
     
     return out_layers
 
 
-def get_cmaps_from_sims(sims, n_colors=2, transform_key=None):
+def get_contrast_limits_from_msims(
+        msims,
+        n_sample_chunks=None,
+        percentiles=None,
+        cache_key=None,
+        seed=0,
+        ):
     """
-    Get colors from view adjacency graph analysis
+    Estimate contrast limits for all channels of several msims
+    within a single dask computation.
+
+    The limits are obtained from the first timepoint
+    of the lowest resolution scale.
 
-    Idea: use the same logic to determine relevant registration edges
+    Parameters
+    ----------
+    msims : list of MultiscaleSpatialImage
+    n_sample_chunks : int, optional
+        If given, estimate the limits from this number of randomly
+        chosen chunks of each image, by default None (all chunks)
+    percentiles : tuple of float, optional
+        Percentiles to use as limits instead of the minimum
+        and maximum, e.g. (0.1, 99.9), by default None
+    cache_key : hashable, optional
+        If given, results are cached under this key, e.g. the path,
+        modification time and size of the file the msims have been
+        read from (see `_utils.get_file_id`), by default None
+    seed : int, optional
+        Seed for sampling chunks, by default 0
 
+    Returns
+    -------
+    list of dict
+        Contrast limits [low, high] for each channel of each msim
     """
 
-    view_adj_graph = mv_graph.build_view_adjacency_graph_from_msims(
-        [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims],
-        expand=True,
-        transform_key=transform_key
-        )
+    if cache_key is not None:
+        cache_key = (cache_key, len(msims), n_sample_chunks,
+                     None if percentiles is None else tuple(percentiles), seed)
+        if cache_key in _contrast_limits_cache:
+            _contrast_limits_cache.move_to_end(cache_key)
+            return _contrast_limits_cache[cache_key]
 
-    # thresholds = threshold_multiotsu(overlaps)
+    rng = np.random.default_rng(seed)
 
-    # strategy: remove edges with overlap values of increasing thresholds until
-    # the graph division into n_colors is successful
+    ch_names, limits = [], []
+    for msim in msims:
 
-    # modify overlap values
-    # strategy: add a small amount to edge overlap depending on how many edges the nodes it connects have (betweenness?)
+        scale_keys = msi_utils.get_sorted_scale_keys(msim)
+        sim_thumb = msim[scale_keys[-1]]['image']
+        sim_thumb = sim_thumb.sel(t=sim_thumb.coords['t'][0])
 
-    edge_vals = nx.edge_betweenness_centrality(view_adj_graph)
+        if 'c' in sim_thumb.dims:
+            ch_thumbs = {str(ch_coord.values): sim_thumb.sel(c=ch_coord)
+                         for ch_coord in sim_thumb.coords['c']}
+        else:
+            ch_thumbs = {str(sim_thumb.coords['c'].values): sim_thumb}
+
+        ch_names.append(list(ch_thumbs.keys()))
+        limits += [_get_contrast_limits(
+                        ch_thumb.data, n_sample_chunks, percentiles, rng)
+                   for ch_thumb in ch_thumbs.values()]
 
-    edges = [e for e in view_adj_graph.edges(data=True)]
-    for e in edges:
-        edge_vals[tuple(e[:2])] = edge_vals[tuple(e[:2])] + e[2]['overlap']
+    limits = compute(limits)[0]
 
-    sorted_unique_vals = sorted(np.unique([v for v in edge_vals.values()]))
+    contrast_limits, ilimits = [], 0
+    for msim_ch_names in ch_names:
+        contrast_limits.append({})
+        for ch_name in msim_ch_names:
+            contrast_limits[-1][ch_name] = [float(v) for v in limits[ilimits]]
+            ilimits += 1
 
-    nx.set_edge_attributes(view_adj_graph, edge_vals, name='edge_val')
+    if cache_key is not None:
+        _contrast_limits_cache[cache_key] = contrast_limits
+        while len(_contrast_limits_cache) > CONTRAST_LIMITS_CACHE_SIZE:
+            _contrast_limits_cache.popitem(last=False)
 
-    thresh_ind = 0
-    while 1:
-        colors = nx.coloring.greedy_color(view_adj_graph)
-        if len(set(colors.values())) <= n_colors:# and nx.coloring.equitable_coloring.is_equitable(view_adj_graph, colors):
-            break
-        view_adj_graph.remove_edges_from(
-            [(a,b) for a, b, attrs in view_adj_graph.edges(data=True)
-            if attrs["edge_val"] <= sorted_unique_vals[thresh_ind]])
-        thresh_ind += 1
+    return contrast_limits
+
+
+def _get_contrast_limits(data, n_sample_chunks, percentiles, rng):
+    """
+    Lazily compute the contrast limits of a (sample of a) dask array.
+    """
+
+    if not isinstance(data, da.Array):
+        data = da.from_array(data)
+
+    blocks = [data]
+    if n_sample_chunks is not None:
+        block_indices = list(np.ndindex(*data.numblocks))
+        if n_sample_chunks < len(block_indices):
+            sampled = sorted(rng.choice(
+                len(block_indices), n_sample_chunks, replace=False))
+            blocks = [data.blocks[block_indices[i]] for i in sampled]
+
+    if percentiles is None:
+        return da.stack([
+            da.stack([block.min() for block in blocks]).min(),
+            da.stack([block.max() for block in blocks]).max(),
+        ])
+
+    return delayed(_percentiles_from_arrays)(blocks, percentiles)
+
+
+def _percentiles_from_arrays(arrays, percentiles):
+    return np.percentile(
+        np.concatenate([np.ravel(a) for a in arrays]), percentiles)
+
+
+def get_cmaps_from_sims(sims, n_colors=2, transform_key=None):
+    """
+    Get colors from the positions of the views.
+
+    The views are assigned to a grid by clustering their center positions
+    along each spatial dimension. Views are then colored in a checkerboard
+    pattern, such that neighboring views obtain different colors.
+
+    In contrast to coloring the view adjacency graph, this scales
+    with O(N log N) in the number of views.
+    """
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+    ndim = len(spatial_dims)
+
+    # avoid xarray arithmetics here, as they dominate
+    # the run time for large numbers of views
+    centers, extents = [], []
+    for sim in sims:
+        coords = [sim.coords[dim].values for dim in spatial_dims]
+        center = np.array([c[len(c) // 2] for c in coords], dtype=float)
+        extent = np.array([len(c) * (c[1] - c[0] if len(c) > 1 else 1.)
+                           for c in coords])
+
+        if transform_key is not None:
+            affine = spatial_image_utils.get_affine_from_sim(
+                sim, transform_key=transform_key).values
+            # select params of first time point if applicable
+            affine = affine.reshape((-1, ndim + 1, ndim + 1))[0]
+            center = affine[:ndim, :ndim] @ center + affine[:ndim, ndim]
+            extent = np.abs(affine[:ndim, :ndim]) @ extent
+
+        centers.append(center)
+        extents.append(extent)
+
+    color_indices = get_positional_color_indices(
+        np.array(centers), np.array(extents), n_colors=n_colors)
 
     cmaps = ['red', 'green', 'blue', 'yellow']
     cmaps = {iview: cmaps[color_index % len(cmaps)]
-             for iview, color_index in colors.items()}
-    
+             for iview, color_index in enumerate(color_indices)}
+
     return cmaps
 
 
+def get_positional_color_indices(centers, extents, n_colors=2, rel_tolerance=0.25):
+    """
+    Assign color indices to views based on their position on a grid.
+
+    Parameters
+    ----------
+    centers : array of shape (N, ndim)
+        Center positions of the views
+    extents : array of shape (N, ndim)
+        Physical extent of the views
+    n_colors : int, optional
+        Number of colors, by default 2
+    rel_tolerance : float, optional
+        Center positions closer than this fraction of the median view extent
+        are considered to belong to the same grid row/column, by default 0.25
+
+    Returns
+    -------
+    array of int
+        Color index for each view
+    """
+
+    centers = np.asarray(centers, dtype=float)
+    tolerances = rel_tolerance * np.median(np.asarray(extents), axis=0)
+
+    grid_indices = np.zeros(centers.shape, dtype=int)
+    for idim in range(centers.shape[1]):
+        order = np.argsort(centers[:, idim], kind='stable')
+        is_new_position = np.diff(centers[order, idim]) > tolerances[idim]
+        grid_indices[order, idim] = np.concatenate(
+            [[0], np.cumsum(is_new_position)])
+
+    return np.sum(grid_indices, axis=1) % n_colors
+
+
 def set_layer_xaffine(l, xaffine, transform_key, base_transform_key=None):
     for sim in l.data:
         spatial_image_utils.set_sim_affine(
@@ -339,69 +719,266 @@ def set_layer_xaffine(l, xaffine, transform_key, base_transform_key=None):
     return
 
 
-def manage_viewer_transformations_callback(event, viewer):
+def get_layer_affines_from_params(params, ndim_layer_data):
     """
-    set transformations
-    - for current timepoint
-    - for each (compatible) layer loaded in viewer
+    Adapt affine parameters of shape (..., ndim + 1, ndim + 1)
+    to the dimensionality of a layer.
+
+    Parameters
+    ----------
+    params : array-like
+        Affine parameters, optionally stacked along leading axes (e.g. time)
+    ndim_layer_data : int
+        Number of dimensions of the layer data
+
+    Returns
+    -------
+    np.ndarray
+        Affine parameters of shape (..., ndim_layer_data + 1, ndim_layer_data + 1)
     """
 
-    # compatible_layers = [l for l in self.viewer.layers
-    #                         if si.is_spatial_image(l.data[0])]
-    
-    # consider all layers for now
-    compatible_layers = viewer.layers
-    
-    if not len(compatible_layers): return
-    
-    # determine spatial dimensions from layers
-    all_spatial_dims = [spatial_image_utils.get_spatial_dims_from_sim(
-        l.data[0]) for l in compatible_layers]
-    
-    highest_sdim = max([len(sdim) for sdim in all_spatial_dims])
+    params = np.asarray(params)
 
-    # get curr tp
-    # handle possibility that there had been no T dimension
-    # when collecting sims from layers
-    if len(viewer.dims.current_step) > highest_sdim:
-        curr_tp = viewer.dims.current_step[-highest_sdim-1]
-    else:
-        curr_tp = 0
+    # if stitcher sim has more dimensions than layer data (i.e. time)
+    vis_p = params[..., -(ndim_layer_data + 1):, -(ndim_layer_data + 1):]
 
-    for _, l in enumerate(compatible_layers):
+    # if layer data has more dimensions than stitcher sim
+    full_vis_p = np.zeros(params.shape[:-2] + (ndim_layer_data + 1,) * 2)
+    full_vis_p[...] = np.eye(ndim_layer_data + 1)
+    full_vis_p[..., -vis_p.shape[-2]:, -vis_p.shape[-1]:] = vis_p
 
-        if not 'full_affine_transform' in l.metadata.keys(): continue
+    return full_vis_p
 
-        layer_sim = l.data[0]
 
+def set_layer_affines(layer_affines):
+    """
+    Set the affine transforms of several layers in a single batch.
+
+    Layers whose transform doesn't change are skipped. While the
+    transforms are set, the layers' extent events are blocked, such that
+    the viewer updates its extent once for all layers instead of once per
+    layer. Thumbnails, which don't depend on the transform, are kept.
+
+    Parameters
+    ----------
+    layer_affines : list of tuple
+        (layer, affine matrix) for each layer
+
+    Returns
+    -------
+    list of napari.layers.Layer
+        Layers whose transform changed
+    """
+
+    updated = [(l, affine) for l, affine in layer_affines
+               if not np.array_equal(l.affine.affine_matrix, affine)]
+
+    if not len(updated): return []
+
+    # extent events are private to napari and may not exist
+    extent_events = [getattr(l.events, '_extent_augmented', None)
+                     for l, _ in updated]
+    extent_events = [e for e in extent_events if e is not None]
+
+    with ExitStack() as stack:
+        for extent_event in extent_events:
+            stack.enter_context(extent_event.blocker())
+
+        for l, affine in updated:
+            l.affine.affine_matrix = affine
+
+            # refreshing layers fails sometimes
+            # this solution is suboptimal though
+            try:
+                l.refresh(thumbnail=False, highlight=False)
+            except:
+                pass
+
+    if len(extent_events):
+        extent_events[-1]()
+
+    return [l for l, _ in updated]
+
+
+def notify_missing_params(curr_tp, lnames):
+    """
+    Notify once about all layers without parameters at a timepoint.
+    """
+
+    if not len(lnames): return
+
+    notifications.notification_manager.receive_info(
+        'Timepoint %s: no parameters available for %s'
+        %(curr_tp, ', '.join(lnames)))
+
+
+class ViewerTransformationManager(object):
+    """
+    Show time dependent affine transforms of image layers
+    (napari doesn't yet support different affine transforms for a single layer).
+
+    Tracks the layers of a viewer carrying a 'full_affine_transform'
+    in their metadata and sets their affine for the current timepoint.
+    The transforms of each layer are extracted once into a numpy stack
+    indexed by timepoint.
+
+    Use `get_viewer_transformation_manager` to obtain the
+    (single) manager of a viewer. The manager only keeps a weak reference
+    to its viewer and disconnects from it once its window is closed.
+    """
+
+    def __init__(self, viewer):
+
+        self._viewer = weakref.ref(viewer)
+        self.layer_affines = dict()
+        self.curr_tp = None
+
+        for l in viewer.layers:
+            self.add_layer(l)
+
+        viewer.layers.events.inserted.connect(self.on_layer_inserted)
+        viewer.layers.events.removed.connect(self.on_layer_removed)
+        viewer.dims.events.current_step.connect(self.on_current_step)
+
+        # napari.Viewer (unlike ViewerModel) has a window
+        qt_window = getattr(getattr(viewer, 'window', None), '_qt_window', None)
+        if qt_window is not None:
+            qt_window.destroyed.connect(self.disconnect)
+
+        self.update(force=True)
+
+    @property
+    def viewer(self):
+        return self._viewer()
+
+    def disconnect(self, *args):
+        """
+        Stop tracking the layers of the viewer.
+        """
+
+        viewer = self.viewer
+        if viewer is None: return
+
+        viewer.layers.events.inserted.disconnect(self.on_layer_inserted)
+        viewer.layers.events.removed.disconnect(self.on_layer_removed)
+        viewer.dims.events.current_step.disconnect(self.on_current_step)
+
+        self.layer_affines = dict()
+        _viewer_transformation_managers.pop(viewer, None)
+
+    def add_layer(self, l):
+        """
+        Track a layer. Returns whether the layer carries transforms.
+        """
+
+        if l.metadata is None or\
+            'full_affine_transform' not in l.metadata.keys(): return False
+
+        layer_sim = l.data[0]
         params = l.metadata['full_affine_transform']
 
-        try:
-            p = np.array(params.sel(t=layer_sim.coords['t'][curr_tp])).squeeze()
+        # parameters for all timepoints of the layer, NaN if not available
+        if 't' in params.dims:
+            params = params.reindex(t=layer_sim.coords['t'])
+            params = np.array(params.transpose('t', ...))
+        else:
+            params = np.array([np.array(params)] * len(layer_sim.coords['t']))
 
-        except:
-            notifications.notification_manager.receive_info(
-                'Timepoint %s: no parameters available for tp %s' % curr_tp)
-            continue
-            # if curr_tp not available, use nearest available parameter
-            # notifications.notification_manager.receive_info(
-            #     'Timepoint %s: no parameters available, taking nearest available one.' % curr_tp)
-            # p = np.array(params.sel(t=layer_sim.coords['t'][curr_tp], method='nearest')).squeeze()
+        self.layer_affines[id(l)] = (
+            l,
+            len(spatial_image_utils.get_spatial_dims_from_sim(layer_sim)),
+            get_layer_affines_from_params(params, len(layer_sim.shape)),
+            )
 
-        ndim_layer_data = len(layer_sim.shape)
+        return True
 
-        # if stitcher sim has more dimensions than layer data (i.e. time)
-        vis_p = p[-(ndim_layer_data + 1):, -(ndim_layer_data + 1):]
+    def on_layer_inserted(self, event):
 
-        # if layer data has more dimensions than stitcher sim
-        full_vis_p = np.eye(ndim_layer_data + 1)
-        full_vis_p[-len(vis_p):, -len(vis_p):] = vis_p
+        if not self.add_layer(event.value): return
 
-        l.affine.affine_matrix = full_vis_p
+        # the inserted layer may change which dimension is time
+        curr_tp = self.get_current_timepoint()
+        if curr_tp != self.curr_tp:
+            self.update()
+            return
 
-        # refreshing layers fails sometimes
-        # this solution is suboptimal though
-        try:
-            l.refresh()
-        except:
-            pass
\ No newline at end of file
+        self.set_layer_affines([self.layer_affines[id(event.value)]], curr_tp)
+
+    def on_layer_removed(self, event):
+        self.layer_affines.pop(id(event.value), None)
+
+    def on_current_step(self, event):
+        self.update()
+
+    def get_current_timepoint(self):
+
+        highest_sdim = max([sdim for _, sdim, _ in self.layer_affines.values()])
+
+        # handle possibility that there had been no T dimension
+        # when collecting sims from layers
+        if len(self.viewer.dims.current_step) > highest_sdim:
+            return self.viewer.dims.current_step[-highest_sdim-1]
+        else:
+            return 0
+
+    def update(self, force=False):
+        """
+        Set the transforms of the current timepoint
+        (only if it changed, unless force is True).
+        """
+
+        if not len(self.layer_affines): return
+
+        curr_tp = self.get_current_timepoint()
+
+        if curr_tp == self.curr_tp and not force: return
+
+        self.set_layer_affines(self.layer_affines.values(), curr_tp)
+
+        self.curr_tp = curr_tp
+
+    def set_layer_affines(self, layer_affines, curr_tp):
+        """
+        Set the transforms of the given (layer, sdim, affines)
+        for a timepoint in a single batch (see `set_layer_affines`).
+        """
+
+        updates, missing = [], []
+        for l, sdim, affines in layer_affines:
+            if curr_tp >= len(affines) or np.isnan(affines[curr_tp]).any():
+                missing.append(l.name)
+            else:
+                updates.append((l, affines[curr_tp]))
+
+        set_layer_affines(updates)
+        notify_missing_params(curr_tp, missing)
+
+
+# one transformation manager per viewer, which
+# doesn't keep closed viewers from being collected
+_viewer_transformation_managers = weakref.WeakKeyDictionary()
+
+
+def get_viewer_transformation_manager(viewer):
+    """
+    Get the transformation manager of a viewer, creating
+    it (and connecting it to the viewer events) only once.
+    """
+
+    manager = _viewer_transformation_managers.get(viewer)
+
+    if manager is None:
+        manager = ViewerTransformationManager(viewer)
+        _viewer_transformation_managers[viewer] = manager
+
+    return manager
+
+
+def manage_viewer_transformations_callback(event, viewer):
+    """
+    set transformations
+    - for current timepoint
+    - for each (compatible) layer loaded in viewer
+    """
+
+    get_viewer_transformation_manager(viewer).update(force=True)